@@ -11,20 +11,24 @@ class BOWActor(macarico.Actor):
     def __init__(self, attention, n_actions, act_history_length=1, obs_history_length=0):
         self.att_dim = sum((att.dim for att in attention))
         super().__init__(n_actions,
-                         self.att_dim + 
+                         self.att_dim +
                          act_history_length * n_actions + \
                          obs_history_length * self.att_dim,
                          attention)
         self.act_history_length = act_history_length
         self.obs_history_length = obs_history_length
+        self._act_history = None
         self._reset()
 
     def _forward(self, state, x):
         feats = x[:]
         if self.act_history_length > 0:
-            f = util.zeros(self, 1, self.act_history_length * self.n_actions)
+            # reuse the history buffer; torch.cat below copies it
+            if self._act_history is None:
+                self._act_history = util.zeros(self, 1, self.act_history_length * self.n_actions)
+            f = self._act_history.zero_()
             for i in range(min(self.act_history_length, len(state._trajectory))):
-                a = state._trajectory[-i]
+                a = state._trajectory[-1-i]
                 f[0, i * self.n_actions + a] = 1
             feats.append(Varng(f))
         if self.obs_history_length > 0:
@@ -35,9 +39,47 @@ class BOWActor(macarico.Actor):
             self.obs_history_pos = (self.obs_history_pos + 1) % self.obs_history_length
         return torch.cat(feats, dim=1)
 
+    def trajectory_independent(self):
+        return self.act_history_length == 0 and self.obs_history_length == 0 and \
+            not any((att.actor_dependent for att in self.attention))
+
+    def _forward_all(self, env, x):
+        return torch.cat(x, dim=1)
+
+    def _forward_batch(self, states, x):
+        B = len(states)
+        feats = x[:]
+        if self.act_history_length > 0:
+            # column L*n_actions is a sink for missing history entries
+            L, K = self.act_history_length, self.n_actions
+            idx = [[i * K + int(state._trajectory[-1-i]) if i < len(state._trajectory) else L * K \
+                    for i in range(L)] \
+                   for state in states]
+            f = util.zeros(self, B, L * K + 1)
+            f.scatter_(1, util.longtensor(self, idx), 1.)
+            feats.append(Varng(f[:, :L*K]))
+        if self.obs_history_length > 0:
+            L = self.obs_history_length
+            for i in range(L):
+                feats.append(Varng(self.obs_history_batch[(self.obs_history_batch_pos+i) % L]))
+            self.obs_history_batch[self.obs_history_batch_pos] = torch.cat(x, dim=1).data
+            self.obs_history_batch_pos = (self.obs_history_batch_pos + 1) % L
+        return torch.cat(feats, dim=1)
+
     def _reset(self):
         self.obs_history = []
         for _ in range(self.obs_history_length):
             self.obs_history.append(util.zeros(self, 1, self.att_dim))
         self.obs_history_pos = 0
-        
+
+    def _snapshot(self):
+        return list(self.obs_history), self.obs_history_pos
+
+    def _restore(self, snapshot):
+        self.obs_history = list(snapshot[0])
+        self.obs_history_pos = snapshot[1]
+
+    def _reset_batch(self, batch_size):
+        self.obs_history_batch = util.zeros(self, max(1, self.obs_history_length), batch_size, self.att_dim)
+        self.obs_history_batch_pos = 0
+
@@ -24,35 +24,110 @@ class RNNActor(macarico.Actor):
         self.d_actemb = d_actemb
         self.d_hid = d_hid
         self.cell_type = cell_type
-        
+
         input_dim = (d_actemb or (1+n_actions)) + sum((att.dim for att in self.attention))
-        
+
         if self.d_actemb is not None:
             self.embed_a = nn.Embedding(1+n_actions, self.d_actemb)
         self.rnn = getattr(nn, cell_type + 'Cell')(input_dim, self.d_hid)
         self.h = None
+        self.h_batch = None
+        self._act_onehot = None # fixed one-hot "embedding" when d_actemb is None
 
     def _reset(self):
-        self.h = Varng(util.zeros(self.rnn.weight_ih, 1, self.d_hid))
+        self.h = self._zero_hidden(1)
+
+    def _reset_batch(self, batch_size):
+        self.h_batch = self._zero_hidden(batch_size)
+
+    def _snapshot(self):
+        # self.h is replaced, never modified in place
+        return self.h
+
+    def _restore(self, snapshot):
+        self.h = snapshot
+
+    def _tied_rnn(self):
+        # an nn.LSTM/GRU/RNN sharing self.rnn's parameters, to run a
+        # whole known sequence in one call; kept out of the module tree
+        # so its (shared) parameters aren't registered twice
+        rnn = self.__dict__.get('_tied')
+        if rnn is None:
+            rnn = getattr(nn, self.cell_type)(self.rnn.input_size, self.d_hid)
+            self.__dict__['_tied'] = rnn
+        for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']:
+            setattr(rnn, name + '_l0', getattr(self.rnn, name))
+        return rnn
+
+    def _teacher_force(self, inputs, actions):
+        w = self.rnn.weight_ih
+        T = len(inputs)
+        last_a = [self.n_actions] + actions[:T-1]
+        prev_a = self.embed_actions(util.longtensor(w, last_a))
+        x = torch.cat([torch.cat(x_t, 1) for x_t in inputs], 0)
+        self._forced_inputs = torch.cat([prev_a, x], 1)
+
+        h0 = self._zero_hidden(1)
+        h0 = (h0[0].unsqueeze(0), h0[1].unsqueeze(0)) if self.cell_type == 'LSTM' else h0.unsqueeze(0)
+        out, hn = self._tied_rnn()(self._forced_inputs.unsqueeze(1), h0)
+        self._forced_outputs = out.view(T, self.d_hid)
+        self._forced_final = (hn[0][0], hn[1][0]) if self.cell_type == 'LSTM' else hn[0]
+        return self._forced_outputs
+
+    def _forced_state(self, t):
+        if t == self._forced_outputs.shape[0]:
+            return self._forced_final
+        if self.cell_type != 'LSTM':
+            return self._zero_hidden(1) if t == 0 else self._forced_outputs[t-1:t]
+        # intermediate LSTM cell states aren't returned by nn.LSTM;
+        # replay the first t steps (only needed off the forced path)
+        h = self._zero_hidden(1)
+        for i in range(t):
+            h = self.rnn(self._forced_inputs[i:i+1], h)
+        return h
+
+    def _zero_hidden(self, batch_size):
+        h = Varng(util.zeros(self.rnn.weight_ih, batch_size, self.d_hid))
         if self.cell_type == 'LSTM':
-            self.h = self.h, Varng(util.zeros(self.rnn.weight_ih, 1, self.d_hid))
+            h = h, Varng(util.zeros(self.rnn.weight_ih, batch_size, self.d_hid))
+        return h
 
     def hidden(self):
         return self.h[0] if self.cell_type == 'LSTM' else self.h
-        
+
+    def hidden_batch(self):
+        return self.h_batch[0] if self.cell_type == 'LSTM' else self.h_batch
+
+    def embed_actions(self, last_a):
+        # last_a is a LongTensor of previous actions, where n_actions
+        # means "no previous action"; returns (len(last_a), d_actemb)
+        if self.d_actemb is not None:
+            return self.embed_a(Varng(last_a))
+        w = self.rnn.weight_ih
+        if self._act_onehot is None or self._act_onehot.type() != w.data.type():
+            self._act_onehot = util.zeros(w, 1+self.n_actions, 1+self.n_actions)
+            for a in range(1+self.n_actions):
+                self._act_onehot[a,a] = 1
+        return Varng(self._act_onehot.index_select(0, last_a))
+
     def _forward(self, state, x):
         w = self.rnn.weight_ih
         # embed the previous action (if it exists)
         last_a = self.n_actions if len(state._trajectory) == 0 else state._trajectory[-1]
-        if self.d_actemb is None:
-            prev_a = util.zeros(w, 1, 1+self.n_actions)
-            prev_a[0,last_a] = 1
-            prev_a = Varng(prev_a)
-        else:
-            prev_a = self.embed_a(util.onehot(w, last_a))
+        prev_a = self.embed_actions(util.longtensor(w, [int(last_a)]))
 
         # combine prev hidden state, prev action embedding, and input x
         inputs = torch.cat([prev_a] + x, 1)
         self.h = self.rnn(inputs, self.h)
         return self.hidden()
-    
+
+    def _forward_batch(self, states, x):
+        w = self.rnn.weight_ih
+        last_a = [self.n_actions if len(state._trajectory) == 0 else int(state._trajectory[-1]) \
+                  for state in states]
+        prev_a = self.embed_actions(util.longtensor(w, last_a))
+
+        inputs = torch.cat([prev_a] + x, 1)
+        self.h_batch = self.rnn(inputs, self.h_batch)
+        return self.hidden_batch()
+
@@ -115,3 +115,6 @@ class stochastic(object):
         self.time += 1
     def __call__(self):
         return random() <= self.inst(self.time)
+    def always(self):
+        "will the next call certainly return True?"
+        return self.inst(self.time) >= 1
@@ -1,9 +1,11 @@
 from __future__ import division, generators, print_function
 import sys
+from collections import OrderedDict
 import torch
 import torch.nn as nn
 from torch.nn.parameter import Parameter
 from torch.autograd import Variable as Var
+from macarico.profiling import profiler
 
 if True:
     # check version
@@ -13,6 +15,17 @@ if True:
     assert major == 0 and minor >= 4, \
         "sorry, macarico requires pytorch version >= 0.4, you have %s" % torch.__version__
 
+# per-step sanity checks on the hot paths (timesteps, tensor shapes);
+# read it as macarico.base.DEBUG, since `from macarico.base import *`
+# copies the value
+DEBUG = False
+
+def set_debug(debug=True):
+    r"""Turn the per-step sanity checks in `Env.run_episode`, `Actor`,
+    `DynamicFeatures` and `Attention` on or off (default: off)."""
+    global DEBUG
+    DEBUG = debug
+
 def check_intentional_override(class_name, fn_name, override_bool_name, obj, *fn_args):
     if not getattr(obj, override_bool_name): # self.OVERRIDE_RUN_EPISODE:
         try:
@@ -71,9 +84,27 @@ class Env(object):
 
     May optionally provide a `_rewind` function that some learning
     algorithms (e.g., LOLS) requires.
+
+    May optionally provide `_reset(example)`, which lets `reset` reuse
+    the env (and any buffers it allocated) on a new example instead of
+    constructing a new one (see `util.EnvPool`).
+
+    Envs whose sequence of states does not depend on the actions taken
+    (e.g., sequence labeling) set `TRAJECTORY_INDEPENDENT` and provide
+    `states()`; `run_episode` then gives the policy a chance to handle
+    the whole episode at once (see `Policy.forward_sequence`).
+
+    Envs whose states are a deterministic function of the example and
+    the actions taken set `DETERMINISTIC`, which lets learning
+    algorithms cache per-prefix state (see `Actor.enable_prefix_cache`).
     """
     OVERRIDE_RUN_EPISODE = False
     OVERRIDE_REWIND = False
+    TRAJECTORY_INDEPENDENT = False
+    DETERMINISTIC = False
+    _policy = None          # the policy of the running episode, see _act
+    _action_mask = None     # cached mask ...
+    _action_mask_of = None  # ... and the self.actions it was computed from
     
     def __init__(self, n_actions, T, example=None):
         self.n_actions = n_actions
@@ -92,43 +123,194 @@ class Env(object):
     def output(self):
         return self._trajectory
     
-    def run_episode(self, policy):
-        #print('BEGIN run_episode', type(self), type(policy))
-        def _policy(state):
-            #print('t', self.timestep(), self.horizon())
-            #if not( self.timestep() < self.horizon()):
-            #    import ipdb; ipdb.set_trace()
-            assert self.timestep() < self.horizon()
-            #print(state, type(policy))
-            a = policy(state)
-            self._trajectory.append(a)
-            return a
-        if hasattr(policy, 'new_example'):
-            policy.new_example()
+    def run_episode(self, policy, keep_features=False):
+        r"""Run `policy` through this env and return its output. By
+        default this starts from scratch by calling
+        `policy.new_example()`. A driver that reruns the same example with
+        unchanged parameters (eg, LOLS rollouts) can pass
+        `keep_features=True` to reuse the static features computed on
+        `self.example` (and any cached actor steps); then only the
+        actors are reset."""
+        prof = profiler.enabled
+        if prof: t0 = profiler.start()
+        if not keep_features:
+            new_example = getattr(policy, 'new_example', None)
+            if new_example is not None:
+                new_example()
         self.rewind(policy)
-        _policy.new_minibatch = policy.new_minibatch if hasattr(policy, 'new_minibatch') else None
-        _policy.new_example = policy.new_example if hasattr(policy, 'new_example') else None
-        _policy.new_run = policy.new_run if hasattr(policy, 'new_run') else None
-        out = self._run_episode(_policy)
-        self.example.Yhat = out if out is not None else self._trajectory
-        #print('END run_episode')
+        out = None
+        if self.TRAJECTORY_INDEPENDENT:
+            forward_sequence = getattr(policy, 'forward_sequence', None)
+            if forward_sequence is not None:
+                try:
+                    out = forward_sequence(self)
+                except NotImplementedError:
+                    pass
+        if out is None:
+            # _run_episode gets a bound method rather than a new closure
+            # per episode; saving _policy allows nested episodes
+            outer_policy, self._policy = self._policy, policy
+            try:
+                out = self._run_episode(self._act_debug if DEBUG else self._act)
+            finally:
+                self._policy = outer_policy
+            if out is None:
+                out = self._trajectory
+        self.example.Yhat = out
+        if prof: profiler.stop('%s.run_episode' % type(self).__name__, t0)
         return self.example.Yhat
+
+    def _act(self, state):
+        a = self._policy(state)
+        self._trajectory.append(a)
+        return a
+
+    def _act_debug(self, state):
+        assert self.timestep() < self.horizon(), \
+            '%s ran past its horizon %d' % (type(self).__name__, self.horizon())
+        return self._act(state)
     
     def input_x(self):
         return self.example.X
 
+    def action_mask(self):
+        r"""Returns a ByteTensor of size `n_actions` that is 1 exactly
+        for the actions in `self.actions` (all ones if that is None).
+        The mask is cached until `self.actions` is reassigned, so envs
+        that modify their action set in place must reassign it (or call
+        `set_action_mask`). Callers must not modify the result."""
+        actions = self.actions
+        if self._action_mask is None or self._action_mask_of is not actions:
+            mask = torch.zeros(self.n_actions).byte()
+            if actions is None or len(actions) == self.n_actions:
+                mask.fill_(1)
+            elif len(actions) > 0:
+                mask.index_fill_(0, torch.LongTensor(list(actions)), 1)
+            self._action_mask = mask
+            self._action_mask_of = actions
+        return self._action_mask
+
+    def set_action_mask(self, mask):
+        r"""Publish a precomputed mask for the current `self.actions`
+        (eg, one computed directly from the board in a game, or shared
+        between states)."""
+        self._action_mask = mask
+        self._action_mask_of = self.actions
+
     def rewind(self, policy):
         self._trajectory = []
         if hasattr(policy, 'new_run'): # TODO make policy.new_run abstract
             policy.new_run()
         self._rewind()
         
+    def reset(self, example):
+        r"""Make this env equivalent to a freshly constructed one on
+        `example` and return it; raises NotImplementedError if the env
+        doesn't provide `_reset`, in which case the env is unchanged."""
+        if type(self)._reset is Env._reset:
+            raise NotImplementedError('%s does not support reset' % type(self).__name__)
+        self.example = example
+        self._trajectory = []
+        self._action_mask = None
+        self._action_mask_of = None
+        if hasattr(self, '_stored_batch_features'):
+            self._stored_batch_features.clear()
+        self._reset(example)
+        return self
+        
     def _run_episode(self, policy):
         raise NotImplementedError('abstract')
     
     def _rewind(self):
         raise NotImplementedError('abstract')
 
+    def _reset(self, example):
+        # set up everything the constructor derives from example;
+        # self.example is already set (envs that make their own
+        # example may replace it)
+        raise NotImplementedError('abstract')
+
+    def states(self):
+        # for TRAJECTORY_INDEPENDENT envs: iterate over the env at each
+        # timestep; the caller appends the action it takes at each
+        # state to _trajectory before moving on to the next
+        raise NotImplementedError('abstract')
+
+class VectorEnv(object):
+    r"""`n_envs` independent copies of a simple (typically
+    classic-control) environment, simulated together as tensors with
+    a leading dimension of size `n_envs`.
+
+    Rather than running complete episodes, a `VectorEnv` is stepped:
+    `step(actions)` takes a LongTensor of one action per copy and
+    returns the per-step costs (a FloatTensor) and a ByteTensor
+    marking the copies whose episode just ended (by termination or by
+    reaching the horizon `T`). Those copies are reset automatically,
+    and the total loss and length of each finished episode is recorded
+    in `finished_losses` and `finished_lengths`.
+
+    Must provide `_reset(mask)` that reinitializes exactly the copies
+    for which the ByteTensor `mask` is 1, and `_step(actions)` that
+    advances every copy and returns `(costs, done)`.
+
+    Learners that support vector environments implement
+    `forward_vector`, `observe_vector` and `get_objective_vector`; see
+    `run_steps`.
+    """
+    def __init__(self, n_envs, n_actions, T):
+        self.n_envs = n_envs
+        self.n_actions = n_actions
+        self.T = T
+        self.t = torch.zeros(n_envs).long()
+        self.episode_loss = torch.zeros(n_envs)
+        self.finished_losses = []
+        self.finished_lengths = []
+
+    def horizon(self):
+        return self.T
+
+    def reset(self, mask=None):
+        if mask is None:
+            mask = torch.ones(self.n_envs).byte()
+        self.t.masked_fill_(mask, 0)
+        self.episode_loss.masked_fill_(mask, 0.)
+        self._reset(mask)
+
+    def step(self, actions):
+        costs, done = self._step(actions)
+        self.t += 1
+        self.episode_loss += costs
+        done = done | (self.t >= self.T)
+        if done.any():
+            idx = done.nonzero().view(-1)
+            self.finished_losses.extend(self.episode_loss.index_select(0, idx).tolist())
+            self.finished_lengths.extend(self.t.index_select(0, idx).tolist())
+            self.reset(done)
+        return costs, done
+
+    def pop_finished(self):
+        "return and forget the losses of all episodes finished so far"
+        losses = self.finished_losses
+        self.finished_losses = []
+        self.finished_lengths = []
+        return losses
+
+    def run_steps(self, learner, n_steps):
+        r"""Advance every copy `n_steps` times, acting according to
+        `learner`, and return its objective over the resulting
+        (n_steps, n_envs) rollout."""
+        for _ in range(n_steps):
+            actions = learner.forward_vector(self)
+            costs, done = self.step(actions)
+            learner.observe_vector(self, costs, done)
+        return learner.get_objective_vector(self)
+
+    def _reset(self, mask):
+        raise NotImplementedError('abstract')
+
+    def _step(self, actions):
+        raise NotImplementedError('abstract')
+
 class TypeMemory(nn.Module):
     def __init__(self):
         nn.Module.__init__(self)
@@ -148,6 +330,7 @@ class DynamicFeatures(nn.Module):
         self.dim = dim
         self._current_env = None
         self._features = None
+        self._features_of = None   # the example _features were computed on
         self._batched_features = None
         self._batched_lengths = None
         self._my_id = '%s #%d' % (type(self), id(self))
@@ -159,23 +342,38 @@ class DynamicFeatures(nn.Module):
         raise NotImplementedError('abstract')
 
     def forward(self, env):
+        prof = profiler.enabled
+        if prof: t0 = profiler.start()
+        from_batch = False
+        example = getattr(env, 'example', None)
         # check to see if batched computation is done
         if self._batched_features is not None and \
            hasattr(env, '_stored_batch_features') and \
            self._my_id in env._stored_batch_features:
             # just get the stored features
             i = env._stored_batch_features[self._my_id]
-            assert 0 <= i and i < self._batched_features.shape[0]
-            assert self._batched_lengths[i] <= self._batched_features.shape[1]
+            if DEBUG:
+                assert 0 <= i and i < self._batched_features.shape[0]
+                assert self._batched_lengths[i] <= self._batched_features.shape[1]
             l = self._batched_lengths[i]
             self._features = self._batched_features[i,:l,:].unsqueeze(0)
+            self._features_of = example
+            from_batch = True
             
-        if self._features is None or self._recompute_always:
+        # static features live until new_example/new_minibatch, or
+        # until we're asked about a different example
+        if self._recompute_always or self._features is None or \
+           self._features_of is not example:
+            if prof and not self._recompute_always: profiler.miss('static features')
             self._features = self._forward(env)
-            assert self._features.dim() == 3
-            assert self._features.shape[0] == 1
-            assert self._features.shape[2] == self.dim
-        assert self._features is not None
+            self._features_of = example
+            if DEBUG:
+                assert self._features.dim() == 3
+                assert self._features.shape[0] == 1
+                assert self._features.shape[2] == self.dim
+        elif prof:
+            profiler.hit('batched features' if from_batch else 'static features')
+        if prof: profiler.stop('%s.forward' % type(self).__name__, t0)
         return self._features
 
     def _forward_batch(self, envs):
@@ -189,8 +387,6 @@ class DynamicFeatures(nn.Module):
             res = self._forward_batch(envs)
             assert isinstance(res, tuple)
             self._batched_features, self._batched_lengths = res
-            if self._batched_features.shape[0] != len(envs):
-                import ipdb; ipdb.set_trace()
         except NotImplementedError:
             pass
 
@@ -232,19 +428,92 @@ class StaticFeatures(DynamicFeatures):
         DynamicFeatures.__init__(self, dim)
         self._recompute_always = False
     
+class PrefixCache(object):
+    r"""A trie over the action prefixes of one example. Node values are
+    whatever an `Actor` needs to resume an episode after that prefix
+    (see `Actor.enable_prefix_cache`). Walking one step down the trie
+    per timestep makes lookups O(1) rather than O(t). At most
+    `max_size` nodes hold values; the least recently used are evicted
+    first, and childless empty nodes are pruned."""
+    class Node(object):
+        __slots__ = ['parent', 'action', 'children', 'value']
+        def __init__(self, parent, action):
+            self.parent = parent
+            self.action = action
+            self.children = {}
+            self.value = None
+
+        def child(self, a):
+            c = self.children.get(a)
+            if c is None:
+                c = self.children[a] = PrefixCache.Node(self, a)
+            return c
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.clear()
+
+    def clear(self, example=None):
+        self.example = example
+        self.root = PrefixCache.Node(None, None)
+        self._lru = OrderedDict()
+
+    def __len__(self):
+        return len(self._lru)
+
+    def get(self, node):
+        if node.value is not None:
+            self._lru.move_to_end(node)
+        return node.value
+
+    def put(self, node, value):
+        node.value = value
+        self._lru[node] = True
+        self._lru.move_to_end(node)
+        while len(self._lru) > self.max_size:
+            old, _ = self._lru.popitem(last=False)
+            old.value = None
+            while old.parent is not None and old.value is None and len(old.children) == 0 and \
+                  old.parent.children.get(old.action) is old:
+                del old.parent.children[old.action]
+                old = old.parent
+
 class Actor(nn.Module):
-    r"""An `Actor` is a module that computes features dynamically as a policy runs."""
+    r"""An `Actor` is a module that computes features dynamically as a policy runs.
+
+    The (detached) features computed at each step of an episode are
+    written into a contiguous (T, dim) buffer that grows on demand and
+    is kept across episodes; see `step_features`.
+
+    Actors that implement `_snapshot` and `_restore` can cache their
+    output and state for each action prefix of the current example
+    (see `enable_prefix_cache`), so that repeated runs that share a
+    prefix (eg, LOLS rollouts) resume where the prefix ends.
+
+    Actors that also implement `_teacher_force` can compute all their
+    outputs for a known action sequence at once (see
+    `macarico.util.teacher_force`)."""
     OVERRIDE_FORWARD = False
+    INITIAL_BUFFER_SIZE = 16
+
     def __init__(self, n_actions, dim, attention):
         nn.Module.__init__(self)
         self._current_env = None
-        self._features = None
+        self._current = None  # features (with graph) for step self._last_t
+        self._n_steps = 0     # number of rows of _step_buffer filled this episode
+        self._step_buffer = None
         self.n_actions = n_actions
 
         self.dim = dim
         self.attention = nn.ModuleList(attention)
         self._T = None
         self._last_t = 0
+        self._batch_size = None
+        self._prefix_cache = None
+        self._prefix_node = None
+        self._forcing_inputs = None  # attention outputs per step, while recording
+        self._forced = None          # (example, actions, outputs) to replay
+        self._forced_on_path = False
 
         for att in attention:
             if att.actor_dependent:
@@ -257,57 +526,314 @@ class Actor(nn.Module):
     def reset(self):
         self._last_t = 0
         self._T = None
-        self._features = None
+        self._current = None
+        self._n_steps = 0
+        self._batch_size = None
+        self._prefix_node = None
         self._reset()
 
     def _reset(self):
         pass
+
+    def _snapshot(self):
+        # returns whatever _restore needs to put the actor back in its
+        # current state; must not be modified in place afterwards
+        raise NotImplementedError('abstract')
+
+    def _restore(self, snapshot):
+        raise NotImplementedError('abstract')
+
+    def enable_prefix_cache(self, max_size=10000):
+        r"""Cache this actor's output and state for up to `max_size`
+        action prefixes of the current example, so runs that repeat a
+        prefix skip straight past it. This assumes the env is a
+        deterministic function of the example and the actions taken.
+        Cached outputs keep their graphs, so the cache is cleared
+        by `new_example` and `new_minibatch` (ie, before the parameters
+        change). Returns False (and does nothing) if the actor does not
+        implement `_snapshot`."""
+        try:
+            self._snapshot()
+        except NotImplementedError:
+            return False
+        self._prefix_cache = PrefixCache(max_size)
+        self._prefix_node = None
+        return True
+
+    def disable_prefix_cache(self):
+        self._prefix_cache = None
+        self._prefix_node = None
+
+    def clear_prefix_cache(self):
+        if self._prefix_cache is not None:
+            self._prefix_cache.clear()
+        self._prefix_node = None
+
+    def _teacher_force(self, inputs, actions):
+        # given the attention outputs at every step (a list of lists,
+        # as passed to _forward) of an episode in which `actions` are
+        # taken, return the (T, dim) outputs of all steps; afterwards
+        # _forced_state(t) must return a snapshot (see _restore) of the
+        # actor after the first t of those steps
+        raise NotImplementedError('abstract')
+
+    def _forced_state(self, t):
+        raise NotImplementedError('abstract')
+
+    def trajectory_independent(self):
+        # True if the output at each step depends only on the env's
+        # state at that step (not on earlier actions or outputs), in
+        # which case forward_all can compute all steps at once
+        return False
+
+    def _forward_all(self, env, x):
+        raise NotImplementedError('abstract')
+
+    def forward_all(self, env):
+        r"""The (T, dim) outputs at every state of `env.states()`, for
+        trajectory independent actors."""
+        assert self.trajectory_independent()
+        x = []
+        for att in self.attention:
+            x += att.forward_all(env)
+        ft = self._forward_all(env, x)
+        assert ft.dim() == 2 and ft.shape[1] == self.dim
+        return ft
+
+    def can_teacher_force(self):
+        if any((att.actor_dependent for att in self.attention)):
+            return False
+        return type(self)._teacher_force is not Actor._teacher_force
+
+    def begin_teacher_force(self):
+        self._forcing_inputs = []
+        self._forced = None
+
+    def record_teacher_force(self, env):
+        x = []
+        for att in self.attention:
+            x += att(env)
+        self._forcing_inputs.append(x)
+
+    def end_teacher_force(self, example, actions):
+        r"""Compute the outputs for every step recorded since
+        `begin_teacher_force`. They are then returned by `forward`, for
+        as long as an episode on `example` follows `actions`, until
+        `clear_teacher_force` (called by `new_example` and
+        `new_minibatch`)."""
+        inputs, self._forcing_inputs = self._forcing_inputs, None
+        if len(inputs) == 0:
+            return
+        outputs = self._teacher_force(inputs, [int(a) for a in actions[:len(inputs)]])
+        assert outputs.shape[0] == len(inputs) and outputs.shape[1] == self.dim
+        self._forced = (example, [int(a) for a in actions], outputs)
+
+    def clear_teacher_force(self):
+        self._forcing_inputs = None
+        self._forced = None
+        self._forced_on_path = False
+
+    def _forced_step(self, env, t):
+        # the forced output for step t if we're still on the forced
+        # path; when we leave it, restore the state reached so far
+        example, actions, outputs = self._forced
+        if t == 0:
+            self._forced_on_path = example is env.example
+        elif self._forced_on_path and int(env._trajectory[-1]) != actions[t-1]:
+            self._forced_on_path = False
+            self._restore(self._forced_state(t))
+        if not self._forced_on_path:
+            return None
+        if t == outputs.shape[0]:
+            self._forced_on_path = False
+            self._restore(self._forced_state(t))
+            return None
+        if profiler.enabled: profiler.hit('teacher forced steps')
+        return outputs[t:t+1]
+
+    def _reset_batch(self, batch_size):
+        pass
         
     def _forward(self, state, x):
         raise NotImplementedError('abstract')
+
+    def _forward_batch(self, states, x):
+        raise NotImplementedError('abstract')
         
     def hidden(self):
         raise NotImplementedError('abstract')
+
+    def step_features(self, t=None):
+        r"""Returns a view of the features computed at step `t` of the
+        current episode as a (1, dim) tensor or, if `t` is None, of all
+        steps so far as a (T, dim) tensor. These do not carry gradients
+        (use the return value of `forward` for that) and are overwritten
+        by the next episode, so `clone` them if they need to survive."""
+        if t is None:
+            return self._step_buffer[:self._n_steps]
+        assert 0 <= t and t < self._n_steps
+        return self._step_buffer[t:t+1]
+
+    def _store_step(self, t, ft):
+        if self._step_buffer is None or t >= self._step_buffer.shape[0]:
+            old = self._step_buffer
+            size = self.INITIAL_BUFFER_SIZE if old is None else old.shape[0]
+            while size <= t: size *= 2
+            self._step_buffer = ft.new(size, self.dim).zero_()
+            if profiler.enabled: profiler.alloc('actor step buffer')
+            if old is not None:
+                self._step_buffer[:old.shape[0]] = old
+        self._step_buffer[t] = ft[0]
+        self._n_steps = t+1
         
     def forward(self, env):
-        if self._features is None or self._T is None:
+        if self._T is None:
             self._T = env.horizon()
-            self._features = [None] * self._T
+            self._n_steps = 0
+            self._current = None
             self._last_t = 0
             
         t = env.timestep()
-        # we want to make sure that we "keep up" with the
-        # environment. so we'll store self._last_t, and if t >
-        # self._last_t+1 then bad news
-        #print(type(self), t, self._last_t)
-        if t > self._last_t+1:
-            import ipdb; ipdb.set_trace()
-        assert t <= self._last_t+1, '%d <= %d+1' % (t, self._last_t)
-        assert t >= self._last_t, '%d >= %d' % (t, self._last_t)
+        if DEBUG:
+            # we want to make sure that we "keep up" with the
+            # environment: t can only stay or advance by one
+            assert t <= self._last_t+1, '%d <= %d+1' % (t, self._last_t)
+            assert t >= self._last_t, '%d >= %d' % (t, self._last_t)
+            assert t >= 0, 'expect t>=0, bug?'
+            assert t < self._T, ('%d=t < T=%d' % (t, self._T))
         self._last_t = t
-        
-        assert self._features is not None
 
-        assert t >= 0, 'expect t>=0, bug?'
-        assert t < self._T, ('%d=t < T=%d' % (t, self._T))
-        assert t < len(self._features)
-        
-        if self._features[t] is not None:
-            return self._features[t]
+        # only the current step can be asked for twice
+        if t < self._n_steps:
+            if profiler.enabled: profiler.hit('actor steps')
+            return self._current
         
-        assert t == 0 or self._features[t-1] is not None
-
+        if DEBUG: assert t == self._n_steps
+
+        if self._forced is not None:
+            ft = self._forced_step(env, t)
+            if ft is not None:
+                self._store_step(t, ft.data)
+                self._current = ft
+                self._prefix_node = None  # the prefix cache sits this episode out
+                return ft
+
+        prof = profiler.enabled
+        cache = self._prefix_cache
+        if cache is not None:
+            node = None
+            if t == 0:
+                if cache.example is not env.example:
+                    cache.clear(env.example)
+                node = cache.root
+            elif self._prefix_node is not None:
+                node = self._prefix_node.child(int(env._trajectory[-1]))
+            self._prefix_node = node
+            cached = None if node is None else cache.get(node)
+            if cached is not None:
+                if prof: profiler.hit('actor prefixes')
+                ft, snapshot = cached
+                self._restore(snapshot)
+                self._store_step(t, ft.data)
+                self._current = ft
+                return ft
+            if prof and node is not None: profiler.miss('actor prefixes')
+
+        if prof:
+            profiler.miss('actor steps')
+            t0 = profiler.start()
         x = []
         for att in self.attention:
             x += att(env)
 
         ft = self._forward(env, x)
+        if DEBUG:
+            assert ft.dim() == 2
+            assert ft.shape[0] == 1
+            assert ft.shape[1] == self.dim
+        
+        self._store_step(t, ft.data)
+        self._current = ft
+        if cache is not None and self._prefix_node is not None:
+            cache.put(self._prefix_node, (ft, self._snapshot()))
+        if prof: profiler.stop('%s.forward' % type(self).__name__, t0)
+        return ft
+
+    def forward_batch(self, envs):
+        r"""Advance the actor by one step in each of `envs` simultaneously
+        (eg, when running several environments in lockstep or a beam) and
+        return a (len(envs), dim) tensor, row i being the features for
+        envs[i]. Recurrent state for the whole batch is kept in a single
+        tensor (see `_reset_batch`), so `envs` must be passed in the same
+        order at every step; changing the batch size starts a new
+        batch."""
+        B = len(envs)
+        if self._batch_size != B:
+            self._batch_size = B
+            self._reset_batch(B)
+
+        # gather attention outputs into one (B, att.dim) tensor per focus
+        x = []
+        for att in self.attention:
+            assert not att.actor_dependent, \
+                'forward_batch does not support actor-dependent attention (%s)' % type(att)
+            fts = [att(env) for env in envs]
+            for i in range(len(fts[0])):
+                x.append(torch.cat([ft[i] for ft in fts], 0))
+
+        ft = self._forward_batch(envs, x)
         assert ft.dim() == 2
-        assert ft.shape[0] == 1
+        assert ft.shape[0] == B
         assert ft.shape[1] == self.dim
-        
-        self._features[t] = ft
-        return self._features[t]
+        return ft
+
+class FeatureGraph(object):
+    r"""The feature computation of a policy, compiled once from its
+    module tree: every `DynamicFeatures`, `Attention` and `Actor`
+    module (each once, however often it is shared), in topological
+    order, so that a module comes after everything it is computed
+    from. `deps[id(m)]` lists the nodes `m` directly depends on.
+
+    Nodes fall into reset classes (see `Policy._reset_some`): `actors`
+    are reset before every run, and `dynamic_features` on every new
+    example. `static_features` are the ones that can be precomputed for
+    a whole minibatch (see `TrainLoop.setup_minibatching`).
+
+    Policies nested in the tree (eg, the policy inside a learner)
+    contribute their own cached graphs."""
+    NODE_TYPES = (DynamicFeatures, Attention, Actor)
+
+    def __init__(self, root):
+        self.nodes = []
+        self.deps = {}
+        seen = set()
+        for child in root.children():
+            self._visit(child, seen)
+        self.actors = [m for m in self.nodes if isinstance(m, Actor)]
+        self.dynamic_features = [m for m in self.nodes if isinstance(m, DynamicFeatures)]
+        self.static_features = [m for m in self.nodes if isinstance(m, StaticFeatures)]
+
+    def _visit(self, module, seen):
+        # returns the nodes module's computation directly depends on
+        # (itself, if it is a node)
+        if id(module) in seen:
+            return [module] if isinstance(module, FeatureGraph.NODE_TYPES) else []
+        seen.add(id(module))
+        if isinstance(module, Policy):
+            for m in module.feature_graph().nodes:
+                if id(m) not in seen:
+                    seen.add(id(m))
+                    self.nodes.append(m)
+                    self.deps[id(m)] = module.feature_graph().deps[id(m)]
+            return []
+        deps = []
+        for child in module.children():
+            deps += self._visit(child, seen)
+        if isinstance(module, FeatureGraph.NODE_TYPES):
+            self.nodes.append(module)
+            self.deps[id(module)] = deps
+            return [module]
+        return deps
 
 class Policy(nn.Module):
     r"""A `Policy` is any function that contains a `forward` function that
@@ -318,11 +844,23 @@ class Policy(nn.Module):
     def forward(self, state):
         raise NotImplementedError('abstract')
 
+    def forward_sequence(self, env):
+        # optional: for a TRAJECTORY_INDEPENDENT env, take the actions
+        # for all of env.states() at once and return the trajectory;
+        # raise NotImplementedError to run step by step instead
+        raise NotImplementedError('abstract')
+
+    def trajectory_independent(self):
+        # True if this policy's output at each state depends only on
+        # that state (see Actor.trajectory_independent)
+        return False
+
     """
     cases where we need to reset:
     - 0. new minibatch. this means reset EVERYTHING.
     - 1. new example in a minibatch. this means reset dynamic and static _features, but not _batched_features
-    - 2. replaying the current example. this means reset dynamic ONLY.
+    - 2. replaying the current example (Env.rewind, eg every LOLS
+         rollout). this means reset dynamic ONLY.
     flipped around:
     - Actors are reset in all cases
     - _features is reset in 0 and 1
@@ -333,32 +871,56 @@ class Policy(nn.Module):
     def new_example(self): self._reset_some(1, True)
     def new_run(self): self._reset_some(2, True)
     
+    def feature_graph(self):
+        r"""The (cached) `FeatureGraph` of this policy. Call
+        `invalidate_feature_graph` after adding or replacing feature
+        modules anywhere below this policy."""
+        graph = getattr(self, '_feature_graph', None)
+        if graph is None:
+            graph = FeatureGraph(self)
+            self._feature_graph = graph
+        return graph
+
+    def invalidate_feature_graph(self):
+        self._feature_graph = None
+        
     def _reset_some(self, reset_type, recurse):
-        #print('_reset_some', reset_type, recurse)
-        for module in self.modules():
-            #print('_reset_some', type(module), isinstance(module, Actor), isinstance(module, DynamicFeatures))
-            if isinstance(module, Actor): # always reset dynamic features
-                module.reset()
-            if isinstance(module, DynamicFeatures):
-                if reset_type == 0 or reset_type == 1:
-                    module._features = None
+        graph = self.feature_graph()
+        for actor in graph.actors: # always reset dynamic features
+            actor.reset()
+            if reset_type == 0 or reset_type == 1:
+                actor.clear_prefix_cache()
+                actor.clear_teacher_force()
+        if reset_type == 0 or reset_type == 1:
+            for module in graph.dynamic_features:
+                module._features = None
+                module._features_of = None
                 if reset_type == 0:
-                    #if module._batched_features is not None:
-                        #print('unset _batched_features ', module)
-                        #if isinstance(module, Policy):
-                        #    import ipdb; ipdb.set_trace()
                     module._batched_features = None
-            #elif module != self and isinstance(module, Policy) and recurse:
-            #    module._reset_some(reset_type, False)
 
 class StochasticPolicy(Policy):
     def stochastic(self, state):
         # returns a:int, p(a):Var(float)
         raise NotImplementedError('abstract')
 
+    def log_stochastic(self, state):
+        # returns a:int, log p(a):Var(float); override this when the
+        # log probability can be computed directly (see macarico.sampling)
+        a, p = self.stochastic(state)
+        return a, p.log()
+
     def sample(self, state):
         return self.stochastic(state)[0]
 
+    def stochastic_vector(self, venv):
+        # returns a:LongTensor(n_envs), p(a):Var(n_envs) for a VectorEnv
+        raise NotImplementedError('abstract')
+
+    def log_stochastic_vector(self, venv):
+        # returns a:LongTensor(n_envs), log p(a):Var(n_envs)
+        a, p = self.stochastic_vector(venv)
+        return a, p.log()
+
 class CostSensitivePolicy(Policy):
     OVERRIDE_UPDATE = False
     
@@ -370,16 +932,17 @@ class CostSensitivePolicy(Policy):
         # raturns Var([float]*n_actions)
         raise NotImplementedError('abstract')
 
+    def predict_costs_sequence(self, env):
+        # optional: the (T, n_actions) costs at every state of a
+        # TRAJECTORY_INDEPENDENT env, or NotImplementedError
+        raise NotImplementedError('abstract')
+
     def costs_to_action(self, state, pred_costs):
         # this is roughly a duplicate of util.argmin
         if isinstance(pred_costs, Var): pred_costs = pred_costs.data
         if state.actions is None or len(state.actions) == 0 or len(state.actions) == pred_costs.shape[0]:
-            return pred_costs.min(0)[1][0]
-        i = None
-        for a in state.actions:
-            if i is None or pred_costs[a] < pred_costs[i]:
-                i = a
-        return i
+            return pred_costs.min(0)[1].item()
+        return pred_costs.masked_fill(state.action_mask() == 0, float('inf')).min(0)[1].item()
 
     
     def update(self, state_or_pred_costs, truth, actions=None):
@@ -391,6 +954,41 @@ class CostSensitivePolicy(Policy):
 
     def _update(self, pred_costs, truth, actions=None):
         raise NotImplementedError('abstract')
+
+    def update_trajectory(self, pred_costs, truths, actions):
+        r"""Equivalent to summing `update(pred_costs[t], truths[t],
+        actions[t])` over a whole trajectory, but lets the policy stack
+        everything into (T, n_actions) tensors and compute the loss with
+        a handful of fused ops (see `_update_trajectory`) instead of
+        O(T * n_actions) little autograd nodes."""
+        assert len(pred_costs) == len(truths) == len(actions)
+        if len(pred_costs) == 0:
+            return 0.
+        try:
+            return self._update_trajectory(pred_costs, truths, actions)
+        except NotImplementedError:
+            return sum((self._update(p, y, a) for p, y, a in zip(pred_costs, truths, actions)))
+
+    def _update_trajectory(self, pred_costs, truths, actions):
+        raise NotImplementedError('abstract')
+
+    def update_batch(self, pred_costs, costs, mask=None):
+        r"""Like `update_trajectory` for a batch of unrelated states
+        whose truths are all cost vectors: `pred_costs` is a (B,
+        n_actions) Var, `costs` a (B, n_actions) tensor and `mask` an
+        optional (B, n_actions) action mask (see `Env.action_mask`)."""
+        if pred_costs.shape[0] == 0:
+            return 0.
+        try:
+            return self._update_batch(pred_costs, costs, mask)
+        except NotImplementedError:
+            B = pred_costs.shape[0]
+            return self.update_trajectory([pred_costs[b] for b in range(B)],
+                                          [costs[b] for b in range(B)],
+                                          [None if mask is None else mask[b] for b in range(B)])
+
+    def _update_batch(self, pred_costs, costs, mask):
+        raise NotImplementedError('abstract')
         
                 
 class Learner(Policy):
@@ -404,6 +1002,25 @@ class Learner(Policy):
     def get_objective(self, loss):
         raise NotImplementedError('abstract method not defined.')
 
+    def known_actions(self, env):
+        # the actions this learner will take in `env`, if they are
+        # determined in advance (eg, a roll-in that always follows the
+        # reference), else None; see macarico.util.teacher_force
+        return None
+
+    # learners that can be trained on a `VectorEnv` also provide:
+    def forward_vector(self, venv):
+        # returns one action per env as a LongTensor
+        raise NotImplementedError('abstract method not defined.')
+
+    def observe_vector(self, venv, costs, done):
+        # called with the result of `venv.step` after each forward_vector
+        raise NotImplementedError('abstract method not defined.')
+
+    def get_objective_vector(self, venv):
+        # objective over everything observed since the last call
+        raise NotImplementedError('abstract method not defined.')
+
 class NoopLearner(Learner):
     def __init__(self, policy):
         super().__init__()
@@ -471,6 +1088,12 @@ class Reference(object):
         # optional, but required by some learning algorithms (eg aggrevate)
         raise NotImplementedError('abstract')
 
+    def known_trajectory(self, example):
+        # optional: the actions this reference takes on `example` when
+        # it is followed from the start, if they can be read off the
+        # example (used for teacher forcing)
+        raise NotImplementedError('abstract')
+
 class Attention(nn.Module):
     r""" It is usually the case that the `Features` one wants to compute
     are a function of only some part of the input at any given time
@@ -495,15 +1118,19 @@ class Attention(nn.Module):
         check_intentional_override('Attention', '_forward', 'OVERRIDE_FORWARD', self, None)
 
     def forward(self, state):
+        prof = profiler.enabled
+        if prof: t0 = profiler.start()
         fts = self._forward(state)
-        dim_sum = 0
-        if self.arity is None: assert len(fts) == 1
-        if self.arity is not None: assert len(fts) == self.arity
-        for ft in fts:
-            assert ft.dim() == 2
-            assert ft.shape[0] == 1
-            dim_sum += ft.shape[1]
-        assert dim_sum == self.dim
+        if DEBUG:
+            dim_sum = 0
+            if self.arity is None: assert len(fts) == 1
+            if self.arity is not None: assert len(fts) == self.arity
+            for ft in fts:
+                assert ft.dim() == 2
+                assert ft.shape[0] == 1
+                dim_sum += ft.shape[1]
+            assert dim_sum == self.dim
+        if prof: profiler.stop('%s.forward' % type(self).__name__, t0)
         return fts
         
     def _forward(self, state):
@@ -511,6 +1138,19 @@ class Attention(nn.Module):
 
     def set_actor(self, actor):
         raise NotImplementedError('abstract')
+
+    def forward_all(self, env):
+        r"""Outputs at every state of `env.states()` as a list of `arity`
+        (T, dim) tensors. By default this runs `forward` on each state;
+        attention that is a simple lookup can gather them at once."""
+        fts = [self(state) for state in env.states()]
+        if len(fts) == 0:  # an empty episode
+            import macarico.util as util  # util imports this module
+            param = next(self.parameters(), None)
+            empty = torch.zeros(0, self.features.dim) if param is None else \
+                    util.zeros(param, 0, self.features.dim)
+            return [Var(empty) for _ in range(self.arity or 1)]
+        return [torch.cat([ft[i] for ft in fts], 0) for i in range(len(fts[0]))]
     
     def make_out_of_bounds(self):
         oob = Parameter(torch.Tensor(1, self.features.dim))
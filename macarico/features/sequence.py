@@ -261,6 +261,17 @@ class AttendAt(macarico.Attention):
         if n >= x.shape[1]: return [self.oob]
         return [x[0,n].unsqueeze(0)]
 
+    def forward_all(self, env):
+        # one gather for all positions; row N of the table is oob
+        positions = [self.position(state) for state in env.states()]
+        if len(positions) == 0:
+            return macarico.Attention.forward_all(self, env)
+        x = self.features(env)
+        N = x.shape[1]
+        idx = [n if 0 <= n < N else N for n in positions]
+        table = torch.cat([x[0], self.oob], 0)
+        return [table.index_select(0, Varng(util.longtensor(self.oob, idx)))]
+
     
 class FrontBackAttention(macarico.Attention):
     """
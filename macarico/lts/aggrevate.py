@@ -16,10 +16,19 @@ class AggreVaTe(macarico.Learner):
         self.rollin_ref = stochastic(p_rollin_ref)
         self.policy = policy
         self.reference = reference
-        self.objective = 0.0
+        # (pred_costs, truth, actions) per timestep, for update_trajectory
+        self.pred_costs, self.truths, self.actions = [], [], []
 
     def forward(self, state):
-        pred_costs = self.policy.predict_costs(state)
+        return self._step(state, self.policy.predict_costs(state))
+
+    def forward_sequence(self, env):
+        pred_costs = self.policy.predict_costs_sequence(env)
+        for t, state in enumerate(env.states()):
+            state._trajectory.append(self._step(state, pred_costs[t]))
+        return env._trajectory
+
+    def _step(self, state, pred_costs):
         costs = torch.zeros(self.policy.n_actions)
         try:
             costs.zero_()
@@ -28,15 +37,17 @@ class AggreVaTe(macarico.Learner):
             raise ValueError('can only run aggrevate on reference losses that define min_cost_to_go; try lols with rollout=ref instead')
 
         costs -= costs.min()
-        self.objective += self.policy.update(pred_costs, costs, state.actions)
+        self.pred_costs.append(pred_costs)
+        self.truths.append(costs)
+        self.actions.append(state.actions)
         
-        return break_ties_by_policy(self.reference, self.policy, state, False) \
+        return break_ties_by_policy(self.reference, self.policy, state, False, pred_costs, costs) \
                if self.rollin_ref() else \
                self.policy.costs_to_action(state, pred_costs)
 
     def get_objective(self, _):
-        ret = self.objective
-        self.objective = 0.0
+        ret = self.policy.update_trajectory(self.pred_costs, self.truths, self.actions)
+        self.pred_costs, self.truths, self.actions = [], [], []
         self.rollin_ref.step()
         return ret
         
@@ -8,14 +8,32 @@ class BehavioralCloning(macarico.Learner):
         assert isinstance(policy, macarico.CostSensitivePolicy)
         self.policy = policy
         self.reference = reference
-        self.objective = 0.0
+        # (pred_costs, truth, actions) per timestep, for update_trajectory
+        self.pred_costs, self.truths, self.actions = [], [], []
 
     def forward(self, state):
+        return self._step(state, self.policy.predict_costs(state))
+
+    def forward_sequence(self, env):
+        pred_costs = self.policy.predict_costs_sequence(env)
+        for t, state in enumerate(env.states()):
+            state._trajectory.append(self._step(state, pred_costs[t]))
+        return env._trajectory
+
+    def _step(self, state, pred_costs):
         ref = self.reference(state)
-        self.objective += self.policy.update(state, ref)
+        self.pred_costs.append(pred_costs)
+        self.truths.append(ref)
+        self.actions.append(state.actions)
         return ref
 
+    def known_actions(self, env):
+        try:
+            return self.reference.known_trajectory(env.example)
+        except NotImplementedError:
+            return None
+
     def get_objective(self, _):
-        ret = self.objective
-        self.objective = 0.0
+        ret = self.policy.update_trajectory(self.pred_costs, self.truths, self.actions)
+        self.pred_costs, self.truths, self.actions = [], [], []
         return ret
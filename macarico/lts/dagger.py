@@ -4,42 +4,108 @@ import numpy as np
 import torch
 import macarico
 from macarico.annealing import stochastic, NoAnnealing
-from macarico.util import break_ties_by_policy, argmin
+from macarico.util import break_ties_by_policy, argmin, Varng, trains_features
 
 class DAgger(macarico.Learner):
-    def __init__(self, policy, reference, p_rollin_ref=NoAnnealing(0)):
+    r"""By default this is online DAgger: each episode's states are
+    used for one update and discarded. Given an `AggregateDataset`
+    (see `macarico.lts.replay`), it instead aggregates: every visited
+    state is stored with its reference cost vector, `get_objective`
+    returns 0, and `retrain` fits the policy's final layer to the whole
+    aggregate between rounds. The stored states are the (detached)
+    inputs of that layer, so aggregation requires `policy.features` to
+    have no trainable parameters."""
+    def __init__(self, policy, reference, p_rollin_ref=NoAnnealing(0), dataset=None):
         macarico.Learner.__init__(self)
+        assert dataset is None or not trains_features(policy), \
+            'aggregate DAgger stores fixed features, so policy.features must not be trainable'
         self.rollin_ref = stochastic(p_rollin_ref)
         self.policy = policy
         self.reference = reference
-        self.objective = 0.0
+        self.dataset = dataset
+        # (pred_costs, truth, actions) per timestep, for update_trajectory
+        self.pred_costs, self.truths, self.actions = [], [], []
 
     def forward(self, state):
-        ref = break_ties_by_policy(self.reference, self.policy, state, False)
-        pol = self.policy(state)
-        self.objective += self.policy.update(state, ref)
+        return self._step(state, self.policy.predict_costs(state))
+
+    def forward_sequence(self, env):
+        # trajectory independent policies predict every state's costs
+        # at once (see Policy.forward_sequence)
+        pred_costs = self.policy.predict_costs_sequence(env)
+        for t, state in enumerate(env.states()):
+            state._trajectory.append(self._step(state, pred_costs[t]))
+        return env._trajectory
+
+    def _step(self, state, pred_costs):
+        # one cost prediction per state, for tie-breaking, acting and
+        # the update
+        ref = break_ties_by_policy(self.reference, self.policy, state, False, pred_costs)
+        pol = self.policy.costs_to_action(state, pred_costs)
+        if self.dataset is not None:
+            self.aggregate(state, ref)
+        else:
+            self.pred_costs.append(pred_costs)
+            self.truths.append(ref)
+            self.actions.append(state.actions)
         return ref if self.rollin_ref() else pol
 
+    def known_actions(self, env):
+        # a roll-in that always follows the reference is known in
+        # advance (up to tie-breaking, which teacher forcing checks)
+        if not self.rollin_ref.always():
+            return None
+        try:
+            return self.reference.known_trajectory(env.example)
+        except NotImplementedError:
+            return None
+
+    def aggregate(self, state, ref):
+        costs = torch.zeros(self.policy.n_actions)
+        try:
+            self.reference.set_min_costs_to_go(state, costs)
+        except NotImplementedError:
+            costs.fill_(1)
+            costs[ref] = 0
+        self.dataset.append(self.policy.features(state).data, costs, state.action_mask())
+
     def get_objective(self, _):
-        ret = self.objective
-        self.objective = 0.0
+        ret = self.policy.update_trajectory(self.pred_costs, self.truths, self.actions)
+        self.pred_costs, self.truths, self.actions = [], [], []
         self.rollin_ref.step()
         return ret
 
+    def retrain(self, optimizer, n_epochs=1, minibatch_size=256):
+        r"""Fit `policy.mapping` to the aggregate dataset with
+        `n_epochs` passes of shuffled minibatches; returns the average
+        loss per state of the last pass."""
+        assert self.dataset is not None, 'retrain requires an aggregate dataset'
+        mapping = self.policy.mapping
+        for _ in range(n_epochs):
+            total = 0.
+            for features, costs, masks in self.dataset.minibatches(mapping.weight, minibatch_size):
+                optimizer.zero_grad()
+                obj = self.policy.update_batch(mapping(Varng(features)), costs, masks)
+                obj.backward()
+                optimizer.step()
+                total += obj.item()
+        return total / max(1, len(self.dataset))
+
 
 class Coaching(DAgger):
     def __init__(self, policy, reference, policy_coeff=0., p_rollin_ref=NoAnnealing(0)):
         DAgger.__init__(self, policy, reference, p_rollin_ref)
         self.policy_coeff = policy_coeff
 
-    def forward(self, state):
+    def _step(self, state, pred_costs):
         costs = torch.zeros(self.policy.n_actions)
         self.reference.set_min_costs_to_go(state, costs)
-        pred_costs = self.policy.predict_costs(state)
         costs += self.policy_coeff * pred_costs.data
-        ref = argmin(costs, state.actions)
-        pol = self.policy(state)
-        self.objective += self.policy.update(pred_costs, ref, state.actions)
+        ref = argmin(costs, state.action_mask())
+        pol = self.policy.costs_to_action(state, pred_costs)
+        self.pred_costs.append(pred_costs)
+        self.truths.append(ref)
+        self.actions.append(state.actions)
         return ref if self.rollin_ref() else pol
 
 
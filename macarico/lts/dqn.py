@@ -0,0 +1,96 @@
+from __future__ import division, generators, print_function
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import macarico
+import macarico.util as util
+from macarico.util import Var, Varng
+from macarico.annealing import stochastic, NoAnnealing
+from macarico.policies.linear import CSOAAPolicy
+from macarico.lts.replay import ReplayBuffer
+
+class DQN(macarico.Learner):
+    r"""Off-policy cost-to-go learning (deep Q-learning, Mnih et al.,
+    2015) for a `CSOAAPolicy`, whose predicted costs are read as
+    Q-values.
+
+    Acts epsilon-greedily (with probability `p_explore` a uniformly
+    random allowed action) and stores every transition in a
+    `ReplayBuffer`. The cost of each step is zero except for the last,
+    which is the episode loss. After each episode, once the buffer
+    holds `min_replay_size` transitions, `get_objective` returns the
+    Huber TD loss of a sampled minibatch against targets
+
+        cost + gamma * min_{a' allowed} Q_target(s', a')
+
+    where Q_target is a copy of `policy.mapping` refreshed every
+    `target_update_every` episodes.
+
+    Transitions store the features fed to `policy.mapping`, so only
+    that layer is trained.
+    """
+    def __init__(self,
+                 policy,
+                 replay=None,
+                 p_explore=NoAnnealing(0.1),
+                 gamma=1.0,
+                 minibatch_size=32,
+                 min_replay_size=100,
+                 target_update_every=100,
+                 capacity=10000,
+                 prioritized=False,
+                ):
+        macarico.Learner.__init__(self)
+        assert isinstance(policy, CSOAAPolicy), 'DQN requires a CSOAAPolicy'
+        self.policy = policy
+        self.replay = replay if replay is not None else ReplayBuffer(capacity, prioritized)
+        self.explore = stochastic(p_explore)
+        self.gamma = gamma
+        self.minibatch_size = minibatch_size
+        self.min_replay_size = min_replay_size
+        self.target_update_every = target_update_every
+        self.n_episodes = 0
+        self.target_weight, self.target_bias = None, None
+        self._prev = None # (features, mask, action) awaiting its next state
+
+    def update_target(self):
+        self.target_weight = self.policy.mapping.weight.data.clone()
+        self.target_bias = self.policy.mapping.bias.data.clone()
+
+    def forward(self, state):
+        fts = self.policy.features(state).data.view(-1)
+        mask = state.action_mask()
+        if self._prev is not None:
+            self.replay.add(*self._prev, cost=0., next_features=fts, next_mask=mask, done=False)
+        if self.explore():
+            a = np.random.choice(list(range(self.policy.n_actions) if state.actions is None else state.actions))
+        else:
+            q = self.policy.mapping(Varng(fts.view(1, -1))).data.view(-1)
+            a = util.argmin(q, mask)
+        self._prev = (fts, mask, a)
+        return a
+
+    def get_objective(self, loss):
+        if self._prev is not None:
+            self.replay.add(*self._prev, cost=float(loss), done=True)
+            self._prev = None
+        self.explore.step()
+        if self.target_weight is None or self.n_episodes % self.target_update_every == 0:
+            self.update_target()
+        self.n_episodes += 1
+        if len(self.replay) < max(1, self.min_replay_size):
+            return 0.
+
+        batch = self.replay.sample(self.minibatch_size)
+        q = self.policy.mapping(Varng(batch.features))
+        q = q.gather(1, batch.actions.view(-1, 1)).view(-1)
+        next_q = F.linear(batch.next_features, self.target_weight, self.target_bias)
+        next_q = util.masked_fill_disallowed(next_q, batch.next_masks, 1e10).min(1)[0]
+        target = batch.costs + self.gamma * (1 - batch.done.type_as(batch.costs)) * next_q
+        if self.replay.prioritized:
+            self.replay.update_priorities(batch.idx, q.data - target)
+        td = F.smooth_l1_loss(q, Varng(target), reduce=False)
+        if batch.weights is not None:
+            td = td * Varng(batch.weights)
+        return td.sum()
@@ -1,18 +1,35 @@
 from __future__ import division, generators, print_function
 
 import sys
+import math
 import numpy as np
 import macarico
 import macarico.util
+import macarico.sampling as sampling
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from macarico.annealing import Averaging, NoAnnealing, stochastic
 import macarico.policies.costeval
+import macarico.policies.active
 from torch.autograd import Variable as Var
 
 class LOLS(macarico.LearningAlg):
+    r"""LOLS (Chang et al., 2015). With `active=True`, `policy` must be a
+    `CSActive` (whose optimizer has been set): at each timestep of the
+    backbone only the actions it flags for querying (those whose cost
+    range could change the argmin) are rolled out and updated on, and
+    the others keep their predicted costs. Costs are then not shifted
+    to a minimum of zero, so that they stay on the scale of
+    `CSActive`'s `min_cost` and `max_cost`. `n_rollouts` and
+    `n_skipped` count the (t, a) rollouts run and skipped.
+
+    All the rollouts from timestep t share the prefix traj0[:t], so
+    if `prefix_cache_size` is given and the env is `DETERMINISTIC`, the
+    policy's actors cache their state for up to that many prefixes
+    while LOLS runs on an example (see `Actor.enable_prefix_cache`) and
+    each rollout only computes its last T-t steps."""
     MIX_PER_STATE, MIX_PER_ROLL = 0, 1
 
     def __init__(self,
@@ -22,8 +39,12 @@ class LOLS(macarico.LearningAlg):
                  p_rollin_ref=NoAnnealing(0),
                  p_rollout_ref=NoAnnealing(0.5),
                  mixture=MIX_PER_ROLL,
+                 active=False,
+                 prefix_cache_size=None,
                 ):
         macarico.LearningAlg.__init__(self)
+        assert not active or isinstance(policy, macarico.policies.active.CSActive), \
+            'active LOLS requires a CSActive policy'
         self.policy = policy
         self.reference = reference
         self.loss_fn = loss_fn()
@@ -33,28 +54,46 @@ class LOLS(macarico.LearningAlg):
         self.rollout = None
         self.true_costs = torch.zeros(self.policy.n_actions)
         self.warned_rollout_ref = False
+        self.active = active
+        self.n_rollouts = 0
+        self.n_skipped = 0
+        self.prefix_cache_size = prefix_cache_size
 
     def __call__(self, env):
+        # the cache is only turned on for the duration of the call, so
+        # other learners sharing the policy never see it
+        actors = []
+        if self.prefix_cache_size is not None and env.DETERMINISTIC:
+            actors = [actor for actor in self.policy.feature_graph().actors
+                      if actor.enable_prefix_cache(self.prefix_cache_size)]
+        try:
+            return self._call(env)
+        finally:
+            for actor in actors:
+                actor.disable_prefix_cache()
+
+    def _call(self, env):
         self.example = env.example
         self.env = env
         n_actions = self.env.n_actions
 
         # compute training loss
-        loss0, _, _, _, _ = self.run(lambda _: EpisodeRunner.LEARN, True, False)
+        loss0 = self.run(lambda _: EpisodeRunner.LEARN, False, keep_features=False)[0]
         
         # generate backbone using rollin policy
-        _, traj0, limit0, costs0, ref_costs0 = self.run(lambda _:
-                                                        EpisodeRunner.REF \
-                                                        if self.rollin_ref() else \
-                                                        EpisodeRunner.LEARN,
-                                                        True, True)
+        _, traj0, limit0, costs0, ref_costs0, ranges0 = self.run(lambda _:
+                                                                 EpisodeRunner.REF \
+                                                                 if self.rollin_ref() else \
+                                                                 EpisodeRunner.LEARN,
+                                                                 True, self.active)
         T = len(traj0)
 
         # run all one step deviations
-        objective = 0.
+        update_costs, truths, update_actions = [], [], []
         follow_traj0 = lambda t: (EpisodeRunner.ACT, traj0[t])
         for t, pred_costs in enumerate(costs0):
             true_costs = None
+            query = limit0[t]
             if self.mixture == LOLS.MIX_PER_ROLL and self.rollout_ref():
                 if ref_costs0[t] is None:
                     if not self.warned_rollout_ref:
@@ -67,13 +106,28 @@ class LOLS(macarico.LearningAlg):
             if true_costs is None:
                 # must actually run the rollout
                 true_costs = self.true_costs.zero_()
+                if self.active:
+                    # only roll out actions whose cost range could
+                    # change the argmin; the rest keep their predictions
+                    _, to_query, _, _ = ranges0[t]
+                    true_costs += pred_costs.data
+                    query = [a for a in limit0[t] if to_query[a]]
+                    self.n_skipped += len(limit0[t]) - len(query)
                 rollout = TiedRandomness(self.make_rollout())
-                for a in limit0[t]:
-                    l, _, _, _, _ = self.run(one_step_deviation(T, follow_traj0, rollout, t, a), False, False)
+                for a in query:
+                    l = self.run(one_step_deviation(T, follow_traj0, rollout, t, a), False)[0]
                     true_costs[a] = float(l)
+                self.n_rollouts += len(query)
 
-            true_costs -= true_costs.min()
-            objective += self.policy.update(pred_costs, true_costs, limit0[t])
+            if len(query) == 0:
+                continue
+            if not self.active:
+                true_costs -= true_costs.min()
+            update_costs.append(pred_costs)
+            truths.append(true_costs.clone())
+            update_actions.append(query)
+
+        objective = self.policy.update_trajectory(update_costs, truths, update_actions)
 
         # run backprop
         self.rollin_ref.step()
@@ -81,13 +135,17 @@ class LOLS(macarico.LearningAlg):
 
         return objective
             
-    def run(self, run_strategy, reset_all, store_ref_costs):
-        runner = EpisodeRunner(self.policy, run_strategy, self.reference, store_ref_costs)
-        if reset_all:
-            self.policy.new_example()
-        self.env.run_episode(runner)
+    def run(self, run_strategy, store_ref_costs, store_ranges=False, keep_features=True):
+        # every run is over self.example with the same parameters, so
+        # after the first run static features (eg, a biLSTM over the
+        # input) are shared by the backbone and all rollouts
+        runner = EpisodeRunner(self.policy, run_strategy, self.reference, store_ref_costs, store_ranges)
+        self.env.run_episode(runner, keep_features)
         cost = self.loss_fn.evaluate(self.example)
-        return cost, runner.trajectory, runner.limited_actions, runner.costs, runner.ref_costs
+        return cost, runner.trajectory, runner.limited_actions, runner.costs, runner.ref_costs, runner.ranges
+
+    def query_rate(self):
+        return self.n_rollouts / max(1, self.n_rollouts + self.n_skipped)
 
     def make_rollout(self):
         mk = lambda _: (EpisodeRunner.REF if self.rollout_ref() else EpisodeRunner.LEARN)
@@ -135,7 +193,6 @@ class BanditLOLS(macarico.Learner):
         self.dev_costs = None
         self.rollout = None
         self.t = None
-        self.disallow = torch.zeros(self.policy.n_actions)
         self.truth = torch.zeros(self.policy.n_actions)
 
     def forward(self, state):
@@ -151,7 +208,7 @@ class BanditLOLS(macarico.Learner):
             if self.explore():
                 self.dev_costs = self.policy.predict_costs(state)
                 self.dev_actions = list(state.actions)[:]
-                self.dev_a, self.dev_imp_weight = self.do_exploration(self.dev_costs, self.dev_actions)
+                self.dev_a, self.dev_imp_weight = self.do_exploration(self.dev_costs, self.dev_actions, state.action_mask())
                 a = self.dev_a if isinstance(self.dev_a, int) else self.dev_a.data[0,0]
 
         elif self.t < self.dev_t:
@@ -165,31 +222,30 @@ class BanditLOLS(macarico.Learner):
         self.t += 1
         return a
 
-    def do_exploration(self, costs, dev_actions):
+    def do_exploration(self, costs, dev_actions, mask=None):
         # returns action and importance weight
         if self.exploration == BanditLOLS.EXPLORE_UNIFORM:
             return np.random.choice(list(dev_actions)), len(dev_actions)
         if self.exploration in [BanditLOLS.EXPLORE_BOLTZMANN, BanditLOLS.EXPLORE_BOLTZMANN_BIASED]:
-            if len(dev_actions) != self.policy.n_actions:
-                self.disallow.zero_()
-                for i in range(self.policy.n_actions):
-                    if i not in dev_actions:
-                        self.disallow[i] = 1e10
-                costs += Var(self.disallow, requires_grad=False)
-            probs = F.softmax(- costs, dim=0)
-            a, p = macarico.util.sample_from_probs(probs)
-            p = p.data[0]
+            if len(dev_actions) == self.policy.n_actions:
+                mask = None
+            elif mask is None:
+                mask = macarico.util.actions_to_mask(costs, [dev_actions], self.policy.n_actions)[0]
+            costs = costs.data() if isinstance(costs, macarico.policies.bootstrap.BootstrapCost) else \
+                    costs.data
+            a, log_p, _ = sampling.sample_costs(costs, mask)
+            p = math.exp(log_p.item())
             if self.exploration == BanditLOLS.EXPLORE_BOLTZMANN_BIASED:
                 p = max(p, 1e-4)
-            return a, 1 / p
+            return a.item(), 1 / p
         if self.exploration == BanditLOLS.EXPLORE_BOOTSTRAP:
             assert isinstance(self.policy,
                               macarico.policies.bootstrap.BootstrapPolicy) or \
                    isinstance(self.policy,
                               macarico.policies.costeval.CostEvalPolicy)
             probs = costs.get_probs(dev_actions)
-            a, p = util.sample_from_np_probs(probs)
-            return a, 1 / p
+            a, p = sampling.sample(probs)
+            return a.item(), 1 / p.item()
         assert False, 'unknown exploration strategy'
 
 
@@ -239,11 +295,12 @@ class BanditLOLS(macarico.Learner):
 class EpisodeRunner(macarico.Learner):
     REF, LEARN, ACT = 0, 1, 2
 
-    def __init__(self, policy, run_strategy, reference=None, store_ref_costs=False):
+    def __init__(self, policy, run_strategy, reference=None, store_ref_costs=False, store_ranges=False):
         macarico.Learner.__init__(self)
         self.policy = policy
         self.run_strategy = run_strategy
         self.store_ref_costs = store_ref_costs
+        self.store_ranges = store_ranges
         self.reference = reference
         self.t = 0
         self.total_loss = 0.
@@ -251,6 +308,7 @@ class EpisodeRunner(macarico.Learner):
         self.limited_actions = []
         self.costs = []
         self.ref_costs = []
+        self.ranges = []
 
     def __call__(self, state):
         a_type = self.run_strategy(self.t)
@@ -279,6 +337,8 @@ class EpisodeRunner(macarico.Learner):
         self.trajectory.append(a)
         cost = self.policy.predict_costs(state) if self.policy is not None else None
         self.costs.append(cost)
+        if self.store_ranges:
+            self.ranges.append(self.policy.cost_ranges(state, cost))
         self.t += 1
 
         return a
@@ -1,45 +1,237 @@
-import macarico
+from __future__ import division, generators, print_function
+import copy
+import random
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable as Var
 
+import macarico
+import macarico.util as util
+import macarico.sampling as sampling
+from macarico.util import Var, Varng, trains_features
+from macarico.annealing import EWMA
+from macarico.policies.linear import SoftmaxPolicy
+
+def rng_state():
+    return random.getstate(), np.random.get_state(), torch.get_rng_state()
+
+def set_rng_state(state):
+    random.setstate(state[0])
+    np.random.set_state(state[1])
+    torch.set_rng_state(state[2])
+
+class RolloutBuffer(object):
+    r"""Per-step records of the episodes collected since the last
+    update: what the policy needs to recompute the step (either the
+    detached input features of its final layer, or the random number
+    generators' state after the step), action masks, the actions
+    taken, their log probabilities under the policy that took them,
+    and their advantages. For replay, every episode also keeps the
+    start it was run from (see `PPO._replay`)."""
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.features, self.rng_states, self.masks, self.actions, self.old_log_p = [], [], [], [], []
+        self.advantages = []
+        self.episodes = []  # (start, end) step ranges
+        self.starts = []    # per episode, None or (env copy, rng state)
+        self._episode_start = 0
+
+    def __len__(self):
+        return len(self.actions)
+
+    def append(self, features, rng, mask, action, log_p):
+        if features is not None: self.features.append(features)
+        if rng is not None: self.rng_states.append(rng)
+        self.masks.append(mask)
+        self.actions.append(action)
+        self.old_log_p.append(log_p)
+
+    def end_episode(self, advantage, start=None):
+        "assign `advantage` to every step since the previous end_episode"
+        self.advantages += [advantage] * (len(self.actions) - self._episode_start)
+        self.episodes.append((self._episode_start, len(self.actions)))
+        self.starts.append(start)
+        self._episode_start = len(self.actions)
+
+    def tensors(self, param):
+        return (torch.cat(self.features, 0) if len(self.features) > 0 else None,
+                torch.stack(self.masks),
+                util.longtensor(param, self.actions),
+                util.getnew(param)(self.old_log_p),
+                util.getnew(param)(self.advantages))
 
 class PPO(macarico.Learner):
-    "Proximal Policy Optimization"
-    def __init__(self, policy, baseline, epsilon, temperature=1.0, only_one_deviation=False):
-        super(PPO, self).__init__()
+    r"""Proximal Policy Optimization (Schulman et al., 2017) with the
+    clipped surrogate objective.
+
+    Steps of `episodes_per_update` episodes are collected into a
+    rollout buffer; then the clipped surrogate is minimized for
+    `n_epochs` passes over the buffer in random minibatches of (about)
+    `minibatch_size` steps, each followed by an `optimizer` step. The
+    advantage of every step is the episode loss minus `baseline`.
+
+    Because PPO takes its own optimizer steps, `get_objective` returns
+    a float and `TrainLoop` does not call backward.
+
+    If `policy.features` has no trainable parameters (eg, an actor over
+    fixed task features), the buffer stores the features fed to the
+    policy's final layer and minibatches are random steps. Otherwise
+    it stores one copy of the env per episode, together with the
+    random number generators' state before the env was rewound and
+    after every step, and every minibatch of whole episodes is
+    replayed through the full policy (actor, attention and features
+    included), so that all of it is trained. Replay assumes that the
+    env's randomness comes from `random`, `numpy.random` or `torch`.
+    """
+    def __init__(self,
+                 policy,
+                 optimizer,
+                 epsilon=0.2,
+                 baseline=EWMA(0.8),
+                 n_epochs=4,
+                 minibatch_size=64,
+                 episodes_per_update=8,
+                 normalize_advantages=True,
+                ):
+        macarico.Learner.__init__(self)
+        assert isinstance(policy, SoftmaxPolicy), 'PPO requires a SoftmaxPolicy'
         self.policy = policy
-        self.baseline = baseline
+        self.optimizer = optimizer
         self.epsilon = epsilon
-        self.temperature = temperature
-        self.trajectory = []
-        self.only_one_deviation = only_one_deviation
-
-    def update(self, loss):
-        if len(self.trajectory) > 0:
-            b = self.baseline()
-            total_loss = 0
-            dev_t = np.random.choice(range(len(self.trajectory)))
-            for t, (a, p_a) in enumerate(self.trajectory):
-                if self.only_one_deviation and t != dev_t:
-                    continue
-                p_a_value = p_a.data
-                ratio = p_a * (1/p_a_value[0])
-                ratio_by_adv = (b - loss) * ratio
-                lower_bound = dy.constant(1, 1 - self.epsilon)
-                clipped_ratio = dy.bmax(ratio, lower_bound)
-                upper_bound = dy.constant(1, 1 + self.epsilon)
-                clipped_ratio = dy.bmin(clipped_ratio, upper_bound)
-                clipped_ratio_by_adv = (b - loss) * clipped_ratio
-                increment = dy.bmin(ratio_by_adv, clipped_ratio_by_adv)
-                total_loss -=  increment
+        self.baseline = baseline
+        self.n_epochs = n_epochs
+        self.minibatch_size = minibatch_size
+        self.episodes_per_update = episodes_per_update
+        self.normalize_advantages = normalize_advantages
+        self.replay = trains_features(policy)
+        self.buffer = RolloutBuffer()
+        self._run_rng = None  # rng state when the current episode was rewound
+        self._start = None    # where the current episode can be replayed from
+
+    def _log_probs(self, features, mask):
+        return sampling.log_probs(self.policy.mapping(features), mask, self.policy.temperature)
+
+    def new_run(self):
+        # Env.rewind calls this just before _rewind
+        if self.replay:
+            self._run_rng = rng_state()
+        macarico.Learner.new_run(self)
+
+    def _copy_env(self, env):
+        # the policy running the episode isn't copied; the example is,
+        # since replaying the episode writes to it
+        memo = {}
+        if env._policy is not None:
+            memo[id(env._policy)] = env._policy
+        return copy.deepcopy(env, memo)
+
+    def forward(self, state):
+        fts = Varng(self.policy.features(state).data)
+        log_p = self._log_probs(fts, state.action_mask().view(1, -1)).data.view(-1)
+        a, log_p_a = sampling.sample_log_probs(log_p)
+        a = a.item()
+        if self.replay:
+            if len(self.buffer) == self.buffer._episode_start:  # first step
+                assert self._run_rng is not None, 'PPO replay needs episodes started by Env.rewind'
+                self._start = (self._copy_env(state), self._run_rng)
+            self.buffer.append(None, rng_state(), state.action_mask(), a, log_p_a.item())
+        else:
+            self.buffer.append(fts.data, None, state.action_mask(), a, log_p_a.item())
+        return a
+
+    def get_objective(self, loss):
+        loss = float(loss)
+        b = 0 if self.baseline is None else self.baseline()
+        self.buffer.end_episode(loss - b, self._start)
+        self._start, self._run_rng = None, None
+        if self.baseline is not None:
             self.baseline.update(loss)
-            if not isinstance(total_loss, float):
-                total_loss.forward()
-                total_loss.backward()
-
-    def __call__(self, state):
-        action, p_action = self.policy.stochastic_with_probability(state, temperature=self.temperature)
-        self.trajectory.append((action, p_action))
-        return action
+        if len(self.buffer.episodes) < self.episodes_per_update:
+            return 0.
+        objective = self.update()
+        self.buffer.clear()
+        return objective
+
+    def _replay(self, i, masks):
+        # (T, n_actions) log probabilities of stored episode i under the
+        # current parameters: rewind a copy of its env with the same
+        # randomness, and act out the stored actions, putting the
+        # randomness back after each one to where it was in the episode
+        start, end = self.buffer.episodes[i]
+        env, run_rng = self.buffer.starts[i]
+        env = self._copy_env(env)
+        fts = []
+        def act(state):
+            t = start + len(fts)
+            assert t < end, 'replayed episode ran longer than the stored one'
+            fts.append(self.policy.features(state))
+            set_rng_state(self.buffer.rng_states[t])
+            return self.buffer.actions[t]
+        saved = rng_state()
+        try:
+            self.policy.new_example()
+            set_rng_state(run_rng)
+            env.rewind(self.policy)
+            env._policy = act
+            env._run_episode(env._act)
+        finally:
+            set_rng_state(saved)
+        assert len(fts) == end - start, 'replayed episode ended early'
+        return self._log_probs(torch.cat(fts, 0), masks[start:end])
+
+    def _minibatches(self, N):
+        # LongTensors of step indices, and for replay the indices of
+        # the episodes they come from
+        param = self.policy.mapping.weight
+        if not self.replay:
+            order = util.longtensor(param, np.random.permutation(N).tolist())
+            for start in range(0, N, self.minibatch_size):
+                yield order[start:start+self.minibatch_size], None
+            return
+        episodes = self.buffer.episodes
+        steps = lambda batch: [t for i in batch for t in range(*episodes[i])]
+        batch, n = [], 0
+        for i in np.random.permutation(len(episodes)):
+            s, e = episodes[i]
+            if e == s: continue
+            batch.append(i)
+            n += e - s
+            if n >= self.minibatch_size:
+                yield util.longtensor(param, steps(batch)), batch
+                batch, n = [], 0
+        if len(batch) > 0:
+            yield util.longtensor(param, steps(batch)), batch
+
+    def update(self):
+        "run the clipped-surrogate epochs over the buffer; returns the mean objective"
+        if len(self.buffer) == 0: return 0.
+        features, masks, actions, old_log_p, advantages = self.buffer.tensors(self.policy.mapping.weight)
+        if self.normalize_advantages and len(self.buffer) > 1:
+            advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
+        N = len(self.buffer)
+        total, count = 0., 0
+        for _ in range(self.n_epochs):
+            for idx, episodes in self._minibatches(N):
+                if episodes is None:
+                    log_p = self._log_probs(Varng(features.index_select(0, idx)),
+                                            masks.index_select(0, idx))
+                else:
+                    log_p = torch.cat([self._replay(i, masks) for i in episodes], 0)
+                log_p = log_p.gather(1, actions.index_select(0, idx).view(-1, 1)).view(-1)
+                ratio = (log_p - Varng(old_log_p.index_select(0, idx))).exp()
+                # advantages are costs, so the pessimistic (clipped) bound is the max
+                adv = Varng(advantages.index_select(0, idx))
+                surrogate = torch.max(ratio * adv,
+                                      ratio.clamp(1 - self.epsilon, 1 + self.epsilon) * adv)
+                objective = surrogate.mean()
+                self.optimizer.zero_grad()
+                objective.backward()
+                self.optimizer.step()
+                total += objective.item()
+                count += 1
+        if self.replay:
+            self.policy.new_example()  # drop features computed during replay
+        return total / max(1, count)
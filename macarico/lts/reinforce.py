@@ -7,6 +7,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from macarico.annealing import EWMA, stochastic
+import macarico.util as util
 from macarico.util import Var, Varng
 
 import macarico
@@ -20,13 +21,14 @@ class Reinforce(macarico.Learner):
         assert isinstance(policy, StochasticPolicy)
         self.policy = policy
         self.baseline = baseline
-        self.trajectory = []
+        self.trajectory = []  # log probabilities of the actions taken
+        self.vec_log_p, self.vec_costs, self.vec_done = [], [], []
 
     def get_objective(self, loss):
         if len(self.trajectory) == 0: return 0.
 
         b = 0 if self.baseline is None else self.baseline()
-        total_loss = sum((torch.log(p_a) for p_a in self.trajectory)) * (loss - b)
+        total_loss = torch.stack(self.trajectory).sum() * (loss - b)
 
         if self.baseline is not None:
             self.baseline.update(loss)
@@ -35,10 +37,32 @@ class Reinforce(macarico.Learner):
         return total_loss
 
     def forward(self, state):
-        action, p_action = self.policy.stochastic(state)
-        self.trajectory.append(p_action)
+        action, log_p_action = self.policy.log_stochastic(state)
+        self.trajectory.append(log_p_action)
         return action
 
+    def forward_vector(self, venv):
+        actions, log_p_actions = self.policy.log_stochastic_vector(venv)
+        self.vec_log_p.append(log_p_actions)
+        return actions
+
+    def observe_vector(self, venv, costs, done):
+        self.vec_costs.append(costs)
+        self.vec_done.append(done)
+
+    def get_objective_vector(self, venv):
+        # each action is scored by the cost to go of its episode, cut
+        # off at the end of the rollout; objective is per env
+        if len(self.vec_log_p) == 0: return 0.
+        costs_to_go = util.costs_to_go(torch.stack(self.vec_costs), torch.stack(self.vec_done))
+        b = 0 if self.baseline is None else self.baseline()
+        log_p = torch.stack(self.vec_log_p)
+        total_loss = (log_p * Varng(costs_to_go - b)).sum() / venv.n_envs
+        if self.baseline is not None:
+            self.baseline.update(costs_to_go.mean().item())
+        self.vec_log_p, self.vec_costs, self.vec_done = [], [], []
+        return total_loss
+
 class LinearValueFn(nn.Module):
     def __init__(self, features, disconnect_values=True):
         nn.Module.__init__(self)
@@ -57,36 +81,66 @@ class LinearValueFn(nn.Module):
 
 
 class A2C(macarico.Learner):
-    def __init__(self, policy, state_value_fn, value_multiplier=1.0):
+    r"""Advantage actor critic. Advantages are GAE(gamma, gae_lambda)
+    estimates; the defaults (1, 1) score each action by the episode
+    loss minus the value of the state it was taken in."""
+    def __init__(self, policy, state_value_fn, value_multiplier=1.0, gamma=1.0, gae_lambda=1.0):
         macarico.Learner.__init__(self)
         self.policy = policy
         self.state_value_fn = state_value_fn
         self.trajectory = []
         self.value_multiplier = value_multiplier
-        self.loss_fn = nn.SmoothL1Loss()
-        self.loss_var = torch.zeros(1)
+        self.gamma = gamma
+        self.gae_lambda = gae_lambda
+        self.vec_trajectory, self.vec_costs, self.vec_done = [], [], []
+
+    def _objective(self, log_p_actions, values, costs, done, bootstrap=None):
+        # log_p_actions and values are (T, n_envs) Vars
+        advantages, targets = util.generalized_advantages(costs, values.data, done,
+                                                          self.gamma, self.gae_lambda, bootstrap)
+        total_loss = (log_p_actions * Varng(advantages)).sum()
+        total_loss += self.value_multiplier * \
+                      F.smooth_l1_loss(values, Varng(targets), size_average=False)
+        return total_loss
 
     def get_objective(self, loss):
-        if len(self.trajectory) == 0: return
-        loss = float(loss)
-        loss_var = Varng(self.loss_var + loss)
-        
-        total_loss = 0.0
-        for p_a, value in self.trajectory:
-            v = value.data[0,0]
-
-            # reinforcement loss
-            total_loss += (loss - v) * p_a.log()
-
-            # value fn approximator loss
-            total_loss += self.value_multiplier * self.loss_fn(value, loss_var)
-
+        if len(self.trajectory) == 0: return 0.
+        log_p_actions, values = zip(*self.trajectory)
+        log_p_actions = torch.stack(log_p_actions).view(-1, 1)
+        values = torch.cat(values).view(-1, 1)
+        # the whole loss arrives at the end of the episode
+        costs = util.zeros(values, values.shape[0], 1)
+        costs[-1, 0] = float(loss)
+        done = util.zeros(values, values.shape[0], 1).byte()
+        done[-1, 0] = 1
         self.trajectory = []
-        return total_loss
+        return self._objective(log_p_actions, values, costs, done)
 
     def forward(self, state):
-        action, p_action = self.policy.stochastic(state)
+        action, log_p_action = self.policy.log_stochastic(state)
         value = self.state_value_fn(state)
         # log action probabilities and values taken along current trajectory
-        self.trajectory.append((p_action, value))
+        self.trajectory.append((log_p_action, value))
         return action
+
+    def forward_vector(self, venv):
+        actions, log_p_actions = self.policy.log_stochastic_vector(venv)
+        values = self.state_value_fn(venv).view(-1)
+        self.vec_trajectory.append((log_p_actions, values))
+        return actions
+
+    def observe_vector(self, venv, costs, done):
+        self.vec_costs.append(costs)
+        self.vec_done.append(done)
+
+    def get_objective_vector(self, venv):
+        # episodes still running are bootstrapped with the value of
+        # their current state
+        if len(self.vec_trajectory) == 0: return 0.
+        bootstrap = self.state_value_fn(venv).data.view(-1)
+        log_p_actions, values = zip(*self.vec_trajectory)
+        total_loss = self._objective(torch.stack(log_p_actions), torch.stack(values),
+                                     torch.stack(self.vec_costs), torch.stack(self.vec_done),
+                                     bootstrap)
+        self.vec_trajectory, self.vec_costs, self.vec_done = [], [], []
+        return total_loss / venv.n_envs
@@ -0,0 +1,153 @@
+from __future__ import division, generators, print_function
+from collections import namedtuple
+import numpy as np
+import torch
+
+import macarico.util as util
+
+Transitions = namedtuple('Transitions', ['features', 'masks', 'actions', 'costs',
+                                         'next_features', 'next_masks', 'done',
+                                         'idx', 'weights'])
+
+class ReplayBuffer(object):
+    r"""A ring buffer of the most recent `capacity` transitions
+    (features, action mask, action, cost, next features, next action
+    mask, done), stored in preallocated tensors that are allocated on
+    the first `add` (so their type and sizes follow the features).
+
+    With `prioritized=True`, `sample` draws transitions with
+    probability proportional to priority^`alpha` and returns
+    importance weights with exponent `beta` (Schaul et al., 2016); new
+    transitions get the largest priority seen so far, and learners
+    report new TD errors through `update_priorities`.
+    """
+    def __init__(self, capacity, prioritized=False, alpha=0.6, beta=0.4, eps=1e-3):
+        self.capacity = capacity
+        self.prioritized = prioritized
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.features = None
+        self.n = 0
+        self.pos = 0
+        self.max_priority = 1.
+
+    def __len__(self):
+        return self.n
+
+    def _allocate(self, features, mask):
+        N, dim, K = self.capacity, features.numel(), mask.numel()
+        self.features = util.zeros(features, N, dim)
+        self.next_features = util.zeros(features, N, dim)
+        self.actions = util.longtensor(features, N).zero_()
+        self.costs = util.zeros(features, N)
+        self.priorities = util.zeros(features, N)
+        self.masks = mask.new(N, K).zero_()
+        self.next_masks = mask.new(N, K).zero_()
+        self.done = mask.new(N).zero_()
+
+    def add(self, features, mask, action, cost, next_features=None, next_mask=None, done=False):
+        r"""Store one transition, overwriting the oldest once full.
+        `next_features` and `next_mask` may be None when `done`."""
+        if self.features is None:
+            self._allocate(features, mask)
+        i = self.pos
+        self.features[i] = features.view(-1)
+        self.masks[i] = mask
+        self.actions[i] = int(action)
+        self.costs[i] = float(cost)
+        self.done[i] = int(done)
+        if next_features is None:
+            self.next_features[i].zero_()
+            self.next_masks[i].fill_(1)
+        else:
+            self.next_features[i] = next_features.view(-1)
+            self.next_masks[i] = next_mask
+        self.priorities[i] = self.max_priority
+        self.pos = (self.pos + 1) % self.capacity
+        self.n = min(self.n + 1, self.capacity)
+
+    def sample(self, n):
+        "returns `Transitions` of `n` stored transitions, drawn with replacement"
+        assert self.n > 0, 'cannot sample from an empty replay buffer'
+        weights = None
+        if self.prioritized:
+            p = self.priorities[:self.n] ** self.alpha
+            idx = torch.multinomial(p, n, replacement=True)
+            weights = (self.n * p.index_select(0, idx) / p.sum()) ** (-self.beta)
+            weights /= weights.max()
+        else:
+            idx = util.longtensor(self.costs, n).random_(0, self.n)
+        return Transitions(self.features.index_select(0, idx),
+                           self.masks.index_select(0, idx),
+                           self.actions.index_select(0, idx),
+                           self.costs.index_select(0, idx),
+                           self.next_features.index_select(0, idx),
+                           self.next_masks.index_select(0, idx),
+                           self.done.index_select(0, idx),
+                           idx,
+                           weights)
+
+    def update_priorities(self, idx, errors):
+        p = errors.abs() + self.eps
+        self.priorities.index_copy_(0, idx, p)
+        self.max_priority = max(self.max_priority, p.max().item())
+
+
+class AggregateDataset(object):
+    r"""An append-only dataset of featurized states with their
+    reference cost vectors and action masks, as aggregated by DAgger.
+
+    Rows live in numpy arrays that double in size as needed; with a
+    `filename` they are memory-mapped files (`filename.features`,
+    `.costs` and `.masks`) so the aggregate can outgrow memory.
+    """
+    def __init__(self, filename=None, initial_capacity=1024):
+        self.filename = filename
+        self.initial_capacity = initial_capacity
+        self.n = 0
+        self.features, self.costs, self.masks = None, None, None
+
+    def __len__(self):
+        return self.n
+
+    def _array(self, name, dtype, shape, old):
+        if self.filename is None:
+            arr = np.zeros(shape, dtype=dtype)
+        else:
+            path = '%s.%s' % (self.filename, name)
+            if old is not None:
+                old.flush()
+            with open(path, 'ab') as h:
+                h.truncate(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            return np.memmap(path, dtype=dtype, mode='r+', shape=shape)
+        if old is not None:
+            arr[:old.shape[0]] = old
+        return arr
+
+    def _grow(self, capacity, dim, n_actions):
+        self.features = self._array('features', np.float32, (capacity, dim), self.features)
+        self.costs = self._array('costs', np.float32, (capacity, n_actions), self.costs)
+        self.masks = self._array('masks', np.uint8, (capacity, n_actions), self.masks)
+
+    def append(self, features, costs, mask):
+        features = features.contiguous().view(-1).cpu().numpy()
+        if self.features is None:
+            self._grow(self.initial_capacity, features.shape[0], costs.shape[0])
+        elif self.n == self.features.shape[0]:
+            self._grow(2 * self.n, self.features.shape[1], self.costs.shape[1])
+        self.features[self.n] = features
+        self.costs[self.n] = costs.cpu().numpy()
+        self.masks[self.n] = mask.cpu().numpy()
+        self.n += 1
+
+    def minibatches(self, param, minibatch_size, shuffle=True):
+        r"""Iterate over the whole dataset as (features, costs, masks)
+        tensors of the same type as `param`."""
+        order = np.random.permutation(self.n) if shuffle else np.arange(self.n)
+        for start in range(0, self.n, minibatch_size):
+            idx = np.sort(order[start:start+minibatch_size])
+            features, costs = self.features[idx], self.costs[idx]
+            yield (util.zeros(param, *features.shape).copy_(torch.from_numpy(features)),
+                   util.zeros(param, *costs.shape).copy_(torch.from_numpy(costs)),
+                   torch.from_numpy(self.masks[idx]))
@@ -64,7 +64,7 @@ class Reslope(BanditLOLS):
         if not self.explore(): # exploit
             a = a_ref if self.use_ref() else a_pol
         else:
-            dev_a, iw = self.do_exploration(a_costs, state.actions)
+            dev_a, iw = self.do_exploration(a_costs, state.actions, state.action_mask())
             a = dev_a if isinstance(dev_a, int) else dev_a.data[0,0]
 
             self.dev_t.append(self.t)
@@ -0,0 +1,295 @@
+"""
+Multi-process data-parallel training. `ParallelTrainLoop` forks
+`n_workers` processes that share the policy's parameters through
+`torch.multiprocessing` shared memory, each running episodes and
+backward passes on its own shard of the training data, while the main
+process prints progress, evaluates on dev data and saves the model.
+
+There are two ways of combining the workers' updates:
+
+* 'hogwild': every worker steps its own copy of the optimizer on the
+  shared parameters, without any locking (Recht et al., 2011).
+
+* 'sync': after every minibatch the workers' gradients are summed over
+  a local gloo process group and averaged over all their examples;
+  worker 0 takes the optimizer step and everyone waits for it before
+  starting the next minibatch. This computes the same updates as a
+  single `TrainLoop` with `n_workers` times the minibatch size.
+
+Workers are forked, so the env factory, learner, optimizer and
+losses are inherited rather than pickled; each worker gets its own
+copy of everything except the parameters (eg, the optimizer state and
+an actor's recurrent state are per worker).
+"""
+
+from __future__ import division, generators, print_function
+
+import os
+import sys
+import traceback
+from copy import deepcopy
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+import macarico
+from macarico.annealing import Averaging
+from macarico.util import LearnerToAlg, LossMatrix, ShortFormatter, EnvPool, minibatch, reseed
+
+class ParallelTrainLoop(object):
+    def __init__(self,
+                 mk_env,
+                 policy,
+                 learner,
+                 optimizer,
+                 losses,      # one or more losses, first is used for early stopping
+                 n_workers=2,
+                 mode='hogwild',   # { hogwild, sync }
+                 minibatch_size=1, # per worker
+                 print_freq=2.0,   # int=additive, float=multiplicative
+                 gradient_clip=None,
+                 quiet=False,
+                 reshuffle=True,
+                 returned_parameters='best',  # { best, last, none }
+                 save_best_model_to=None,
+                 checkpoint_to=None,  # save the policy here at every printout
+                 n_random_train=5,
+                 n_random_dev=5,
+                 n_eval_train=50,  # number of training examples to evaluate at printouts
+                 mk_formatter=ShortFormatter,
+                 seed=90210,
+                 port=29500,       # for the gloo process group in sync mode
+                ):
+        assert mk_env is not None, 'trainloop expects an mk_env'
+        assert policy is not None, 'trainloop expects a policy'
+        assert learner is not None, 'trainloop expects a learner'
+        assert losses is not None, 'must specify at least one loss function'
+        assert optimizer is not None, 'need an optimizer'
+        assert mode in ['hogwild', 'sync'], 'mode must be hogwild or sync, got %s' % mode
+        assert n_workers >= 1
+        if not isinstance(losses, list):
+            losses = [losses]
+
+        self.mk_env = mk_env
+        self.policy = policy
+        self.optimizer = optimizer
+        self.losses = losses
+        self.n_workers = n_workers
+        self.mode = mode
+        self.minibatch_size = minibatch_size
+        self.print_freq = print_freq
+        self.gradient_clip = gradient_clip
+        self.quiet = quiet
+        self.reshuffle = reshuffle
+        self.returned_parameters = returned_parameters
+        self.save_best_model_to = save_best_model_to
+        self.checkpoint_to = checkpoint_to
+        self.n_eval_train = n_eval_train
+        self.mk_formatter = mk_formatter
+        self.seed = seed
+        self.port = port
+        self.learning_alg = learner if isinstance(learner, macarico.LearningAlg) else \
+                            LearnerToAlg(learner, policy, losses[0])
+
+        self.tr_loss_matrix = LossMatrix(n_random_train, losses)
+        self.de_loss_matrix = LossMatrix(n_random_dev, losses)
+        self.env_pool = EnvPool(mk_env)
+
+        self.best_de_err = float('inf')
+        self.final_parameters = None
+        self.objective_average = Averaging()
+
+        self.optimizer_parameters = []
+        for pg in optimizer.param_groups:
+            if 'params' in pg:
+                self.optimizer_parameters += pg['params']
+
+        self.N = 0  # total number of examples seen, over all workers
+        self.N_last = 0
+        self.N_print = None
+
+    def print_it(self, string):
+        if not self.quiet:
+            print(string, file=sys.stderr)
+
+    def next_print(self):
+        if self.print_freq is None:
+            return None
+        if self.N < 1:
+            return 1
+        N2 = (self.N + self.print_freq) if isinstance(self.print_freq, int) else (self.N * self.print_freq)
+        return min(N2, self.N + self.n_training_ex)
+
+    def train(self, training_data, dev_data=None, n_epochs=1):
+        if dev_data is not None and len(dev_data) == 0:
+            dev_data = None
+        assert len(training_data) >= self.n_workers, \
+            'need at least one training example per worker'
+        self.n_training_ex = len(training_data)
+        self.N_print = self.next_print()
+        self.formatter = self.mk_formatter(dev_data is not None, self.losses)
+        if self.formatter.header is not None:
+            self.print_it(self.formatter.header)
+        eval_train = [training_data[i] for i in
+                      np.random.permutation(len(training_data))[:self.n_eval_train]]
+
+        # gradients are per process, so they mustn't be shared
+        for p in self.policy.parameters():
+            p.grad = None
+        self.policy.share_memory()
+
+        # the workers rely on inheriting everything, so always fork
+        ctx = mp.get_context('fork')
+        queue = ctx.Queue()
+        workers = []
+        for rank in range(self.n_workers):
+            w = ctx.Process(target=self._worker,
+                           args=(rank, training_data[rank::self.n_workers], n_epochs, queue))
+            w.start()
+            workers.append(w)
+
+        n_done = 0
+        epoch = 1
+        try:
+            while n_done < self.n_workers:
+                msg = queue.get()
+                if msg[0] == 'batch':
+                    _, rank, epoch, n, obj = msg
+                    if n == 0: continue  # padding, see _worker
+                    self.N += n
+                    self.objective_average.update(obj / n)
+                    if self.N_print is not None and self.N >= self.N_print:
+                        self.do_printable_update(eval_train, dev_data, epoch)
+                elif msg[0] == 'done':
+                    n_done += 1
+                elif msg[0] == 'error':
+                    raise Exception('worker %d failed:\n%s' % (msg[1], msg[2]))
+        finally:
+            for w in workers:
+                if n_done < self.n_workers: w.terminate()
+                w.join()
+
+        if self.N_last < self.N:
+            self.do_printable_update(eval_train, dev_data, n_epochs)
+        if self.returned_parameters == 'last':
+            self.final_parameters = deepcopy(self.policy.state_dict())
+
+        return self.tr_loss_matrix, self.de_loss_matrix, self.final_parameters
+
+    def evaluate_into(self, loss_matrix, data):
+        for example in data:
+            self.policy.new_minibatch()
+            loss_matrix.run_and_append(self.env_pool([example])[0], self.policy)
+
+    def do_printable_update(self, eval_train, dev_data, epoch):
+        # runs on the shared parameters while the workers keep going
+        self.N_last = self.N
+        self.N_print = self.next_print()
+        self.evaluate_into(self.tr_loss_matrix, eval_train)
+        if dev_data is not None:
+            self.evaluate_into(self.de_loss_matrix, dev_data)
+        tr_err = self.tr_loss_matrix.next(self.N, epoch)
+        de_err = self.de_loss_matrix.next(self.N, epoch)
+
+        err = de_err[0] if dev_data is not None else tr_err[0]
+        is_best = err < self.best_de_err
+        self.print_it(self.formatter(self.objective_average(),
+                                     self.tr_loss_matrix,
+                                     self.de_loss_matrix,
+                                     self.N,
+                                     epoch,
+                                     is_best))
+        self.objective_average.reset()
+
+        if self.checkpoint_to is not None:
+            torch.save(self.policy.state_dict(), self.checkpoint_to + '.writing')
+            os.rename(self.checkpoint_to + '.writing', self.checkpoint_to)
+        if is_best:
+            self.best_de_err = err
+            if self.save_best_model_to is not None:
+                torch.save(self.policy.state_dict(), self.save_best_model_to)
+            if self.returned_parameters == 'best':
+                self.final_parameters = deepcopy(self.policy.state_dict())
+
+    ###########
+    ## workers
+    ###########
+    def _worker(self, rank, shard, n_epochs, queue):
+        try:
+            torch.set_num_threads(1)  # the workers already use all the cores
+            reseed(self.seed + rank)
+            if self.mode == 'sync':
+                import torch.distributed as dist
+                dist.init_process_group('gloo',
+                                        init_method='tcp://127.0.0.1:%d' % self.port,
+                                        rank=rank,
+                                        world_size=self.n_workers)
+            # every worker must take part in the same number of
+            # reductions, so shards are padded out with empty batches
+            shard = list(shard)
+            shard_size = (self.n_training_ex + self.n_workers - 1) // self.n_workers
+            n_batches = (shard_size + self.minibatch_size - 1) // self.minibatch_size
+            env_pool = EnvPool(self.mk_env)
+            for epoch in range(1, n_epochs+1):
+                if self.reshuffle:
+                    np.random.shuffle(shard)
+                batches = [batch for batch, _ in minibatch(shard, self.minibatch_size)]
+                for b in range(n_batches):
+                    batch = batches[b] if b < len(batches) else []
+                    total_obj = self._run_batch(env_pool, batch)
+                    self._step(total_obj, len(batch))
+                    queue.put(('batch', rank, epoch, len(batch),
+                               total_obj if isinstance(total_obj, float) else total_obj.item()))
+            queue.put(('done', rank))
+        except Exception:
+            queue.put(('error', rank, traceback.format_exc()))
+
+    def _run_batch(self, env_pool, batch):
+        self.optimizer.zero_grad()
+        self.policy.new_minibatch()
+        envs = env_pool(batch)
+        if len(envs) > 1:
+            for module in self.policy.feature_graph().static_features:
+                module.forward_batch(envs)
+        total_obj = 0.
+        for env in envs:
+            self.policy.new_example()
+            total_obj += self.learning_alg(env)
+        return total_obj
+
+    def _step(self, total_obj, n):
+        if self.mode == 'hogwild':
+            if n > 0 and not isinstance(total_obj, float):
+                (total_obj / n).backward()
+                self._clip_and_step()
+            return
+
+        import torch.distributed as dist
+        if not isinstance(total_obj, float):
+            total_obj.backward()
+        # sum gradients and example counts over workers, in one reduction
+        params = self.optimizer_parameters
+        sizes = [p.numel() for p in params]
+        flat = torch.zeros(sum(sizes) + 1)
+        i = 0
+        for p, size in zip(params, sizes):
+            if p.grad is not None:
+                flat[i:i+size] = p.grad.data.view(-1)
+            i += size
+        flat[-1] = n
+        dist.reduce(flat, dst=0)
+        if dist.get_rank() == 0 and flat[-1] > 0:
+            flat /= flat[-1]
+            i = 0
+            for p, size in zip(params, sizes):
+                if p.grad is None:
+                    p.grad = torch.zeros_like(p.data)
+                p.grad.data.copy_(flat[i:i+size].view_as(p.grad.data))
+                i += size
+            self._clip_and_step()
+        dist.barrier()  # nobody runs the next batch on stale parameters
+
+    def _clip_and_step(self):
+        if self.gradient_clip is not None:
+            torch.nn.utils.clip_grad_norm(self.optimizer_parameters, self.gradient_clip)
+        self.optimizer.step()
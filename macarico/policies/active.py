@@ -1,18 +1,34 @@
 from __future__ import division, generators, print_function
-import random
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable as Var
 
+import macarico
+import macarico.util as util
+from macarico import CostSensitivePolicy
+from macarico.util import Var, Varng
+
+class CSActive(CostSensitivePolicy):
+    r"""Cost-sensitive active learning (Krishnamurthy et al., 2017) on
+    top of a `CostSensitivePolicy` whose final layer is a linear map of
+    `base_policy.features`.
+
+    `cost_ranges` computes, for every action at once, the range of
+    costs that a regressor close to the current one could predict (by
+    a vectorized bisection), and decides which of the actions' costs
+    are worth querying: those whose range is large and overlaps the
+    smallest upper bound, when more than one does. Everything else is
+    passed through to `base_policy`.
+    """
+    OVERRIDE_UPDATE = True
 
-from macarico import Policy
-
-class CSActive(Policy):
     def __init__(self, base_policy, min_cost=0, max_cost=1, mellowness=0.1, range_c=0.5):
+        CostSensitivePolicy.__init__(self)
         self.base_policy = base_policy
+        self.n_actions = base_policy.n_actions
         self.optimizer = None
-        
+
         self.min_cost = min_cost
         self.max_cost = max_cost
         self.mellowness = mellowness
@@ -27,156 +43,120 @@ class CSActive(Policy):
 
     def set_optimizer(self, optimizer):
         self.optimizer = optimizer
-        
+
+    def query_rate(self):
+        return self.num_query / max(1, self.num_query + self.num_skip)
+
     #############################
     ## passthrough to base policy
     #############################
-        
-    def __call__(self, state, deviate_to=None):
-        b, z = self.cost_ranges(state)
-        return self.base_policy(state, deviate_to)
+
+    def forward(self, state):
+        return self.base_policy(state)
 
     def sample(self, state):
         return self.base_policy.sample(state)
 
-    def stochastic(self, state, temperature=1):
-        return self.base_policy.stochastic(state, temperature)
-
-    def stochastic_with_probability(self, state, temperature=1):
-        return self.base_policy.stochastic_with_probability(state, temperature)
-        
-    def predict_costs(self, state, deviate_to=None):
-        return self.base_policy.predict_costs(state, deviate_to)
-    
-    def forward(self, state, truth):
-        return self.base_policy.forward(state, truth)
-    
-    def forward_partial_complete(self, pred_costs, truth, actions):
-        #print truth
-        assert all((self.min_cost <= t for t in truth))
-        assert all((t <= self.max_cost for t in truth))
-        if np.random.random() < 0.001:
-            print self.num_query / max(1, self.num_query + self.num_skip)
-        return self.base_policy.forward_partial_complete(pred_costs, truth, actions)
+    def stochastic(self, state):
+        return self.base_policy.stochastic(state)
+
+    def log_stochastic(self, state):
+        return self.base_policy.log_stochastic(state)
+
+    def predict_costs(self, state):
+        return self.base_policy.predict_costs(state)
+
+    def costs_to_action(self, state, pred_costs):
+        return self.base_policy.costs_to_action(state, pred_costs)
+
+    def _update(self, pred_costs, truth, actions=None):
+        assert not torch.is_tensor(truth) or \
+            (truth.min() >= self.min_cost and truth.max() <= self.max_cost)
+        return self.base_policy.update(pred_costs, truth, actions)
+
+    def _update_trajectory(self, pred_costs, truths, actions):
+        return self.base_policy.update_trajectory(pred_costs, truths, actions)
 
+    def _update_batch(self, pred_costs, costs, mask):
+        return self.base_policy.update_batch(pred_costs, costs, mask)
 
     ########################
     ## active learning stuff
     ########################
     def cost_ranges(self, state, pred_costs=None):
+        r"""Returns `(query_any, to_query, min_pred, max_pred)`, where
+        `to_query` is a ByteTensor over actions (0 for actions not
+        allowed in `state`) and `min_pred` and `max_pred` bound each
+        action's cost."""
         if pred_costs is None:
             pred_costs = self.predict_costs(state)
-        if isinstance(pred_costs, dy.Expression):
+        if isinstance(pred_costs, Var):
             pred_costs = pred_costs.data
-            
+
         self.t += 1
-        K = len(pred_costs)
+        K = pred_costs.shape[0]
         t_prev = max(self.t - 1, 1)
-        min_max_cost = 1e100
-        eta = self.range_c * self.cost_span / torch.sqrt(self.t)
-        delta = self.mellowness * torch.log(K * t_prev) * (self.cost_span ** 2)
-    
-        ranges = []
-        feats = self.base_policy.features(state).data
-        #if self.t > 22000:
-        #    from arsenal import ip; ip()
+        eta = self.range_c * self.cost_span / math.sqrt(self.t)
+        delta = self.mellowness * math.log(K * t_prev) * (self.cost_span ** 2)
+
+        feats = self.base_policy.features(state).data.view(-1)
         sens = self.sensitivity(feats)
-        for i in xrange(K):
-            min_pred, max_pred, is_range_large = \
-              self.find_cost_range(feats, pred_costs, i, delta, eta, sens)
-            min_max_cost = min(min_max_cost, max_pred)
-            ranges.append( (min_pred, max_pred, is_range_large) )
-    
-        n_overlapped = 0
-        for (min_pred, max_pred, is_range_large) in ranges:
-            is_range_overlapped = min_pred <= min_max_cost
-            n_overlapped += is_range_overlapped
-
-        query_any = False
-        label_cost_ranges = []
-        if True or n_overlapped > 1:
-            for i, (min_pred, max_pred, is_range_large) in enumerate(ranges):
-                is_range_overlapped = min_pred <= min_max_cost
-                to_query = is_range_overlapped and is_range_large and n_overlapped > 1
-                label_cost_ranges.append( (to_query, min_pred, max_pred) )
-                query_any = query_any or to_query
-                if to_query:
-                    self.num_query += 1
-                else:
-                    self.num_skip += 1
-
-        #if not query_any:
-        #    from arsenal import ip; ip()
-        return query_any, label_cost_ranges
-    
-    def compute_rate_decay(self, w):
-        rate_decay = 1.
-        # TODO: this really needs to take, eg, adagrad params into account
-        return rate_decay
+        if math.isnan(sens) or math.isinf(sens):
+            min_pred = pred_costs.new(K).fill_(self.min_cost)
+            max_pred = pred_costs.new(K).fill_(self.max_cost)
+            is_range_large = pred_costs.new(K).fill_(1).byte()
+        else:
+            max_pred = (pred_costs + sens * self.binary_search(self.max_cost - pred_costs, delta, sens)).clamp(max=self.max_cost)
+            min_pred = (pred_costs - sens * self.binary_search(pred_costs - self.min_cost, delta, sens)).clamp(min=self.min_cost)
+            is_range_large = (max_pred - min_pred) > eta
+
+        # only allowed actions compete for the argmin
+        allowed = state.action_mask()
+        is_range_overlapped = (min_pred <= util.masked_fill_disallowed(max_pred, allowed).min()) & allowed
+        n_overlapped = is_range_overlapped.sum().item()
+        to_query = is_range_overlapped & is_range_large
+        if n_overlapped <= 1:
+            to_query.zero_()
+
+        n_query = to_query.sum().item()
+        self.num_query += n_query
+        self.num_skip += allowed.sum().item() - n_query
+        return n_query > 0, to_query, min_pred, max_pred
 
     def average_update(self):
         return 1. # if normalized this is different
-        
+
     def get_pred_per_update(self, x):
-        #x_min = 1.084202e-19
-        #x2_min = x_min * x_min
-        
-        #grad_squared = loss.get_square_grad(pred, label) * imp_weight
-        #grad_squared = (pred - label) * (pred - label) * imp_weight
-
-        # TODO: pred_per_update_feature
-        pred_per_update = x.dot(x)
-        #for x, w in zip(features, weights):
-            # right now, compute_rate_decay is just 1, so this is the sum of x^2
-            #x2 = x * x
-            #if x2 < x2_min:
-            #    x = x_min if x > 0 else -x_min
-            #x2 = x2_min
-            #pred_per_update += x2 * self.compute_rate_decay(w)
-
-        pred_per_update *= self.average_update()
-        return pred_per_update
-        
+        # TODO: this really needs to take, eg, adagrad params into account
+        return x.dot(x) * self.average_update()
+
     def sensitivity(self, x):
         # note: "stateless" is true
-        return self.get_scale() * self.get_pred_per_update(x)
+        return float(self.get_scale() * self.get_pred_per_update(x))
 
     def get_scale(self):
-        return self.optimizer.learning_rate / torch.sqrt(max(1, self.t))
-    
+        return self.optimizer.param_groups[0]['lr'] / math.sqrt(max(1, self.t))
+
     def binary_search(self, fhat, delta, sens):
-        fhat2 = fhat*fhat
-        
-        maxw = min(fhat/sens, 1e20)
-        if maxw*fhat2 <= delta:
-            return maxw
-    
-        l = 0
-        u = maxw
-        w = None
-        v = None
-        for _ in xrange(self.MAX_ITER):
-            w = (u + l) / 2
-            v = w * (fhat2 - (fhat-sens*w)*(fhat-sens*w)) - delta
-            l, u = (l, w) if v > 0 else (w, u)
-            if abs(v) < self.TOLERANCE or u-l <= self.TOLERANCE:
+        r"""For each entry of the vector `fhat`, the largest importance
+        weight w with w * (fhat^2 - (fhat - sens * w)^2) <= delta, found
+        by bisection on all entries simultaneously; each entry stops
+        moving once it has converged."""
+        fhat2 = fhat * fhat
+        maxw = (fhat / sens).clamp(max=1e20)
+        small = maxw * fhat2 <= delta
+
+        l = fhat.new(fhat.shape).zero_()
+        u = maxw.clone()
+        active = 1 - small
+        for _ in range(self.MAX_ITER):
+            if not active.any():
                 break
-            
-        return l
-    
-    def find_cost_range(self, x, pred_costs, i, delta, eta, sens):
-        #if np.random.random < 0.1: print sens
-        if torch.isnan(sens) or torch.isinf(sens):
-            return self.min_cost, self.max_cost, True
-    
-        max_pred = min(self.max_cost,
-                       pred_costs[i] + \
-                       sens * self.binary_search(self.max_cost - pred_costs[i], delta, sens))
-        min_pred = max(self.min_cost,
-                       pred_costs[i] - \
-                       sens * self.binary_search(pred_costs[i] - self.min_cost, delta, sens))
-        is_range_large = max_pred - min_pred > eta
-    
-        return min_pred, max_pred, is_range_large
-    
+            w = (u + l) / 2
+            v = w * (fhat2 - (fhat - sens * w) * (fhat - sens * w)) - delta
+            too_big = v > 0
+            u = torch.where(active & too_big, w, u)
+            l = torch.where(active & (1 - too_big), w, l)
+            active = active & (1 - ((v.abs() < self.TOLERANCE) | (u - l <= self.TOLERANCE)))
 
+        return torch.where(small, maxw, l)
@@ -1,164 +1,183 @@
 from __future__ import division, generators, print_function
 
-from macarico.policies.linear import LinearPolicy
-from macarico import Policy
-from macarico import util
-
+import math
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable as Var
-
-
-def actions_to_probs(actions, n_actions):
-    probs = torch.zeros(n_actions)
-    bag_size = len(actions)
-    prob = 1. / bag_size
-    for action_set in actions:
-        for action in action_set:
-            probs[action] += prob / len(action_set)
-    return probs
-
-
-# Randomize over predictions from a base set of predictors
-def bootstrap_probabilities(n_actions, policy_bag, state, deviate_to):
-    actions = [[policy(state, deviate_to)] for policy in policy_bag]
-    probs = actions_to_probs(actions, n_actions)
-    return probs
-
-
-def min_set(costs, limit_actions=None):
-    min_val = None
-    min_set = []
-    if limit_actions is None:
-        for a, c in enumerate(costs):
-            if min_val is None or c < min_val:
-                min_val = c
-                min_set = [a]
-            elif c == min_val:
-                min_set.append(a)
-    else:
-        for a in limit_actions:
-            c = costs[a]
-            if min_val is None or c < min_val:
-                min_val = c
-                min_set = [a]
-            elif c == min_val:
-                min_set.append(a)
-    return min_set
+from torch.nn.parameter import Parameter
+
+import macarico
+from macarico import CostSensitivePolicy
+from macarico import util
+import macarico.sampling as sampling
+from macarico.util import Var, Varng
+
+
+def min_set_probs(costs, mask=None):
+    r"""For a (bag_size, n_actions) tensor of costs, the probability of
+    each action under "pick a bag member uniformly, then one of its
+    minimum-cost allowed actions uniformly"."""
+    if mask is not None:
+        costs = util.masked_fill_disallowed(costs, mask.view(1, -1).expand_as(costs))
+    ties = (costs == costs.min(1, keepdim=True)[0]).type_as(costs)
+    return (ties / ties.sum(1, keepdim=True)).mean(0)
 
 class BootstrapCost:
+    r"""The predicted costs of every bag member, as a (bag_size,
+    n_actions) Var. Behaves like the costs of the first member (if
+    `greedy_predict`) or the average over members otherwise."""
     def __init__(self, costs, greedy_predict=True):
         self.costs = costs
         self.greedy_predict = greedy_predict
 
     def average_cost(self):
-        return sum(self.costs) / len(self.costs)
-        
+        return self.costs.mean(0)
+
+    def prediction(self):
+        return self.costs[0] if self.greedy_predict else self.average_cost()
+
     def data(self):
-        if self.greedy_predict:
-            return self.costs[0].data
-        else:
-            return self.average_cost().data
+        return self.prediction().data
 
     def get_probs(self, limit_actions=None):
-        assert(len(self.costs) > 0)
-        n_actions = len(self.costs[0].data)
-        actions = [min_set(c.data, limit_actions) for c in self.costs]
-        return actions_to_probs(actions, n_actions)
+        mask = None
+        if limit_actions is not None and len(limit_actions) != self.costs.shape[1]:
+            mask = util.actions_to_mask(self.costs.data, [limit_actions], self.costs.shape[1])[0]
+        return min_set_probs(self.costs.data, mask)
 
     def __getitem__(self, idx):
-        if self.greedy_predict:
-            return self.costs[0][idx]
-        else:
-            return self.average_cost()[idx]
+        return self.prediction()[idx]
 
     def __neg__(self):
-        if self.greedy_predict:
-            return self.costs[0].__neg__()
-        else:
-            return self.average_cost().__neg__()
+        return -self.prediction()
 
     def argmin(self):
-        if self.greedy_predict:
-            return self.costs[0].argmin()
-        else:
-            return self.average_cost().argmin()
-
-# Constructs a policy bag of linear policies, number of policies =
-# len(features_bag)
-def build_policy_bag(features_bag, n_actions, loss_fn, n_layers,
-                     hidden_dim):
-    return [LinearPolicy(features, n_actions, loss_fn=loss_fn,
-                         n_layers=n_layers, hidden_dim=hidden_dim)
-            for features in features_bag]
-
-
-def delegate_with_poisson(params, functions, greedy_update):
-    total_loss = 0.0
-    functions_params_pairs = zip(functions, params)
-    for idx, (loss_fn, params) in enumerate(functions_params_pairs):
-        loss_i = loss_fn(*params)
-        if greedy_update and idx == 0:
-            count_i = 1
-        else:
-            count_i = np.random.poisson(1)
-        total_loss = total_loss + count_i * loss_i
-    return total_loss
-
-
-class BootstrapPolicy(nn.Module, Policy):
-    """
-        Bootstrapping policy
+        return util.argmin(self.prediction())
+
+
+class BootstrapPolicy(CostSensitivePolicy):
+    r"""A bag of `bag_size` cost-sensitive regressors trained on Poisson
+    bootstrap resamples, for exploration (eg, BanditLOLS with
+    EXPLORE_BOOTSTRAP).
+
+    `features_bag` is either a single features module shared by all
+    members (eg, one actor over one biLSTM encoder; pass `bag_size`)
+    or a list of one per member. Only the heads differ between
+    members: their layers are stored as stacked (bag_size, ...) weight
+    tensors, so every member is evaluated with one batched matmul per
+    layer. With `n_layers=2` there is a tanh hidden layer of size
+    `hidden_dim`. Shared features are computed once per state, and the
+    bag's costs are cached until the features change, so calling the
+    policy and `predict_costs` on the same state costs one evaluation.
+
+    Updates weight the loss of each member by an independent
+    Poisson(1) draw (except the first member when `greedy_update`,
+    which always gets weight 1).
     """
+    OVERRIDE_UPDATE = True
 
-    def __init__(self, features_bag, n_actions, loss_fn='squared',
+    def __init__(self, features_bag, n_actions, loss_fn='squared', bag_size=None,
                  greedy_predict=True, greedy_update=True, n_layers=1,
                  hidden_dim=50):
-        nn.Module.__init__(self)
-        
+        CostSensitivePolicy.__init__(self)
+        assert n_layers in [1, 2], 'BootstrapPolicy supports n_layers 1 or 2'
+        assert loss_fn in ['squared', 'huber']
         self.n_actions = n_actions
-        self.bag_size = len(features_bag)
-        self.policy_bag = nn.ModuleList(build_policy_bag(features_bag, n_actions,
-                                           loss_fn, n_layers, hidden_dim))
+        if isinstance(features_bag, list):
+            self.bag_size = len(features_bag)
+            self.features_bag = nn.ModuleList(features_bag)
+            self.features = None
+            dim = features_bag[0].dim
+        else:
+            assert bag_size is not None, 'bag_size is required with shared features'
+            self.bag_size = bag_size
+            self.features_bag = None
+            self.features = features_bag
+            dim = features_bag.dim
+        self.loss_fn = F.mse_loss if loss_fn == 'squared' else F.smooth_l1_loss
         self.greedy_predict = greedy_predict
         self.greedy_update = greedy_update
-
-    def __call__(self, state, deviate_to=None):
-        action_probs = bootstrap_probabilities(self.n_actions, self.policy_bag,
-                                               state, deviate_to)
-        action = None
+        self._cached_input, self._cached_costs = None, None
+
+        dims = [dim] + ([hidden_dim] if n_layers == 2 else []) + [n_actions]
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for d_in, d_out in zip(dims[:-1], dims[1:]):
+            # same initialization as nn.Linear, independently per member
+            bound = 1. / math.sqrt(d_in)
+            self.weights.append(Parameter(torch.Tensor(self.bag_size, d_in, d_out).uniform_(-bound, bound)))
+            self.biases.append(Parameter(torch.Tensor(self.bag_size, 1, d_out).uniform_(-bound, bound)))
+
+    def bag_features(self, state):
+        "(bag_size, 1, dim) inputs of every member"
+        if self.features is not None:
+            x = self.features(state).view(1, 1, -1)
+            return x.expand(self.bag_size, 1, x.shape[2])
+        # members may share features modules; run each one once
+        computed = {}
+        for f in self.features_bag:
+            if id(f) not in computed:
+                computed[id(f)] = f(state).view(1, -1)
+        return torch.stack([computed[id(f)] for f in self.features_bag])
+
+    def bag_costs(self, x):
+        "(bag_size, n_actions) costs of every member for (bag_size, 1, dim) inputs"
+        for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+            if i > 0: x = F.tanh(x)
+            x = torch.baddbmm(b, x, w)
+        return x.view(self.bag_size, self.n_actions)
+
+    def predict_costs(self, state):
+        if self.features is None:
+            return BootstrapCost(self.bag_costs(self.bag_features(state)), self.greedy_predict)
+        # actors return the same object when asked twice for one step
+        x = self.features(state)
+        if x is not self._cached_input:
+            self._cached_costs = self.bag_costs(x.view(1, 1, -1).expand(self.bag_size, 1, x.numel()))
+            self._cached_input = x
+        return BootstrapCost(self._cached_costs, self.greedy_predict)
+
+    def forward(self, state):
+        return self.costs_to_action(state, self.predict_costs(state))
+
+    def costs_to_action(self, state, pred_costs):
+        costs = pred_costs.costs.data
+        mask = None if state.actions is None or len(state.actions) == self.n_actions else \
+               state.action_mask()
         if self.greedy_predict:
-            action = self.policy_bag[0](state, deviate_to)
-        else:
-            action, prob = util.sample_from_np_probs(action_probs)
-        return action
-
-    def predict_costs(self, state, deviate_to=None):
-        all_costs = [policy.predict_costs(state, deviate_to)
-                     for policy in self.policy_bag]
-        return BootstrapCost(all_costs, self.greedy_predict)
-
-    def greedy(self, state, pred_costs=None, deviate_to=None):
-        actions = [[policy.greedy(state, pred_costs=p_costs,
-                                  deviate_to=deviate_to)]
-                   for policy, p_costs in zip(self.policy_bag, pred_costs)]
-        action_probs = actions_to_probs(actions, self.n_actions)
-        action = None
-        if self.greedy_predict:
-            action = self.policy_bag[0].greedy(state, pred_costs=pred_costs[0],
-                                               deviate_to=deviate_to)
-        else:
-            action, prob = util.sample_from_np_probs(action_probs)
-        return action
-
-    def forward(self, state, ref):
-        params = [(state, ref) for i in range(self.bag_size)]
-        fns = [policy.forward for policy in self.policy_bag]
-        return delegate_with_poisson(params, fns, self.greedy_update)
-
-    def forward_partial_complete(self, costs, truth, acts):
-        params = [(costs.costs[i], truth, acts) for i in range(self.bag_size)]
-        loss_fns = [p.forward_partial_complete for p in self.policy_bag]
-        return delegate_with_poisson(params, loss_fns, self.greedy_update)
+            return util.argmin(costs[0], mask)
+        return sampling.sample(min_set_probs(costs, mask))[0].item()
+
+    def poisson_weights(self, param):
+        w = np.random.poisson(1, self.bag_size)
+        if self.greedy_update:
+            w[0] = 1
+        return util.getnew(param)(w.tolist())
+
+    def _update(self, pred_costs, truth, actions=None):
+        return self._update_trajectory([pred_costs], [truth], [actions])
+
+    def _update_trajectory(self, pred_costs, truths, actions):
+        pred = torch.stack([p.costs for p in pred_costs])   # (T, bag_size, n_actions)
+        truth = util.zeros(pred, len(truths), self.n_actions)
+        for t, y in enumerate(truths):
+            if isinstance(y, torch.FloatTensor):
+                truth[t] = y
+            else:
+                truth[t].fill_(1)
+                for a in ([y] if isinstance(y, int) else y):
+                    truth[t, a] = 0
+        return self._bag_loss(pred, truth, util.actions_to_mask(truth, actions, self.n_actions))
+
+    def _bag_loss(self, pred, truth, mask):
+        # pred is (T, bag_size, n_actions), truth and mask (T, n_actions)
+        target = Varng(truth.unsqueeze(1).expand_as(pred))
+        if mask is not None:
+            mask = Varng(mask.type_as(truth).unsqueeze(1).expand_as(pred))
+            pred, target = pred * mask, target * mask
+        losses = self.loss_fn(pred, target, reduce=False).sum(2).sum(0)  # (bag_size,)
+        self._cached_input, self._cached_costs = None, None
+        return (losses * Varng(self.poisson_weights(truth))).sum()
+
+    forward_partial_complete = _update
@@ -15,6 +15,7 @@ import numpy as np
 
 import macarico
 from macarico import util, CostSensitivePolicy
+import macarico.sampling as sampling
 
 class SoftmaxPolicy(macarico.StochasticPolicy):
     def __init__(self, features, n_actions, temperature=1.0):
@@ -22,25 +23,54 @@ class SoftmaxPolicy(macarico.StochasticPolicy):
         self.n_actions = n_actions
         self.features = features
         self.mapping = nn.Linear(features.dim, n_actions)
-        self.disallow = torch.zeros(n_actions)
         self.temperature = temperature
 
     def forward(self, state):
         fts = self.features(state)
         z = self.mapping(fts).squeeze().data
         #print('pol', z.numpy(), util.argmin(z, state.actions), state.actions)
-        return util.argmin(z, state.actions)
+        if state.actions is None or len(state.actions) == self.n_actions:
+            return util.argmin(z)
+        return util.argmin(z, state.action_mask())
+
+    def trajectory_independent(self):
+        return isinstance(self.features, macarico.Actor) and self.features.trajectory_independent()
+
+    def predict_costs_sequence(self, env):
+        # (T, n_actions) scores for every state, as one matmul
+        if not (env.TRAJECTORY_INDEPENDENT and self.trajectory_independent()):
+            raise NotImplementedError('policy is not trajectory independent')
+        return self.mapping(self.features.forward_all(env))
+
+    def forward_sequence(self, env):
+        z = self.predict_costs_sequence(env).data
+        for t, state in enumerate(env.states()):
+            if state.actions is None or len(state.actions) == self.n_actions:
+                a = util.argmin(z[t])
+            else:
+                a = util.argmin(z[t], state.action_mask())
+            state._trajectory.append(a)
+        return env._trajectory
 
     def stochastic(self, state):
-        z = self.mapping(self.features(state)).squeeze()
-        if len(state.actions) != self.n_actions:
-            self.disallow.zero_()
-            self.disallow += 1e10
-            for a in state.actions:
-                self.disallow[a] = 0.
-            z += Varng(self.disallow)
-        p = F.softmax(-z / self.temperature, dim=0)
-        return util.sample_from_probs(p)
+        a, log_p = self.log_stochastic(state)
+        return a, log_p.exp()
+
+    def log_stochastic(self, state):
+        z = self.mapping(self.features(state)).view(-1)
+        mask = None if state.actions is None or len(state.actions) == self.n_actions else \
+               state.action_mask()
+        a, log_p, _ = sampling.sample_costs(z, mask, self.temperature)
+        return a.item(), log_p
+
+    def stochastic_vector(self, venv):
+        a, log_p = self.log_stochastic_vector(venv)
+        return a, log_p.exp()
+
+    def log_stochastic_vector(self, venv):
+        z = self.mapping(self.features(venv))
+        a, log_p, _ = sampling.sample_costs(z, None, self.temperature)
+        return a, log_p
 
 def truth_to_vec(truth, tmp_vec):
     if isinstance(truth, torch.FloatTensor):
@@ -73,22 +103,40 @@ class CSOAAPolicy(SoftmaxPolicy, CostSensitivePolicy):
         return self.mapping(self.features(state)).squeeze()
 
     def _compute_loss(self, loss_fn, pred_costs, truth, state_actions):
-        if len(state_actions) == self.n_actions:
+        if state_actions is None or len(state_actions) == self.n_actions:
             return loss_fn(pred_costs, Varng(truth))
-        return sum((loss_fn(pred_costs[a], Varng(torch.zeros(1) + truth[a])) \
-                    for a in state_actions))
+        state_actions = list(state_actions)
+        idx = util.longtensor(pred_costs, state_actions)
+        return loss_fn(pred_costs.index_select(0, Varng(idx)),
+                       Varng(truth.index_select(0, util.longtensor(truth, state_actions))))
     
     def _update(self, pred_costs, truth, actions=None):
         truth = truth_to_vec(truth, torch.zeros(self.n_actions))
         #print('update', truth.numpy(), pred_costs.data.numpy(), actions)
         return self._compute_loss(self.loss_fn, pred_costs, truth, actions)
 
+    def _update_trajectory(self, pred_costs, truths, actions):
+        pred = torch.stack(pred_costs)
+        truth = util.zeros(pred, len(truths), self.n_actions)
+        tmp_vec = torch.zeros(self.n_actions)
+        for t, y in enumerate(truths):
+            truth[t] = truth_to_vec(y, tmp_vec)
+        return self._update_batch(pred, truth, util.actions_to_mask(pred, actions, self.n_actions))
+
+    def _update_batch(self, pred_costs, costs, mask):
+        if mask is None:
+            return self.loss_fn(pred_costs, Varng(costs))
+        # disallowed entries become loss(0, 0) = 0
+        mask = Varng(mask.type_as(costs))
+        return self.loss_fn(pred_costs * mask, Varng(costs) * mask)
+
 class WMCPolicy(CSOAAPolicy):
     def __init__(self, features, n_actions, loss_fn='hinge', temperature=1.0):
         CSOAAPolicy.__init__(self, features, n_actions, loss_fn, temperature)
         
     def set_loss(self, loss_fn):
         assert loss_fn in ['multinomial', 'hinge', 'squared', 'huber']
+        self.loss_type = loss_fn
         if loss_fn == 'hinge':
             l = nn.MultiMarginLoss(size_average=False)
             self.loss_fn = lambda p, t, _: l(p, Varng(torch.LongTensor([t])))
@@ -118,4 +166,62 @@ class WMCPolicy(CSOAAPolicy):
         return sum((w[a] * self.loss_fn(pred_costs, a, actions) \
                     for a in actions \
                     if w[a] > 1e-6))
-            
+
+    def _update_trajectory(self, pred_costs, truths, actions):
+        K = self.n_actions
+        pred = -torch.stack(pred_costs)
+        T = pred.shape[0]
+        mask = util.actions_to_mask(pred, actions, K)
+        if mask is None:
+            mask = util.zeros(pred, T, K).fill_(1)
+
+        # W[t,a] is the weight on loss_fn(pred[t], a), exactly as in _update
+        W = util.zeros(pred, T, K)
+        cost_rows = []
+        for t, (y, acts) in enumerate(zip(truths, actions)):
+            if isinstance(y, int): y = [y]
+            if isinstance(y, list) or isinstance(y, set):
+                for a in y: W[t,a] += 1
+            elif acts is not None and len(acts) == 1:
+                W[t,list(acts)[0]] = 1
+            else:
+                assert isinstance(y, torch.FloatTensor)
+                cost_rows.append(t)
+        if len(cost_rows) > 0:
+            rows = util.longtensor(pred, cost_rows)
+            C = torch.stack([truths[t] for t in cost_rows]).type_as(W)
+            W.index_copy_(0, rows, self._cost_weights(C, mask.index_select(0, rows)))
+        return self._weighted_loss(pred, W, mask)
+
+    def _cost_weights(self, C, m):
+        # the weights _update puts on each allowed action of cost vectors C
+        w = (C * m).sum(1, keepdim=True) / (m.sum(1, keepdim=True) - 1).clamp(min=1) - C
+        w -= w.min(1, keepdim=True)[0]
+        return w * m * (w > 1e-6).type_as(w)
+
+    def _update_batch(self, pred_costs, costs, mask):
+        pred = -pred_costs
+        T, K = pred.shape
+        mask = util.zeros(costs, T, K).fill_(1) if mask is None else mask.type_as(costs)
+        W = self._cost_weights(costs, mask)
+        # a single allowed action is always the target
+        single = (mask.sum(1, keepdim=True) == 1).type_as(W)
+        W = single * mask + (1 - single) * W
+        return self._weighted_loss(pred, W, mask)
+
+    def _weighted_loss(self, pred, W, mask):
+        # sum_t,a W[t,a] * loss_fn(pred[t], a), for negated costs pred
+        K = self.n_actions
+        eye = util.zeros(pred, K, K)
+        for a in range(K): eye[a,a] = 1
+        if self.loss_type == 'hinge':
+            margins = (1 - pred.unsqueeze(2) + pred.unsqueeze(1)).clamp(min=0)
+            L = (margins * Varng(1 - eye).unsqueeze(0)).sum(2) / K
+        elif self.loss_type == 'multinomial':
+            L = -F.log_softmax(pred, dim=1)
+        else: # squared or huber against a one-hot target, over allowed actions
+            D = pred.unsqueeze(1) - Varng(eye).unsqueeze(0)
+            E = D * D if self.loss_type == 'squared' else \
+                torch.where(D.abs() < 1, 0.5 * D * D, D.abs() - 0.5)
+            L = (E * Varng(mask).unsqueeze(1)).sum(2)
+        return (Varng(W) * L).sum()
@@ -0,0 +1,160 @@
+"""
+Lightweight instrumentation of macarico's hot paths. Everything is off
+by default; when disabled the only cost is checking
+`profiler.enabled`. Calls to policies are timed by forward hooks that
+exist only while a policy is watched. Typical use:
+
+    import macarico.profiling as profiling
+    profiling.enable(record_trace=True, model=policy)
+    ... run episodes / TrainLoop(..., profile=True) ...
+    print(profiling.profiler.report())
+    profiling.profiler.dump_chrome_trace('trace.json')  # chrome://tracing
+    profiling.disable()
+
+Timings are inclusive (a policy call includes its actor call, etc.).
+"""
+from __future__ import division, generators, print_function
+
+import json
+import time
+from collections import defaultdict
+
+class Profiler(object):
+    def __init__(self):
+        self.enabled = False
+        self.record_trace = False
+        self.max_events = 1000000
+        self._hooks = []
+        self.reset()
+
+    def reset(self):
+        self.time = defaultdict(float)   # name -> total wall time (s)
+        self.calls = defaultdict(int)    # name -> number of calls
+        self.allocs = defaultdict(int)   # name -> number of tensor allocations
+        self.hits = defaultdict(int)     # name -> cache hits
+        self.misses = defaultdict(int)   # name -> cache misses
+        self.minibatches = []            # one summary() per minibatch
+        self.events = []                 # (name, start, end) for chrome traces
+        self._last = self._snapshot()
+        self._origin = time.perf_counter()
+
+    def start(self):
+        return time.perf_counter()
+
+    def stop(self, name, t0):
+        t1 = time.perf_counter()
+        self.time[name] += t1 - t0
+        self.calls[name] += 1
+        if self.record_trace and len(self.events) < self.max_events:
+            self.events.append((name, t0, t1))
+
+    def alloc(self, name, n=1):
+        self.allocs[name] += n
+
+    def hit(self, name):
+        self.hits[name] += 1
+
+    def miss(self, name):
+        self.misses[name] += 1
+
+    def section(self, name):
+        return _Section(self, name)
+
+    def watch(self, model):
+        r"""Time every call to a `Policy` in `model`'s module tree (as
+        '<type>.__call__') with forward hooks, until `unwatch`."""
+        from macarico.base import Policy
+        for module in model.modules():
+            if isinstance(module, Policy):
+                name = '%s.__call__' % type(module).__name__
+                starts = []  # a stack, as policies may be called recursively
+                def pre(_module, _input, starts=starts):
+                    starts.append(self.start() if self.enabled else None)
+                def post(_module, _input, _output, starts=starts, name=name):
+                    t0 = starts.pop() if len(starts) > 0 else None
+                    if t0 is not None: self.stop(name, t0)
+                self._hooks.append(module.register_forward_pre_hook(pre))
+                self._hooks.append(module.register_forward_hook(post))
+
+    def unwatch(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+    def _snapshot(self):
+        return (dict(self.time), dict(self.calls), dict(self.allocs),
+                dict(self.hits), dict(self.misses))
+
+    def new_minibatch(self):
+        "close off the current minibatch, recording its (delta) summary"
+        cur = self._snapshot()
+        delta = [{k: v - last.get(k, 0) for k, v in now.items() if v != last.get(k, 0)} \
+                 for now, last in zip(cur, self._last)]
+        self.minibatches.append(dict(zip(['time', 'calls', 'allocs', 'hits', 'misses'], delta)))
+        self._last = cur
+
+    def hit_rate(self, name):
+        n = self.hits[name] + self.misses[name]
+        return self.hits[name] / n if n > 0 else float('nan')
+
+    def summary(self):
+        return { 'time': dict(self.time),
+                 'calls': dict(self.calls),
+                 'allocs': dict(self.allocs),
+                 'hit_rate': { k: self.hit_rate(k) for k in set(self.hits) | set(self.misses) },
+                 'n_minibatches': len(self.minibatches) }
+
+    def report(self, top=None):
+        names = sorted(self.time.keys(), key=lambda k: -self.time[k])
+        if top is not None: names = names[:top]
+        s = '%-40s %10s %10s %12s\n' % ('component', 'time(s)', 'calls', 'us/call')
+        for name in names:
+            s += '%-40s %10.4f %10d %12.2f\n' % \
+                 (name, self.time[name], self.calls[name], 1e6 * self.time[name] / max(1, self.calls[name]))
+        for name in sorted(set(self.hits) | set(self.misses)):
+            s += '%-40s hit rate %6.2f%% (%d/%d)\n' % \
+                 (name, 100 * self.hit_rate(name), self.hits[name], self.hits[name] + self.misses[name])
+        for name in sorted(self.allocs.keys()):
+            s += '%-40s %d tensor allocations\n' % (name, self.allocs[name])
+        return s
+
+    def short_report(self, top=3):
+        total = sum(self.time.values())
+        names = sorted(self.time.keys(), key=lambda k: -self.time[k])[:top]
+        return '  '.join(('%s=%.0f%%' % (name, 100 * self.time[name] / max(total, 1e-12)) for name in names))
+
+    def dump_chrome_trace(self, filename):
+        events = [{ 'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+                    'ts': 1e6 * (t0 - self._origin), 'dur': 1e6 * (t1 - t0) } \
+                  for name, t0, t1 in self.events]
+        with open(filename, 'w') as h:
+            json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, h)
+
+class _Section(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.t0 = None
+
+    def __enter__(self):
+        if self.profiler.enabled:
+            self.t0 = self.profiler.start()
+        return self
+
+    def __exit__(self, *args):
+        if self.t0 is not None:
+            self.profiler.stop(self.name, self.t0)
+            self.t0 = None
+        return False
+
+profiler = Profiler()
+
+def enable(record_trace=False, model=None):
+    profiler.enabled = True
+    profiler.record_trace = record_trace
+    if model is not None:
+        profiler.watch(model)
+
+def disable():
+    profiler.enabled = False
+    profiler.unwatch()
@@ -0,0 +1,68 @@
+"""
+Vectorized categorical sampling for stochastic policies and
+exploration. Every function takes either a single distribution (a
+vector over actions) or a batch of them (a (B, n_actions) matrix, one
+row per state), and returns actions as a LongTensor (0-dim for a
+single distribution, (B,) for a batch) together with the probability
+or log-probability of each sampled action, gathered from the input so
+that gradients flow through it.
+
+Masks are ByteTensors that are 1 for allowed actions (see
+`Env.action_mask`); a single mask of size n_actions is shared by every
+row of a batch.
+"""
+
+from __future__ import division, generators, print_function
+
+import torch
+import torch.nn.functional as F
+
+def _expand_mask(mask, x):
+    if mask.dim() < x.dim():
+        mask = mask.view(1, -1).expand_as(x)
+    return mask
+
+def log_probs(costs, mask=None, temperature=1.0):
+    r"""Log-probabilities of the Boltzmann distribution
+    softmax(-costs / temperature) over the last dimension; disallowed
+    actions get (numerically) zero probability."""
+    if mask is not None:
+        costs = costs.masked_fill(_expand_mask(mask, costs) == 0, 1e10)
+    return F.log_softmax(-costs / temperature, dim=-1)
+
+def _draw(weights):
+    # one index per row of (B, K) non-negative, not necessarily
+    # normalized weights
+    return torch.multinomial(weights, 1)
+
+def sample(probs, mask=None):
+    r"""Sample from `probs` (rows need not be normalized) restricted to
+    `mask`; returns `(actions, p(actions))`, where the probabilities
+    are renormalized over the allowed actions."""
+    single = probs.dim() == 1
+    P = probs.view(1, -1) if single else probs
+    if mask is not None:
+        P = P * _expand_mask(mask.view(1, -1) if single else mask, P).type_as(P)
+    P = P / P.sum(1, keepdim=True)
+    a = _draw(P.data)
+    p = P.gather(1, a).view(-1)
+    a = a.view(-1)
+    return (a[0], p[0]) if single else (a, p)
+
+def sample_log_probs(log_p):
+    r"""Sample from normalized log-probabilities `log_p`; returns
+    `(actions, log p(actions))`."""
+    single = log_p.dim() == 1
+    L = log_p.view(1, -1) if single else log_p
+    a = _draw(L.data.exp())
+    lp = L.gather(1, a).view(-1)
+    a = a.view(-1)
+    return (a[0], lp[0]) if single else (a, lp)
+
+def sample_costs(costs, mask=None, temperature=1.0):
+    r"""Sample from the Boltzmann distribution over `costs` (see
+    `log_probs`); returns `(actions, log p(actions), log p)` where the
+    last is the full (..., n_actions) matrix of log-probabilities."""
+    log_p = log_probs(costs, mask, temperature)
+    a, lp = sample_log_probs(log_p)
+    return a, lp, log_p
@@ -83,3 +83,52 @@ class CartPoleFeatures(macarico.DynamicFeatures):
 
     def _forward(self, state):
         return Var(state.state.view(1,1,-1), requires_grad=False)
+
+
+class VecCartPoleEnv(macarico.VectorEnv):
+    "`n_envs` copies of `CartPoleEnv`, each costing -1 per step survived"
+    def __init__(self, n_envs, T=200):
+        macarico.VectorEnv.__init__(self, n_envs, 2, T)
+        single = CartPoleEnv()
+        for name in ['gravity', 'masscart', 'masspole', 'total_mass', 'length',
+                     'polemass_length', 'force_mag', 'tau',
+                     'theta_threshold_radians', 'x_threshold']:
+            setattr(self, name, getattr(single, name))
+        self.state = torch.zeros(n_envs, 4)
+        self.reset()
+
+    def _reset(self, mask):
+        fresh = torch.rand(self.n_envs, 4) * 0.1 - 0.05
+        self.state = torch.where(mask.view(-1, 1).expand_as(self.state), fresh, self.state)
+
+    def _step(self, actions):
+        # state is replaced rather than updated in place, since features
+        # computed from the previous state may still be needed by autograd
+        x, x_dot, theta, theta_dot = self.state.t()
+        force = (actions.float() * 2 - 1) * self.force_mag
+        costheta = torch.cos(theta)
+        sintheta = torch.sin(theta)
+        temp = (force + self.polemass_length * theta_dot * theta_dot * sintheta) / self.total_mass
+        thetaacc = (self.gravity * sintheta - costheta * temp) / (self.length * (4.0/3.0 - self.masspole * costheta * costheta / self.total_mass))
+        xacc = temp - self.polemass_length * thetaacc * costheta / self.total_mass
+        x = x + self.tau * x_dot
+        x_dot = x_dot + self.tau * xacc
+        theta = theta + self.tau * theta_dot
+        theta_dot = theta_dot + self.tau * thetaacc
+        self.state = torch.stack([x, x_dot, theta, theta_dot], dim=1)
+        done = (x < -self.x_threshold) | \
+               (x > self.x_threshold) | \
+               (theta < -self.theta_threshold_radians) | \
+               (theta > self.theta_threshold_radians)
+        costs = self.state.new(self.n_envs).fill_(-1.)
+        return costs, done
+
+
+class VecCartPoleFeatures(nn.Module):
+    "batched version of `CartPoleFeatures` for a `VecCartPoleEnv`; returns (n_envs, 4)"
+    def __init__(self):
+        nn.Module.__init__(self)
+        self.dim = 4
+
+    def forward(self, venv):
+        return Var(venv.state, requires_grad=False)
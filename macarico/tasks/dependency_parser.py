@@ -5,6 +5,34 @@ import torch
 import macarico
 from macarico.data.types import DependencyTree
 
+_transition_masks = {}
+def transition_masks(n_transitions, n_actions):
+    # one (shared, read-only) action mask for each subset of transitions
+    if n_actions not in _transition_masks:
+        masks = []
+        for bits in range(1 << n_transitions):
+            mask = torch.zeros(n_actions).byte()
+            for a in range(n_transitions):
+                if bits & (1 << a): mask[a] = 1
+            masks.append(mask)
+        _transition_masks[n_actions] = masks
+    return _transition_masks[n_actions]
+
+def gold_structure(example):
+    # (gold_heads, gold_deps) of example, computed once and kept on it
+    gold = getattr(example, '_gold_structure', None)
+    if gold is None:
+        gold_heads = {}
+        gold_deps = defaultdict(list)
+        if example.Y is not None:
+            for dep in range(example.N):
+                head, _ = example.Y[dep]
+                gold_heads[dep] = head
+                gold_deps[head].append(dep)
+        gold = (gold_heads, gold_deps)
+        example._gold_structure = gold
+    return gold
+
 class DependencyParser(macarico.Env):
     """
     A greedy transition-based parser, based heavily on
@@ -17,6 +45,7 @@ class DependencyParser(macarico.Env):
     """
 
     SHIFT, RIGHT, LEFT, N_ACT = 0, 1, 2, 3
+    DETERMINISTIC = True
 
     def __init__(self, example):
         self.n_rels = example.n_rels
@@ -28,18 +57,7 @@ class DependencyParser(macarico.Env):
         self.X = example.X
         self.tags = example.tags
         self.N = example.N
-
-        self.gold_heads = {}
-        self.gold_deps = defaultdict(lambda: [])
-        if self.example.Y is not None:
-            for dep in range(self.N):
-                head, _ = self.example.Y[dep]
-                self.gold_heads[dep] = head
-                if head not in self.gold_deps:
-                    self.gold_deps[head] = []
-                self.gold_deps[head].append(dep)
-        #print 'gold_heads =', self.gold_heads
-        #print 'gold_deps  =', self.gold_deps
+        self.gold_heads, self.gold_deps = gold_structure(example)
 
         self.root = self.N
         self.b = 0   # invariant: buf = [b, b+1, ..., N]
@@ -51,6 +69,9 @@ class DependencyParser(macarico.Env):
         self.is_rel = None       # used to indicate whether the action type is a label action or not.
         if self.n_rels > 0:
             self.valid_rels = set(range(self.N_ACT, self.N_ACT+self.n_rels))
+            self.valid_rels_mask = torch.zeros(self.n_actions).byte()
+            self.valid_rels_mask[self.N_ACT:] = 1
+        self.transition_masks = transition_masks(self.N_ACT, self.n_actions)
             
     def _rewind(self):
         #print '\n-------------------'
@@ -60,6 +81,17 @@ class DependencyParser(macarico.Env):
         self.Yhat = DependencyTree(self.N, self.n_rels > 0)
         self.actions = None
 
+    def _reset(self, example):
+        assert example.n_rels == self.n_rels
+        self.T = 2 * example.N * (1 if self.n_rels == 0 else 2)
+        self.X = example.X
+        self.tags = example.tags
+        self.N = example.N
+        self.gold_heads, self.gold_deps = gold_structure(example)
+        self.root = self.N
+        # Yhat isn't reused: it becomes example.Yhat
+        self._rewind()
+
     def __str__(self):
         return 'stack = %s\nb     = %d\narcs  = %s' % (self.stack, self.b, self.Yhat)
             #print 'stack = %s\tbuf = %s' % (self.stack, self.b)
@@ -77,6 +109,7 @@ class DependencyParser(macarico.Env):
             # get shift/reduce action
             self.is_rel = False
             self.actions = self.get_valid_transitions()
+            self.set_action_mask(self.transition_masks[sum((1 << a for a in self.actions))])
             #print 'actions = %s' % self.actions
             self.a = policy(self)
             #print('stack = %s\tbuf = %s\tactions = %s\ta = %d' % (self.stack, self.b, self.actions, self.a))
@@ -93,6 +126,7 @@ class DependencyParser(macarico.Env):
             if self.n_rels > 0 and self.a != self.SHIFT:
                 self.is_rel = True
                 self.actions = self.valid_rels
+                self.set_action_mask(self.valid_rels_mask)
                 rel = policy(self)
                 assert rel is not None
                 #if rel is None:   # timv: @hal3 why will this ever be None?
@@ -28,6 +28,11 @@ class Hex(macarico.Env):
         self.state *= 0
         self.state[2,:,:] = 1.0
         self.to_play = Hex.BLACK
+
+    def _reset(self, example):
+        # games make their own example; the board is reused
+        self.example = macarico.Example()
+        self.example.reward = 0
     
     def _run_episode(self, policy):
         if self.player_color != self.to_play:
@@ -39,7 +44,8 @@ class Hex(macarico.Env):
         self.example.reward = 0
             
         for _ in range(self.horizon()):
-            self.actions = get_possible_actions(self.state)
+            self.actions, mask = possible_actions(self.state, self.n_actions)
+            self.set_action_mask(mask)
             a = policy(self)
             if resign_move(self.board_size, a):
                 self.example.reward = -1
@@ -81,6 +87,12 @@ def action_to_coord(board, a):
 def get_possible_actions(board):
     free_x, free_y = np.where(board[2,:,:].numpy() == 1)
     return [coord_to_action(board, [x,y]) for x, y in zip(free_x, free_y)]
+def possible_actions(board, n_actions):
+    # same as get_possible_actions, together with its mask, both read
+    # off the board once; the last action (resign) is never listed
+    mask = torch.zeros(n_actions).byte()
+    mask[:-1] = board[2,:,:].contiguous().view(-1) == 1
+    return mask.nonzero().view(-1).tolist(), mask
 def game_finished(board):
     d = board.shape[1]
     inpath = set()
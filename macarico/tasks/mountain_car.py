@@ -68,3 +68,41 @@ class MountainCarFeatures(macarico.DynamicFeatures):
 
     def _forward(self, state):
         return Var(state.state.view(1,1,-1))
+
+
+class VecMountainCar(macarico.VectorEnv):
+    "`n_envs` copies of `MountainCar`, each costing 1 per step until the goal"
+    def __init__(self, n_envs, T=2000):
+        macarico.VectorEnv.__init__(self, n_envs, 3, T)
+        self.min_position = -1.2
+        self.max_position = 0.6
+        self.max_speed = 0.07
+        self.goal_position = 0.5
+        self.state = torch.zeros(n_envs, 2)
+        self.reset()
+
+    def _reset(self, mask):
+        fresh = torch.rand(self.n_envs, 2) - 0.6
+        fresh[:,1] = 0
+        self.state = torch.where(mask.view(-1, 1).expand_as(self.state), fresh, self.state)
+
+    def _step(self, actions):
+        position, velocity = self.state.t()
+        velocity = velocity + (actions.float() - 1) * 0.001 + torch.cos(3 * position) * (-0.0025)
+        velocity = velocity.clamp(-self.max_speed, self.max_speed)
+        position = (position + velocity).clamp(self.min_position, self.max_position)
+        velocity = velocity.masked_fill((position <= self.min_position) & (velocity < 0), 0.)
+        self.state = torch.stack([position, velocity], dim=1)
+        done = position >= self.goal_position
+        costs = self.state.new(self.n_envs).fill_(1.)
+        return costs, done
+
+
+class VecMountainCarFeatures(nn.Module):
+    "batched version of `MountainCarFeatures` for a `VecMountainCar`; returns (n_envs, 2)"
+    def __init__(self):
+        nn.Module.__init__(self)
+        self.dim = 2
+
+    def forward(self, venv):
+        return Var(venv.state, requires_grad=False)
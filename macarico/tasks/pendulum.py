@@ -71,3 +71,49 @@ class PendulumFeatures(macarico.DynamicFeatures):
         view[0,0,2] = np.sin(state.th)
         view[0,0,3] = state.th_dot
         return Varng(view)
+
+
+class VecPendulum(macarico.VectorEnv):
+    r"""`n_envs` copies of `Pendulum`. The cost of each step is the
+    `Pendulum` cost divided by T, so that an episode's total cost
+    matches `PendulumLoss`."""
+    def __init__(self, n_envs, T=100):
+        self.granularity = 0.1
+        self.action_torques = torch.arange(-2, 2+self.granularity/2, self.granularity)
+        macarico.VectorEnv.__init__(self, n_envs, len(self.action_torques), T)
+        self.max_speed = 8
+        self.max_torque = 2.
+        self.dt = 0.01
+        self.th = torch.zeros(n_envs)
+        self.th_dot = torch.zeros(n_envs)
+        self.reset()
+
+    def _reset(self, mask):
+        fresh_th = torch.rand(self.n_envs) * (2 * np.pi) - np.pi
+        fresh_th_dot = torch.rand(self.n_envs) * 2 - 1
+        self.th = torch.where(mask, fresh_th, self.th)
+        self.th_dot = torch.where(mask, fresh_th_dot, self.th_dot)
+
+    def _step(self, actions):
+        g, m, l = 10., 1., 1.
+        u = self.action_torques.index_select(0, actions)
+        costs = (torch.remainder(self.th + np.pi, 2*np.pi) - np.pi) ** 2 + .1 * self.th_dot ** 2 + 0.001 * (u**2)
+        new_th_dot = self.th_dot + self.dt * \
+                     (-3*g/(2*l) * torch.sin(self.th + np.pi) + 3./(m*l**2)*u)
+        self.th = self.th + new_th_dot * self.dt
+        self.th_dot = new_th_dot.clamp(-self.max_speed, self.max_speed)
+        return costs / self.T, torch.zeros(self.n_envs).byte()
+
+
+class VecPendulumFeatures(nn.Module):
+    "batched version of `PendulumFeatures` for a `VecPendulum`; returns (n_envs, 4)"
+    def __init__(self):
+        nn.Module.__init__(self)
+        self.dim = 4
+
+    def forward(self, venv):
+        # one (n_envs, 4) allocation per step for all envs
+        return Varng(torch.stack([torch.ones(venv.n_envs),
+                                  torch.cos(venv.th),
+                                  torch.sin(venv.th),
+                                  venv.th_dot], dim=1))
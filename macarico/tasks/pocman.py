@@ -171,6 +171,13 @@ class POCMAN(macarico.Env):
         self.example.total_reward = 0
         return self
 
+    def _reset(self, example):
+        # games make their own example; the maze is reused
+        self.example = macarico.Example()
+        self.example.total_reward = 0
+        self.total_reward = 0
+        self.obs = [0]
+
     def _run_episode(self, policy, print_it=False):
         self._rewind()
         self.obs = [self.make_observations()]
@@ -8,6 +8,8 @@ class SequenceLabeler(macarico.Env):
     length). Loss is evaluated with Hamming distance, which has an optimal
     reference policy.
     """
+    TRAJECTORY_INDEPENDENT = True
+    DETERMINISTIC = True
 
     def __init__(self, example):
         self.N = example.N
@@ -23,6 +25,18 @@ class SequenceLabeler(macarico.Env):
     def _rewind(self):
         pass
 
+    def _reset(self, example):
+        self.N = example.N
+        self.T = example.N
+        self.X = example.X
+        if self.n_actions != example.n_labels:
+            self.n_actions = example.n_labels
+            self.actions = set(range(example.n_labels))
+
+    def states(self):
+        for self.n in range(self.horizon()):
+            yield self
+
 
 class HammingLossReference(macarico.Reference):
     def __call__(self, state):
@@ -33,6 +47,9 @@ class HammingLossReference(macarico.Reference):
         cost_vector += 1
         cost_vector[state.example.Y[state.n]] = 0.
 
+    def known_trajectory(self, example):
+        return list(map(int, example.Y))
+
 class HammingLoss(macarico.Loss):
     def __init__(self, Yname=None, Yhatname=None):
         self.Yname = Yname
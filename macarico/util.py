@@ -14,6 +14,8 @@ import random as py_random
 
 from macarico.lts.lols import EpisodeRunner, one_step_deviation
 from macarico.annealing import Averaging
+from macarico.profiling import profiler
+import macarico.sampling as sampling
 
 
 # helpful functions
@@ -30,28 +32,91 @@ def getnew(param):
         None
 
 def zeros(param, *dims):
+    if profiler.enabled: profiler.alloc('util.zeros')
     return getnew(param)(*dims).zero_()
 
 def longtensor(param, *dims):
+    if profiler.enabled: profiler.alloc('util.longtensor')
     return getnew(param)(*dims).long()
 
 def onehot(param, i):
     return Varng(longtensor(param, [int(i)]))
 
+def actions_to_mask(param, actions, n_actions):
+    r"""Turn a list of T allowed-action collections (or per-step action
+    masks, see `Env.action_mask`) into a (T, n_actions) 0/1 mask of the
+    same type as `param`, or None if every action is allowed at every
+    step. An entry of None means "all allowed"."""
+    if all((acts is None or (not torch.is_tensor(acts) and len(acts) == n_actions) \
+            for acts in actions)):
+        return None
+    mask = zeros(param, len(actions), n_actions)
+    for t, acts in enumerate(actions):
+        if torch.is_tensor(acts):
+            mask[t].copy_(acts)
+        elif acts is None or len(acts) == n_actions:
+            mask[t].fill_(1)
+        elif len(acts) > 0:
+            mask[t].index_fill_(0, longtensor(param, list(acts)), 1)
+    return mask
+
+def masked_fill_disallowed(vec, mask, value=float('inf')):
+    "`vec` with every entry whose `mask` is 0 replaced by `value`"
+    if isinstance(mask, Var): mask = mask.data
+    return vec.masked_fill(mask == 0, value)
+
 def argmin(vec, allowed=None, dim=0):
+    r"""Index of the smallest element of `vec` (a vector, or a 1xK or
+    1x1xK tensor for dim=1, 2) among `allowed`, which is either a
+    collection of actions or an action mask (see `Env.action_mask`)."""
     if isinstance(vec, Var): vec = vec.data
-    if allowed is None or len(allowed) == 0 or len(allowed) == vec.shape[dim]:
-        return vec.min(dim)[1].item()
-    i = None
-    for a in allowed:
-        if i is None or \
-           (dim == 0 and vec[a] < vec[i]) or \
-           (dim == 1 and vec[0,a] < vec[0,i]) or \
-           (dim == 2 and vec[0,0,a] < vec[0,0,i]):
-            i = a
-    return i
+    if dim > 0: vec = vec.contiguous().view(-1)
+    if allowed is None:
+        return vec.min(0)[1].item()
+    if torch.is_tensor(allowed):
+        return masked_fill_disallowed(vec, allowed).min(0)[1].item()
+    if len(allowed) == 0 or len(allowed) == vec.shape[0]:
+        return vec.min(0)[1].item()
+    allowed = list(allowed)
+    return allowed[vec.index_select(0, longtensor(vec, allowed)).min(0)[1].item()]
            
 
+def costs_to_go(costs, done, gamma=1.0, bootstrap=None):
+    r"""Discounted sum of the remaining costs of each episode, for a
+    (T, n_envs) rollout of a `VectorEnv`, where `done[t]` marks the
+    last step of an episode. Episodes still running after step T-1 are
+    continued with `bootstrap` (eg, value estimates of the current
+    states) if given, else cut off."""
+    if bootstrap is None:
+        running = costs.new(costs.shape[1]).zero_()
+    else:
+        running = bootstrap.clone()
+    out = costs.new(costs.shape)
+    not_done = 1 - done.type_as(costs)
+    for t in range(costs.shape[0]-1, -1, -1):
+        running = costs[t] + gamma * not_done[t] * running
+        out[t] = running
+    return out
+
+def generalized_advantages(costs, values, done, gamma=1.0, lam=1.0, bootstrap=None):
+    r"""GAE(gamma, lambda) advantages for (T, n_envs) tensors of costs
+    and value estimates, where `done[t]` marks the last step of an
+    episode and `bootstrap` (n_envs) is the value of the states after
+    step T-1 (zero if None). Since these are costs, a positive
+    advantage means the action did worse than expected. Returns the
+    advantages and the corresponding value targets; with gamma=lam=1
+    the targets are just `costs_to_go`."""
+    not_done = 1 - done.type_as(costs)
+    next_value = costs.new(costs.shape[1]).zero_() if bootstrap is None else bootstrap
+    running = costs.new(costs.shape[1]).zero_()
+    advantages = costs.new(costs.shape)
+    for t in range(costs.shape[0]-1, -1, -1):
+        delta = costs[t] + gamma * not_done[t] * next_value - values[t]
+        running = delta + gamma * lam * not_done[t] * running
+        advantages[t] = running
+        next_value = values[t]
+    return advantages, advantages + values
+
 def getattr_deep(obj, field):
     for f in field.split('.'):
         obj = getattr(obj, f)
@@ -65,31 +130,74 @@ def reseed(seed=90210, gpu_id=None):
         torch.cuda.manual_seed(seed)
     np.random.seed(seed)
 
-def break_ties_by_policy(reference, policy, state, force_advance_policy=True):
-    costs = torch.zeros(state.n_actions)
-    set_costs = False
-    try:
-        reference.set_min_costs_to_go(state, costs)
-        set_costs = True
-    except NotImplementedError:
-        pass
-    if not set_costs:
+def trains_features(policy):
+    r"""Does `policy.features` (or anything it reads from) have
+    parameters that an optimizer would update?"""
+    return any((p.requires_grad for name, p in policy.features.named_parameters() \
+                if not name.endswith('_typememory.param')))
+
+def break_ties_by_policy(reference, policy, state, force_advance_policy=True, pred_costs=None, ref_costs=None):
+    r"""The reference's action at `state`, breaking ties between its
+    minimum-cost actions the way `policy` would. Pass the `pred_costs`
+    already predicted for this state (and optionally the reference's
+    `ref_costs`) to have the policy choose among the tied actions with
+    `costs_to_action` rather than run again."""
+    costs = ref_costs
+    if costs is None:
+        costs = torch.zeros(state.n_actions)
+        try:
+            reference.set_min_costs_to_go(state, costs)
+        except NotImplementedError:
+            costs = None
+    if costs is None:
         ref = reference(state)
-        if force_advance_policy:
+        if force_advance_policy and pred_costs is None:
             policy(state)
         return ref
     # otherwise we successfully got costs
     old_actions = state.actions
-    min_cost = min((costs[a] for a in old_actions))
-    state.actions = [a for a in old_actions if costs[a] <= min_cost]
-    a = policy(state)  # advances policy
-    #print costs, old_actions, state.actions, a
-    #a = state.actions[0]
+    allowed = state.action_mask()
+    costs = masked_fill_disallowed(costs, allowed)
+    min_cost = costs.min()
+    state.actions = (costs <= min_cost).nonzero().view(-1).tolist()
+    if pred_costs is None:
+        a = policy(state)  # advances policy
+    else:
+        a = policy.costs_to_action(state, pred_costs)
     assert a is not None, 'got action None in %s, costs=%s, old_actions=%s' % (state.actions, costs, old_actions)
     state.actions = old_actions
     return a
     
 
+class EnvPool(object):
+    r"""Makes the envs for a minibatch of examples, reusing the envs of
+    the previous minibatch through `Env.reset(example)` rather than
+    calling `mk_env` again, so an env's preallocated buffers survive
+    from one minibatch to the next. This assumes `mk_env` builds the
+    same kind of env for every example, and that nothing holds on to
+    an env once the next minibatch is requested. Envs that don't
+    support `reset` are simply constructed every time."""
+    def __init__(self, mk_env):
+        self.mk_env = mk_env
+        self.envs = []
+        self.can_reset = True
+
+    def __call__(self, examples):
+        envs = []
+        for i, example in enumerate(examples):
+            env = None
+            if self.can_reset and i < len(self.envs):
+                try:
+                    env = self.envs[i].reset(example)
+                except NotImplementedError:
+                    self.can_reset = False
+            if env is None:
+                env = self.mk_env(example)
+            envs.append(env)
+        if self.can_reset and len(envs) >= len(self.envs):
+            self.envs = envs
+        return envs
+
 def evaluate(mk_env, data, policy, losses, verbose=False):
     "Compute average `loss()` of `policy` on `data`"
     was_list = True
@@ -98,9 +206,10 @@ def evaluate(mk_env, data, policy, losses, verbose=False):
         was_list = False
     for loss in losses:
         loss.reset()
+    env_pool = EnvPool(mk_env)
     for example in data:
         policy.new_minibatch()
-        mk_env(example).run_episode(policy)
+        env_pool([example])[0].run_episode(policy)
         if verbose:
             print(example)
         for loss in losses:
@@ -153,6 +262,31 @@ def padto(s, l, right=False):
             s += ' ' * (l - n)
     return s
 
+def teacher_force(env, policy, actions):
+    r"""Prepare `policy`'s actors for an episode of `env` in which
+    `actions` are taken: run through `env` once with those actions,
+    recording only the actors' attention outputs, and then have each
+    actor compute its outputs for all steps at once (eg, one nn.LSTM
+    call instead of one LSTMCell call per step). The next episode on
+    this example replays them for as long as it follows `actions`.
+    Returns False if no actor can be teacher forced."""
+    actors = [m for m in policy.feature_graph().actors if m.can_teacher_force()]
+    if len(actors) == 0:
+        return False
+    env.rewind(policy)
+    for actor in actors:
+        actor.begin_teacher_force()
+    def record(state):
+        t = state.timestep()
+        assert t < len(actions), 'teacher forcing ran out of actions at t=%d' % t
+        for actor in actors:
+            actor.record_teacher_force(state)
+        return actions[t]
+    env.run_episode(record)
+    for actor in actors:
+        actor.end_teacher_force(env.example, actions)
+    return True
+
 class LearnerToAlg(macarico.LearningAlg):
     def __init__(self, learner, policy, loss):
         macarico.LearningAlg.__init__(self)
@@ -161,9 +295,13 @@ class LearnerToAlg(macarico.LearningAlg):
         self.loss = loss()
 
     def __call__(self, env):
-        #print('BEGIN __call__', type(self), type(self.learner))
-        env.rewind(self.policy)
-        env.run_episode(self.learner)
+        # start from fresh features, then keep them (and the teacher
+        # forced actor outputs) for the learner's episode
+        self.learner.new_example()
+        actions = self.learner.known_actions(env)
+        if actions is not None:
+            teacher_force(env, self.policy, actions)
+        env.run_episode(self.learner, keep_features=True)
         loss = self.loss.evaluate(env.example)
         obj = self.learner.get_objective(loss)
         #print('END __call__')
@@ -277,6 +415,9 @@ class ShortFormatter(object):
         if is_best: s += ' *'
         return s
 
+    def profile(self, profiler):
+        return '    profile: ' + profiler.short_report()
+
 class LongFormatter(object):
     def __init__(self, has_dev, losses, ex_width=None):
         self.start_time = time.time()
@@ -327,6 +468,9 @@ class LongFormatter(object):
                 s += ii + ' pred%d  %s\n' % (i, padto(out, None))
                 s += '\n'
         return s
+
+    def profile(self, profiler):
+        return '\nPROFILE\n' + profiler.report(top=20)
               
 class TrainLoop(object):
     def __init__(self,
@@ -351,6 +495,9 @@ class TrainLoop(object):
                  mk_formatter=ShortFormatter,
                  progress_bar=True,
                  checkpoint_per_batch=None, # int k = checkpoint after every k batches
+                 profile=False,    # time hot paths, see macarico.profiling
+                 profile_trace_to=None, # write a chrome://tracing file here at the end of train
+                 reuse_envs=True,  # reset envs on new examples instead of calling mk_env, see EnvPool
                 ):
         assert mk_env is not None, 'trainloop expects an mk_env'
         assert policy is not None, 'trainloop expects a policy'
@@ -363,6 +510,9 @@ class TrainLoop(object):
             print_it('warning: running bandit mode with n_epochs>1, this is weird!')
 
         self.mk_env = mk_env
+        self.env_pool = EnvPool(mk_env) if reuse_envs else \
+                        (lambda examples: [mk_env(example) for example in examples])
+        self.dev_env_pool = EnvPool(mk_env) if reuse_envs else self.env_pool
         self.policy = policy
         self.optimizer = optimizer
         self.losses = losses
@@ -382,6 +532,8 @@ class TrainLoop(object):
         self.mk_formatter = mk_formatter
         self.progress_bar = progress_bar
         self.checkpoint_per_batch = checkpoint_per_batch
+        self.profile = profile or (profile_trace_to is not None)
+        self.profile_trace_to = profile_trace_to
         self.learning_alg = learner if isinstance(learner, macarico.LearningAlg) else \
                             LearnerToAlg(learner, policy, losses[0])
         
@@ -409,13 +561,9 @@ class TrainLoop(object):
         self.erasable = None
 
     def setup_minibatching(self, batch):
-        # find all static features in the policy; TODO cache this list in the policy
         # TODO there's gonna be an issue with multitask policies where only some features run on certain examples :(
-        computed_modules = set()
-        for module in self.policy.modules():
-            if isinstance(module, macarico.StaticFeatures) and id(module) not in computed_modules:
-                computed_modules.add(id(module))
-                module.forward_batch(batch)
+        for module in self.policy.feature_graph().static_features:
+            module.forward_batch(batch)
 
     def print_it(self, string, *args, **kwargs):
         if not self.quiet:
@@ -451,6 +599,21 @@ class TrainLoop(object):
               n_epochs=1,
               resume_from_checkpoint=None,
              ):
+        if not self.profile:
+            return self._train(training_data, dev_data, n_epochs, resume_from_checkpoint)
+        profiler.reset()
+        profiler.enabled = True
+        profiler.record_trace = self.profile_trace_to is not None
+        profiler.watch(self.policy)
+        try:
+            return self._train(training_data, dev_data, n_epochs, resume_from_checkpoint)
+        finally:
+            profiler.enabled = False
+            profiler.unwatch()
+            if self.profile_trace_to is not None:
+                profiler.dump_chrome_trace(self.profile_trace_to)
+
+    def _train(self, training_data, dev_data, n_epochs, resume_from_checkpoint):
         self.erasable = None
         if dev_data is not None and len(dev_data) == 0:
             dev_data = None
@@ -525,7 +688,7 @@ class TrainLoop(object):
 
                 # preprocess if we're minibatching
                 self.policy.new_minibatch()
-                batch = [self.mk_env(example) for example in batch]
+                batch = self.env_pool(batch)
                 if len(batch) > 1:
                     self.setup_minibatching(batch)
 
@@ -541,7 +704,8 @@ class TrainLoop(object):
                     if not self.bandit_evaluation and self.N > tr_eval_threshold:
                         self.tr_loss_matrix.run_and_append(env, self.policy)
 
-                    obj = self.learning_alg(env)
+                    with profiler.section('learning_alg'):
+                        obj = self.learning_alg(env)
                     if self.bandit_evaluation:
                         self.tr_loss_matrix.append(env.example)
 
@@ -551,11 +715,15 @@ class TrainLoop(object):
                 # do a gradient update/optimizer step
                 if not isinstance(total_obj, float):
                     total_obj /= len(batch)
-                    total_obj.backward()
+                    with profiler.section('backward'):
+                        total_obj.backward()
 
                     if self.gradient_clip is not None:
                         total_norm = nn.utils.clip_grad_norm(self.optimizer_parameters, self.gradient_clip)
-                    self.optimizer.step()
+                    with profiler.section('optimizer.step'):
+                        self.optimizer.step()
+                if self.profile:
+                    profiler.new_minibatch()
 
 
                 # print stuff to screen and/or save the current model
@@ -643,7 +811,7 @@ class TrainLoop(object):
             # TODO minibatch this
             for example in dev_data[:self.N]:
                 self.policy.new_minibatch()
-                self.de_loss_matrix.run_and_append(self.mk_env(example), self.policy)
+                self.de_loss_matrix.run_and_append(self.dev_env_pool([example])[0], self.policy)
 
         tr_err = self.tr_loss_matrix.next(self.N, self.epoch)
         de_err = self.de_loss_matrix.next(self.N, self.epoch)
@@ -661,6 +829,8 @@ class TrainLoop(object):
                                      self.N,
                                      self.epoch,
                                      is_best))
+        if self.profile and hasattr(self.formatter, 'profile'):
+            self.print_it(self.formatter.profile(profiler))
         self.objective_average.reset()
 
         self.last_print = self.N
@@ -742,14 +912,12 @@ def test_reference(mk_env, ref, loss, data, verbose=False, test_values=False, ex
         test_reference_on(mk_env, ref, loss, example, verbose, test_values, except_on_failure)
 
 def sample_action_from_probs(r, probs):
-    r0 = r
-    for i, v in enumerate(probs):
-        r -= v
-        if r <= 0:
-            return i
-    _, mx = probs.max(0)
-    print('warning: sampling from %s failed! returning max item %d; (r=%g r0=%g sum=%g)' % \
-          (str(probs), mx, r, r0, probs.sum()), file=sys.stderr)
+    # the first i with probs[0] + ... + probs[i] >= r
+    i = int((probs.cumsum(0) < r).sum())
+    if i < len(probs):
+        return i
+    print('warning: sampling from %s failed! returning last item; (r=%g sum=%g)' % \
+          (str(probs), r, probs.sum()), file=sys.stderr)
     return len(probs)-1
 
 def sample_from_np_probs(np_probs):
@@ -758,6 +926,5 @@ def sample_from_np_probs(np_probs):
     return a, np_probs[a]
 
 def sample_from_probs(probs):
-    r = np.random.rand()
-    a = sample_action_from_probs(r, probs.data)
-    return a, probs[a]
+    a, p = sampling.sample(probs)
+    return a.item(), p
@@ -0,0 +1,325 @@
+from __future__ import division, generators, print_function
+"""
+Throughput benchmarks for macarico's hot paths. Runs entirely on
+synthetic data, so no downloads are needed. Usage:
+
+    python benchmark.py                         # run everything, print a table
+    python benchmark.py --quick                 # smaller sizes, for smoke testing
+    python benchmark.py --only sl_ dep_         # only benchmarks with these prefixes
+    python benchmark.py --out bench.json        # save results
+    python benchmark.py --baseline old.json     # compare against an earlier run
+
+Every benchmark reports a rate (tokens/sec, sentences/sec or
+episodes/sec; higher is better). The JSON output records the git commit
+and library versions, so runs from different commits can be compared
+with --baseline.
+"""
+
+import sys
+import os
+import time
+import json
+import argparse
+import platform
+import subprocess
+import random
+
+import numpy as np
+import torch
+
+import macarico
+import macarico.util as util
+from macarico.data.types import Sequences, Dependencies
+
+from macarico.lts.dagger import DAgger
+from macarico.lts.aggrevate import AggreVaTe
+from macarico.lts.lols import LOLS
+from macarico.lts.reinforce import Reinforce, LinearValueFn, A2C
+
+from macarico.features.sequence import EmbeddingFeatures, BOWFeatures, RNN, AttendAt
+from macarico.actors.rnn import RNNActor
+from macarico.actors.bow import BOWActor
+from macarico.policies.linear import CSOAAPolicy
+
+import macarico.tasks.sequence_labeler as sl
+import macarico.tasks.dependency_parser as dep
+import macarico.tasks.cartpole as cartpole
+import macarico.tasks.gridworld as gridworld
+import macarico.tasks.mountain_car as car
+
+################################################################################
+# synthetic data
+################################################################################
+
+def make_sequence_data(n_examples, length, n_types, n_labels):
+    "label of each token is a deterministic function of it and its left neighbor"
+    data = []
+    for _ in range(n_examples):
+        x = np.random.randint(0, n_types, length).tolist()
+        y = [(x[i] + (x[i-1] if i > 0 else 0)) % n_labels for i in range(length)]
+        data.append(Sequences(x, y, n_types, n_labels))
+    return data
+
+def random_projective_heads(n):
+    "heads of a uniformly split random projective tree over n tokens (root = n)"
+    heads = [None] * n
+    spans = [(0, n, n)]
+    while len(spans) > 0:
+        lo, hi, head = spans.pop()
+        if lo >= hi: continue
+        r = random.randrange(lo, hi)
+        heads[r] = head
+        spans.append((lo, r, r))
+        spans.append((r+1, hi, r))
+    return heads
+
+def make_dependency_data(n_examples, length, n_types):
+    data = []
+    for _ in range(n_examples):
+        tokens = np.random.randint(0, n_types, length).tolist()
+        data.append(Dependencies(tokens=tokens,
+                                 heads=random_projective_heads(length),
+                                 token_vocab=n_types))
+    return data
+
+################################################################################
+# model builders
+################################################################################
+
+def build_sequence_policy(feature_type, n_types, n_actions, attention=AttendAt, d=50):
+    if feature_type == 'bow':
+        features = BOWFeatures(n_types)
+    elif feature_type == 'emb':
+        features = EmbeddingFeatures(n_types, d_emb=d)
+    elif feature_type == 'bilstm':
+        features = RNN(EmbeddingFeatures(n_types, d_emb=d), d_rnn=d, bidirectional=True, cell_type='LSTM')
+    else:
+        raise ValueError('unknown feature type %s' % feature_type)
+    if feature_type == 'bow':
+        actor = BOWActor([attention(features)], n_actions)
+    else:
+        actor = RNNActor([attention(features)], n_actions, d_hid=d)
+    return CSOAAPolicy(actor, n_actions)
+
+def build_rl_policy(features, n_actions):
+    actor = BOWActor([AttendAt(features, position=lambda _: 0)], n_actions)
+    return actor, CSOAAPolicy(actor, n_actions)
+
+################################################################################
+# timing
+################################################################################
+
+def train_examples(mk_env, examples, policy, learning_alg, parameters):
+    "one pass of plain per-example SGD; returns elapsed seconds"
+    optimizer = torch.optim.Adam(parameters, lr=0.001)
+    start = time.perf_counter()
+    for example in examples:
+        optimizer.zero_grad()
+        policy.new_minibatch()
+        obj = learning_alg(mk_env(example))
+        if not isinstance(obj, float):
+            obj.backward()
+            optimizer.step()
+    return time.perf_counter() - start
+
+def evaluate_examples(mk_env, examples, policy):
+    "one pass of test-time prediction; returns elapsed seconds"
+    start = time.perf_counter()
+    with torch.no_grad():
+        for example in examples:
+            policy.new_minibatch()
+            mk_env(example).run_episode(policy)
+    return time.perf_counter() - start
+
+def result(unit, count, seconds, **extra):
+    r = { 'unit': unit,
+          'count': count,
+          'seconds': seconds,
+          'rate': count / max(seconds, 1e-12) }
+    r.update(extra)
+    return r
+
+################################################################################
+# benchmarks; each takes a size dictionary and returns a result()
+################################################################################
+
+def bench_sequence_labeling(feature_type, train):
+    def run(size):
+        n_types, n_labels = 50, 9
+        data = make_sequence_data(size['sl_examples'], size['sl_length'], n_types, n_labels)
+        policy = build_sequence_policy(feature_type, n_types, n_labels)
+        n_tokens = sum((len(ex.X) for ex in data))
+        if train:
+            learner = DAgger(policy, sl.HammingLossReference())
+            alg = util.LearnerToAlg(learner, policy, sl.HammingLoss)
+            seconds = train_examples(sl.SequenceLabeler, data, policy, alg, policy.parameters())
+        else:
+            seconds = evaluate_examples(sl.SequenceLabeler, data, policy)
+        return result('tokens/sec', n_tokens, seconds)
+    return run
+
+def bench_dependency_parsing(learner_name):
+    def run(size):
+        n_types = 50
+        data = make_dependency_data(size['dep_examples'], size['dep_length'], n_types)
+        n_actions = dep.DependencyParser(data[0]).n_actions
+        policy = build_sequence_policy('emb', n_types, n_actions, attention=dep.DependencyAttention)
+        ref = dep.AttachmentLossReference()
+        if learner_name == 'lols':
+            alg = LOLS(policy, ref, dep.AttachmentLoss, prefix_cache_size=10000)
+        else:
+            learner = DAgger(policy, ref) if learner_name == 'dagger' else \
+                      AggreVaTe(policy, ref)
+            alg = util.LearnerToAlg(learner, policy, dep.AttachmentLoss)
+        seconds = train_examples(dep.DependencyParser, data, policy, alg, policy.parameters())
+        return result('sentences/sec', len(data), seconds,
+                      tokens_per_sec=len(data) * size['dep_length'] / max(seconds, 1e-12))
+    return run
+
+RL_TASKS = {
+    'cartpole':  (lambda: cartpole.CartPoleEnv(), cartpole.CartPoleFeatures, cartpole.CartPoleLoss),
+    'gridworld': (lambda: gridworld.make_default_gridworld(), gridworld.LocalGridFeatures, gridworld.GridLoss),
+    'car':       (lambda: car.MountainCar(T=200), car.MountainCarFeatures, car.MountainCarLoss),
+}
+
+def bench_rl(task_name, learner_name):
+    def run(size):
+        mk_env, mk_features, loss_fn = RL_TASKS[task_name]
+        n_actions = mk_env().n_actions
+        actor, policy = build_rl_policy(mk_features(), n_actions)
+        parameters = list(policy.parameters())
+        if learner_name == 'reinforce':
+            learner = Reinforce(policy)
+        else:
+            value_fn = LinearValueFn(actor)
+            learner = A2C(policy, value_fn)
+            parameters += list(value_fn.parameters())
+        alg = util.LearnerToAlg(learner, policy, loss_fn)
+        n_episodes = size['rl_episodes']
+        envs = []
+        def mk_tracked_env(_):
+            env = mk_env()
+            envs.append(env)
+            return env
+        seconds = train_examples(mk_tracked_env, range(n_episodes), policy, alg, parameters)
+        n_steps = sum((len(env._trajectory) for env in envs))
+        return result('episodes/sec', n_episodes, seconds,
+                      steps_per_sec=n_steps / max(seconds, 1e-12))
+    return run
+
+BENCHMARKS = [
+    ('sl_bow_train',       bench_sequence_labeling('bow', True)),
+    ('sl_emb_train',       bench_sequence_labeling('emb', True)),
+    ('sl_bilstm_train',    bench_sequence_labeling('bilstm', True)),
+    ('sl_bow_eval',        bench_sequence_labeling('bow', False)),
+    ('sl_emb_eval',        bench_sequence_labeling('emb', False)),
+    ('sl_bilstm_eval',     bench_sequence_labeling('bilstm', False)),
+    ('dep_dagger_train',   bench_dependency_parsing('dagger')),
+    ('dep_aggrevate_train',bench_dependency_parsing('aggrevate')),
+    ('dep_lols_train',     bench_dependency_parsing('lols')),
+    ('rl_cartpole_reinforce',  bench_rl('cartpole', 'reinforce')),
+    ('rl_cartpole_a2c',        bench_rl('cartpole', 'a2c')),
+    ('rl_gridworld_reinforce', bench_rl('gridworld', 'reinforce')),
+    ('rl_gridworld_a2c',       bench_rl('gridworld', 'a2c')),
+    ('rl_car_reinforce',       bench_rl('car', 'reinforce')),
+    ('rl_car_a2c',             bench_rl('car', 'a2c')),
+]
+
+SIZES = {
+    'full':  { 'sl_examples': 500, 'sl_length': 20,
+               'dep_examples': 100, 'dep_length': 15,
+               'rl_episodes': 100 },
+    'quick': { 'sl_examples': 20, 'sl_length': 10,
+               'dep_examples': 5, 'dep_length': 8,
+               'rl_episodes': 5 },
+}
+
+################################################################################
+# driver
+################################################################################
+
+def git_commit():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def run_benchmarks(size, only=None, repeat=1, seed=90210, verbose=True):
+    results = {}
+    for name, bench in BENCHMARKS:
+        if only and not any((name.startswith(prefix) for prefix in only)):
+            continue
+        runs = []
+        for _ in range(repeat):
+            util.reseed(seed)
+            runs.append(bench(size))
+        # report the fastest run, which is least affected by noise
+        best = max(runs, key=lambda r: r['rate'])
+        best['repeat'] = repeat
+        results[name] = best
+        if verbose:
+            print('%-26s %12.2f %-14s (%.2fs)' % (name, best['rate'], best['unit'], best['seconds']),
+                  file=sys.stderr)
+    return results
+
+def compare(results, baseline, threshold):
+    "print rate ratios against `baseline`; returns names of regressions"
+    regressions = []
+    print('%-26s %12s %12s %8s' % ('benchmark', 'baseline', 'current', 'ratio'))
+    for name in sorted(results):
+        if name not in baseline: continue
+        old, new = baseline[name]['rate'], results[name]['rate']
+        ratio = new / max(old, 1e-12)
+        flag = ''
+        if ratio < 1 - threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-26s %12.2f %12.2f %8.3f%s' % (name, old, new, ratio, flag))
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='macarico throughput benchmarks')
+    parser.add_argument('--quick', action='store_true', help='use small problem sizes')
+    parser.add_argument('--only', nargs='*', default=None, help='only run benchmarks with these name prefixes')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per benchmark; the fastest is kept')
+    parser.add_argument('--seed', type=int, default=90210)
+    parser.add_argument('--threads', type=int, default=1, help='torch intra-op threads (fixed for comparability)')
+    parser.add_argument('--out', default=None, help='write JSON results here')
+    parser.add_argument('--baseline', default=None, help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown counted as a regression')
+    args = parser.parse_args(argv)
+
+    torch.set_num_threads(args.threads)
+    size_name = 'quick' if args.quick else 'full'
+    results = run_benchmarks(SIZES[size_name], args.only, args.repeat, args.seed)
+
+    report = { 'meta': { 'commit': git_commit(),
+                         'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                         'python': platform.python_version(),
+                         'torch': torch.__version__,
+                         'platform': platform.platform(),
+                         'threads': args.threads,
+                         'size': size_name,
+                         'sizes': SIZES[size_name],
+                         'seed': args.seed },
+               'results': results }
+
+    if args.out is not None:
+        with open(args.out, 'w') as h:
+            json.dump(report, h, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as h:
+            baseline = json.load(h)
+        if baseline['meta'].get('size') != size_name:
+            print('warning: baseline was run with size=%s, this run is size=%s' % \
+                  (baseline['meta'].get('size'), size_name), file=sys.stderr)
+        regressions = compare(results, baseline['results'], args.threshold)
+        if len(regressions) > 0:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
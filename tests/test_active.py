@@ -0,0 +1,82 @@
+from __future__ import division, generators, print_function
+
+import numpy as np
+import torch
+import macarico.util
+macarico.util.reseed()
+
+from macarico.data.types import Sequences
+from macarico.annealing import ExponentialAnnealing
+from macarico.lts.lols import LOLS
+import macarico.tasks.sequence_labeler as sl
+from macarico.features.sequence import EmbeddingFeatures, RNN, AttendAt
+from macarico.actors.rnn import RNNActor
+from macarico.policies.linear import CSOAAPolicy
+from macarico.policies.active import CSActive
+
+def make_data(count, length, n_types, n_labels):
+    data = []
+    for _ in range(count):
+        x = np.random.randint(0, n_types, length).tolist()
+        data.append(Sequences(x, [t % n_labels for t in x], n_types, n_labels))
+    return data
+
+class RestrictedLabeler(sl.SequenceLabeler):
+    # only two labels are allowed at each position (one of them right),
+    # so that cost_ranges sees disallowed actions
+    TRAJECTORY_INDEPENDENT = False
+
+    def _run_episode(self, policy):
+        for self.n in range(self.horizon()):
+            x = self.X[self.n]
+            self.actions = set([x % self.n_actions, (x + 1) % self.n_actions])
+            policy(self)
+        return self._trajectory
+
+class CheckedCSActive(CSActive):
+    def cost_ranges(self, state, pred_costs=None):
+        res = CSActive.cost_ranges(self, state, pred_costs)
+        assert (res[1] & (1 - state.action_mask())).sum().item() == 0, \
+            'cost_ranges wants to query a disallowed action'
+        return res
+
+def test1(active, mk_env=sl.SequenceLabeler):
+    print()
+    print('# testing LOLS active=%s on %s' % (active, mk_env.__name__))
+    print()
+    n_types = 10
+    n_labels = 4
+    length = 5
+    data = make_data(100, length, n_types, n_labels)
+
+    actor = RNNActor([AttendAt(RNN(EmbeddingFeatures(n_types)))], n_labels)
+    policy = CSOAAPolicy(actor, n_labels)
+    if active:
+        policy = CheckedCSActive(policy, min_cost=0, max_cost=length)
+    optimizer = torch.optim.Adam(policy.parameters(), lr=0.01)
+    if active:
+        policy.set_optimizer(optimizer)
+
+    learner = LOLS(policy,
+                   sl.HammingLossReference(),
+                   sl.HammingLoss,
+                   p_rollin_ref=ExponentialAnnealing(0.9),
+                   p_rollout_ref=ExponentialAnnealing(0.9),
+                   active=active)
+
+    macarico.util.TrainLoop(mk_env, policy, learner, optimizer,
+                            losses=sl.HammingLoss,
+                            progress_bar=False,
+    ).train(data[:len(data)//2],
+            dev_data=data[len(data)//2:],
+            n_epochs=2)
+    print('rollouts run: %d, skipped: %d' % (learner.n_rollouts, learner.n_skipped))
+    if active and mk_env is RestrictedLabeler:
+        # only the two allowed actions of a step are rolled out or skipped
+        n_steps = 2 * (len(data) // 2) * length  # over 2 epochs
+        assert learner.n_rollouts + learner.n_skipped <= 2 * n_steps
+
+if __name__ == '__main__':
+    test1(False)
+    test1(True)
+    test1(True, RestrictedLabeler)
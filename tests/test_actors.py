@@ -0,0 +1,143 @@
+from __future__ import division, generators, print_function
+
+import numpy as np
+import torch
+import macarico.util
+macarico.util.reseed()
+
+from macarico.data.types import Sequences
+import macarico.tasks.sequence_labeler as sl
+from macarico.features.sequence import EmbeddingFeatures, RNN, AttendAt
+from macarico.actors.rnn import RNNActor
+from macarico.actors.bow import BOWActor
+
+n_types = 10
+n_labels = 4
+
+def make_envs(count, length):
+    envs = []
+    for _ in range(count):
+        x = np.random.randint(0, n_types, length).tolist()
+        envs.append(sl.SequenceLabeler(Sequences(x, [t % n_labels for t in x], n_types, n_labels)))
+    return envs
+
+def random_actions(envs):
+    return [np.random.randint(0, n_labels, env.horizon()).tolist() for env in envs]
+
+def run_single(actor, env, actions):
+    # step-by-step outputs of actor on env, taking actions; (T, dim)
+    actor.reset()
+    env._trajectory = []
+    out = []
+    for t, _ in enumerate(env.states()):
+        out.append(actor(env).data.clone())
+        env._trajectory.append(actions[t])
+    return torch.cat(out, 0)
+
+def run_batch(actor, envs, actions):
+    # outputs of actor.forward_batch with envs in lockstep; (T, B, dim)
+    actor.reset()
+    for env in envs:
+        env._trajectory = []
+    states = [env.states() for env in envs]
+    out = []
+    for t in range(envs[0].horizon()):
+        for s in states:
+            next(s)
+        out.append(actor.forward_batch(envs).data.clone())
+        for env, acts in zip(envs, actions):
+            env._trajectory.append(acts[t])
+    return torch.stack(out, 0)
+
+def max_diff(a, b):
+    return (a - b).abs().max().item()
+
+def step_through(actor, env, actions):
+    # like run_single, but also returns the actor's state before the
+    # first step and after each one (only meaningful when not forced)
+    actor.reset()
+    env._trajectory = []
+    out, states = [], [actor._snapshot()]
+    for t, _ in enumerate(env.states()):
+        out.append(actor(env).data.clone())
+        states.append(actor._snapshot())
+        env._trajectory.append(actions[t])
+    return torch.cat(out, 0), states
+
+def force(actor, env, actions):
+    # what util.teacher_force does, for a bare actor
+    actor.clear_teacher_force()
+    actor.reset()
+    actor.begin_teacher_force()
+    env._trajectory = []
+    for t, _ in enumerate(env.states()):
+        actor.record_teacher_force(env)
+        env._trajectory.append(actions[t])
+    actor.end_teacher_force(env.example, actions)
+
+def state_diff(a, b):
+    a = a if isinstance(a, tuple) else (a,)
+    b = b if isinstance(b, tuple) else (b,)
+    return max((max_diff(x.data, y.data) for x, y in zip(a, b)))
+
+def test_forward_batch():
+    print()
+    print('# testing Actor.forward_batch against per-state forward')
+    print()
+    mk_actors = [('RNNActor(LSTM)', lambda att: RNNActor(att, n_labels)),
+                 ('RNNActor(GRU, d_actemb=5)', lambda att: RNNActor(att, n_labels, d_actemb=5, cell_type='GRU')),
+                 ('BOWActor', lambda att: BOWActor(att, n_labels, act_history_length=2, obs_history_length=2)),
+                ]
+    for name, mk_actor in mk_actors:
+        actor = mk_actor([AttendAt(RNN(EmbeddingFeatures(n_types)))])
+        envs = make_envs(3, 6)
+        actions = random_actions(envs)
+        batched = run_batch(actor, envs, actions)
+        for i, env in enumerate(envs):
+            d = max_diff(run_single(actor, env, actions[i]), batched[:,i])
+            assert d < 1e-5, '%s: forward_batch differs from forward by %g' % (name, d)
+        print('%s ok' % name)
+
+def test_teacher_force():
+    print()
+    print('# testing RNNActor teacher forcing against per-step cells')
+    print()
+    T = 7
+    for cell_type in ['LSTM', 'GRU', 'RNN']:
+        actor = RNNActor([AttendAt(RNN(EmbeddingFeatures(n_types)))], n_labels, cell_type=cell_type)
+        env = make_envs(1, T)[0]
+        actions = random_actions([env])[0]
+        diverged = []
+        for k in range(1, T):
+            acts = list(actions)
+            acts[k-1] = (acts[k-1] + 1) % n_labels
+            diverged.append(acts)
+
+        # step-by-step references, computed before any forcing
+        ref_out, ref_states = step_through(actor, env, actions)
+        refs = [step_through(actor, env, acts) for acts in diverged]
+
+        force(actor, env, actions)
+        d = max_diff(actor._forced[2].data, ref_out)
+        assert d < 1e-5, '%s: _teacher_force differs from %sCell by %g' % (cell_type, cell_type, d)
+        for t in range(T+1):
+            d = state_diff(actor._forced_state(t), ref_states[t])
+            assert d < 1e-5, '%s: _forced_state(%d) differs by %g' % (cell_type, t, d)
+
+        # following the forced actions replays the forced outputs
+        out, _ = step_through(actor, env, actions)
+        assert actor._forced_on_path, '%s: left the forced path' % cell_type
+        d = max_diff(out, ref_out)
+        assert d < 1e-5, '%s: forced episode differs by %g' % (cell_type, d)
+
+        # diverging after step k restores the state after k steps
+        for k, (acts, (ref, ref_st)) in enumerate(zip(diverged, refs), 1):
+            out, states = step_through(actor, env, acts)
+            assert not actor._forced_on_path, '%s: missed divergence at %d' % (cell_type, k)
+            d = max(max_diff(out, ref), state_diff(states[-1], ref_st[-1]))
+            assert d < 1e-5, '%s: diverging at %d differs by %g' % (cell_type, k, d)
+        print('%s ok' % cell_type)
+
+if __name__ == '__main__':
+    test_forward_batch()
+    test_teacher_force()
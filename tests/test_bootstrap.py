@@ -1,63 +1,59 @@
 from __future__ import division, generators, print_function
 
-import random
+import numpy as np
 import torch
-import torch.nn as nn
-import torch.nn.functional as F
-from torch.autograd import Variable as Var
-import sys
 import macarico.util
 macarico.util.reseed()
 
-from macarico.annealing import ExponentialAnnealing, stochastic, EWMA
+from macarico.data.types import Sequences
+from macarico.annealing import ExponentialAnnealing
 from macarico.lts.lols import BanditLOLS
-from macarico.tasks.sequence_labeler import Example, HammingLoss, HammingLossReference
-from macarico.features.sequence import RNNFeatures, AttendAt
-from macarico.features.actor import TransitionRNN
+import macarico.tasks.sequence_labeler as sl
+from macarico.features.sequence import EmbeddingFeatures, RNN, AttendAt
+from macarico.actors.rnn import RNNActor
 from macarico.policies.bootstrap import BootstrapPolicy
-from macarico.policies.linear import LinearPolicy
 
-def test1(learning_method, exploration):
-    print
-    print '# testing learning_method=%d exploration=%d' % (learning_method, exploration)
-    print
+def make_data(count, length, n_types, n_labels):
+    data = []
+    for _ in range(count):
+        x = np.random.randint(0, n_types, length).tolist()
+        data.append(Sequences(x, [t % n_labels for t in x], n_types, n_labels))
+    return data
+
+def test1(learning_method, exploration, shared):
+    print()
+    print('# testing learning_method=%d exploration=%d shared=%s' % (learning_method, exploration, shared))
+    print()
     n_types = 10
     n_labels = 2
-    data = macarico.util.make_sequence_mod_data(100, 1, n_types, n_labels)
-    data = [Example(x, y, n_labels) for x, y in data]
+    data = make_data(100, 3, n_types, n_labels)
 
     bag_size = 5
-    tRNN = [TransitionRNN([RNNFeatures(n_types)], [AttendAt()], n_labels) for i in range(bag_size)]
-    policy = BootstrapPolicy(tRNN, n_labels)
-    #policy = LinearPolicy(tRNN[0], n_labels)
-    #print 'policy=', policy
-    #print 'parameters=', list(policy.parameters())
+    if shared:
+        # one encoder and actor; only the bag's heads differ
+        actor = RNNActor([AttendAt(RNN(EmbeddingFeatures(n_types)))], n_labels)
+        policy = BootstrapPolicy(actor, n_labels, bag_size=bag_size)
+    else:
+        actors = [RNNActor([AttendAt(RNN(EmbeddingFeatures(n_types)))], n_labels) for i in range(bag_size)]
+        policy = BootstrapPolicy(actors, n_labels)
     optimizer = torch.optim.Adam(policy.parameters(), lr=0.01)
 
-    p_rollin_ref  = stochastic(ExponentialAnnealing(0.9))
-    p_rollout_ref = stochastic(ExponentialAnnealing(0.99999))
-
-    macarico.util.trainloop(
-        training_data   = data[:len(data)//2],
-        dev_data        = data[len(data)//2:],
-        policy          = policy,
-        Learner         = lambda: BanditLOLS(HammingLossReference(),
-                                             policy,
-                                             p_rollin_ref,
-                                             p_rollout_ref,
-                                             learning_method,
-                                             exploration,
-                                             ),
-        losses          = HammingLoss(),
-        optimizer       = optimizer,
-        run_per_batch   = [p_rollin_ref.step, p_rollout_ref.step],
-        train_eval_skip = 1,
-        n_epochs        = 2,
-    )
+    learner = BanditLOLS(policy,
+                         sl.HammingLossReference(),
+                         p_rollin_ref=ExponentialAnnealing(0.9),
+                         p_rollout_ref=ExponentialAnnealing(0.99999),
+                         update_method=learning_method,
+                         exploration=exploration)
+
+    macarico.util.TrainLoop(sl.SequenceLabeler, policy, learner, optimizer,
+                            losses=sl.HammingLoss,
+                            progress_bar=False,
+    ).train(data[:len(data)//2],
+            dev_data=data[len(data)//2:],
+            n_epochs=2)
 
 if __name__ == '__main__':
     for learning_method in [BanditLOLS.LEARN_IPS, BanditLOLS.LEARN_DR, BanditLOLS.LEARN_MTR]:
         for exploration in [BanditLOLS.EXPLORE_BOLTZMANN, BanditLOLS.EXPLORE_BOOTSTRAP]:
-            test1(learning_method, exploration)
-
-
+            for shared in [True, False]:
+                test1(learning_method, exploration, shared)
@@ -0,0 +1,52 @@
+from __future__ import division, generators, print_function
+import sys
+import numpy as np
+import torch
+
+import macarico.util as util
+from macarico.annealing import ExponentialAnnealing
+from macarico.features.sequence import AttendAt
+from macarico.actors.bow import BOWActor
+from macarico.policies.linear import CSOAAPolicy
+from macarico.lts.dqn import DQN
+
+import macarico.tasks.cartpole as cartpole
+import macarico.tasks.gridworld as gridworld
+
+TASKS = {
+    'cartpole':  (cartpole.CartPoleEnv, cartpole.CartPoleFeatures, cartpole.CartPoleLoss),
+    'gridworld': (gridworld.make_default_gridworld, gridworld.LocalGridFeatures, gridworld.GridLoss),
+}
+
+def test_dqn(task, prioritized, n_episodes=300):
+    print('dqn', task, 'prioritized' if prioritized else 'uniform')
+    mk_env, mk_features, mk_loss = TASKS[task]
+    env = mk_env()
+    actor = BOWActor([AttendAt(mk_features(), position=lambda _: 0)], env.n_actions)
+    policy = CSOAAPolicy(actor, env.n_actions)
+    learner = DQN(policy,
+                  p_explore=ExponentialAnnealing(0.99, lower_bound=0.05),
+                  min_replay_size=50,
+                  target_update_every=20,
+                  prioritized=prioritized)
+    optimizer = torch.optim.Adam(policy.parameters(), lr=0.01)
+    loss_fn = mk_loss()
+    losses = []
+    for episode in range(1, 1+n_episodes):
+        optimizer.zero_grad()
+        env = mk_env()
+        env.run_episode(learner)
+        loss = loss_fn.evaluate(env.example)
+        losses.append(loss)
+        obj = learner.get_objective(loss)
+        if not isinstance(obj, float):
+            obj.backward()
+            optimizer.step()
+        if episode % 50 == 0:
+            print(episode, len(learner.replay), np.mean(losses[-50:]))
+
+if __name__ == '__main__':
+    util.reseed(90210)
+    task = sys.argv[1] if len(sys.argv) > 1 else 'cartpole'
+    test_dqn(task, prioritized=False)
+    test_dqn(task, prioritized=True)
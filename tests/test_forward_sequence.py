@@ -0,0 +1,84 @@
+from __future__ import division, generators, print_function
+
+import numpy as np
+import torch
+import macarico.util
+macarico.util.reseed()
+
+from macarico.data.types import Sequences
+import macarico.tasks.sequence_labeler as sl
+from macarico.features.sequence import EmbeddingFeatures, RNN, AttendAt
+from macarico.actors.bow import BOWActor
+from macarico.policies.linear import SoftmaxPolicy, CSOAAPolicy
+from macarico.lts.dagger import DAgger
+
+n_types = 10
+n_labels = 4
+
+def make_env(length):
+    x = np.random.randint(0, n_types, length).tolist()
+    return sl.SequenceLabeler(Sequences(x, [t % n_labels for t in x], n_types, n_labels))
+
+def make_actor():
+    # no action or observation history, so the actor is trajectory
+    # independent
+    return BOWActor([AttendAt(RNN(EmbeddingFeatures(n_types)))], n_labels,
+                    act_history_length=0, obs_history_length=0)
+
+def run(env, runner, sequence):
+    # run an episode either through forward_sequence or step by step
+    env.TRAJECTORY_INDEPENDENT = sequence
+    try:
+        return list(map(int, env.run_episode(runner)))
+    finally:
+        del env.TRAJECTORY_INDEPENDENT
+
+def test_policy(mk_policy):
+    policy = mk_policy(make_actor(), n_labels)
+    assert policy.trajectory_independent()
+    for length in [1, 5, 12]:
+        env = make_env(length)
+        by_sequence = run(env, policy, True)
+        by_step = run(env, policy, False)
+        assert by_sequence == by_step, '%s: %s != %s' % (type(policy).__name__, by_sequence, by_step)
+    print('%s ok' % type(policy).__name__)
+
+def test_dagger():
+    policy = CSOAAPolicy(make_actor(), n_labels)
+    learner = DAgger(policy, sl.HammingLossReference())
+    for length in [1, 5, 12]:
+        env = make_env(length)
+        # costs of every state at once match the per-state costs
+        policy.new_example()
+        costs = policy.predict_costs_sequence(env).data
+        policy.new_example()
+        env.rewind(policy)
+        for t, state in enumerate(env.states()):
+            d = (costs[t] - policy.predict_costs(state).data).abs().max().item()
+            assert d < 1e-5, 'predict_costs_sequence differs at %d by %g' % (t, d)
+            state._trajectory.append(0)
+
+        results = []
+        for sequence in [True, False]:
+            traj = run(env, learner, sequence)
+            obj = learner.get_objective(None)
+            results.append((traj, obj.item()))
+        (traj1, obj1), (traj2, obj2) = results
+        assert traj1 == traj2, 'DAgger: %s != %s' % (traj1, traj2)
+        assert abs(obj1 - obj2) < 1e-5, 'DAgger: objective %g != %g' % (obj1, obj2)
+    print('DAgger ok')
+
+def test_empty():
+    actor = make_actor()
+    env = make_env(0)
+    assert actor.forward_all(env).shape == (0, actor.dim)
+    print('empty ok')
+
+if __name__ == '__main__':
+    print()
+    print('# testing forward_sequence against step-by-step episodes')
+    print()
+    test_policy(SoftmaxPolicy)
+    test_policy(CSOAAPolicy)
+    test_dagger()
+    test_empty()
@@ -0,0 +1,82 @@
+from __future__ import division, generators, print_function
+
+from copy import deepcopy
+import numpy as np
+import torch
+import macarico.util
+macarico.util.reseed()
+
+from macarico.data.types import Sequences
+from macarico.lts.dagger import DAgger
+import macarico.tasks.sequence_labeler as sl
+from macarico.features.sequence import EmbeddingFeatures, RNN, AttendAt
+from macarico.actors.rnn import RNNActor
+from macarico.policies.linear import CSOAAPolicy
+from macarico.util import TrainLoop
+from macarico.parallel import ParallelTrainLoop
+
+def make_data(count, length, n_types, n_labels):
+    data = []
+    for _ in range(count):
+        x = np.random.randint(0, n_types, length).tolist()
+        data.append(Sequences(x, [t % n_labels for t in x], n_types, n_labels))
+    return data
+
+def make_policy(n_types, n_labels):
+    actor = RNNActor([AttendAt(RNN(EmbeddingFeatures(n_types)))], n_labels)
+    return CSOAAPolicy(actor, n_labels)
+
+def train(policy, data, parallel, mode='sync', port=29500):
+    optimizer = torch.optim.SGD(policy.parameters(), lr=0.1)
+    learner = DAgger(policy, sl.HammingLossReference())
+    kwargs = dict(losses=sl.HammingLoss,
+                  quiet=True,
+                  reshuffle=False,
+                  returned_parameters='last')
+    if parallel:
+        loop = ParallelTrainLoop(sl.SequenceLabeler, policy, learner, optimizer,
+                                 n_workers=2, mode=mode, minibatch_size=1, port=port,
+                                 **kwargs)
+    else:
+        loop = TrainLoop(sl.SequenceLabeler, policy, learner, optimizer,
+                         minibatch_size=2, progress_bar=False, **kwargs)
+    _, _, params = loop.train(data[:len(data)//2],
+                              dev_data=data[len(data)//2:],
+                              n_epochs=2)
+    return loop, params
+
+def test_sync():
+    print()
+    print('# testing ParallelTrainLoop mode=sync against TrainLoop')
+    print()
+    n_types, n_labels = 10, 4
+    data = make_data(40, 5, n_types, n_labels)
+    # worker r gets examples r, r+2, ..., so with one example per
+    # worker each sync step sees the same pair as a TrainLoop
+    # minibatch of two, and both should end up with the same parameters
+    policy = make_policy(n_types, n_labels)
+    init = deepcopy(policy.state_dict())
+    _, serial = train(policy, data, False)
+    policy = make_policy(n_types, n_labels)
+    policy.load_state_dict(init)
+    _, parallel = train(policy, data, True, 'sync', 29501)
+    for name in serial:
+        d = (serial[name] - parallel[name]).abs().max().item()
+        assert d < 1e-4, '%s differs by %g' % (name, d)
+    print('sync ok')
+
+def test_hogwild():
+    print()
+    print('# testing ParallelTrainLoop mode=hogwild')
+    print()
+    # hogwild results vary from run to run, so only check that every
+    # example was trained on
+    n_types, n_labels = 10, 4
+    data = make_data(40, 5, n_types, n_labels)
+    loop, _ = train(make_policy(n_types, n_labels), data, True, 'hogwild', 29500)
+    assert loop.N == 2 * (len(data)//2), 'trained on %d examples' % loop.N
+    print('hogwild ok')
+
+if __name__ == '__main__':
+    test_sync()
+    test_hogwild()
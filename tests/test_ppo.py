@@ -1,57 +1,57 @@
-from macarico.tasks.mountain_car import MountainCar
-from macarico.tasks.mountain_car import MountainCarLoss
-from macarico.tasks.mountain_car import MountainCarFeatures
-from macarico.tasks.cartpole import CartPoleEnv
-from macarico.tasks.cartpole import CartPoleFeatures
-from macarico.tasks.cartpole import CartPoleLoss
-from macarico.features.actor import TransitionBOW
+from __future__ import division, generators, print_function
+from argparse import ArgumentParser
+import numpy as np
+import torch
+
+import macarico.util as util
+from macarico.tasks.mountain_car import MountainCar, MountainCarLoss, MountainCarFeatures
+from macarico.tasks.cartpole import CartPoleEnv, CartPoleFeatures, CartPoleLoss
 from macarico.features.sequence import AttendAt
-from macarico.policies.linear import LinearPolicy
-from macarico.annealing import EWMA
+from macarico.actors.bow import BOWActor
+from macarico.policies.linear import SoftmaxPolicy
 from macarico.lts.ppo import PPO
 from macarico.lts.reinforce import Reinforce
-from argparse import ArgumentParser
-import torch
-import torch.nn as nn
-import torch.nn.functional as F
-from torch.autograd import Variable as Var
 
 
 def parse_arguments():
     ap = ArgumentParser()
-    ap.add_argument('--eps', '-e', default='0.8', type=float,
+    ap.add_argument('--eps', '-e', default='0.2', type=float,
                     help='epsilon for PPO')
-    ap.add_argument('--task', '-t', default='mountaincar', type=str,
+    ap.add_argument('--task', '-t', default='cartpole', type=str,
                     help='Taks: either cartpole or mountaincar')
     ap.add_argument('--learner', '-l', default='ppo', type=str,
-                    help='Learner: either PPO or reinforce')
+                    help='Learner: either ppo or reinforce')
+    ap.add_argument('--episodes', '-n', default=200, type=int,
+                    help='number of training episodes')
     return ap.parse_args()
 
 
-def run_ppo(ex, actor, loss_fn, eps, learner_type):
+def run_ppo(mk_env, features, loss_fn, eps, learner_type, n_episodes):
     print(learner_type)
     print('Eps: ', eps)
 
-    policy = LinearPolicy(actor(), ex.n_actions, n_layers=1)
-    baseline = EWMA(0.8)
+    env = mk_env()
+    actor = BOWActor([AttendAt(features, position=lambda _: 0)], env.n_actions)
+    policy = SoftmaxPolicy(actor, env.n_actions)
     optimizer = torch.optim.Adam(policy.parameters(), lr=0.01)
+    if learner_type == 'ppo':
+        learner = PPO(policy, optimizer, eps, episodes_per_update=8)
+    elif learner_type == 'reinforce':
+        learner = Reinforce(policy)
     losses = []
-    n_episodes = 10000
     for episode in range(n_episodes):
-        dy.renew_cg()
-        if learner_type == 'ppo':
-            learner = PPO(policy, baseline, eps)
-        elif learner_type == 'reinforce':
-            learner = Reinforce(policy, baseline)
-        env = ex.mk_env()
+        optimizer.zero_grad()
+        env = mk_env()
         env.run_episode(learner)
-        loss = loss_fn(ex, env)
+        loss = loss_fn.evaluate(env.example)
         losses.append(loss)
-        if episode % 5 == 0:
-            print('episode: ', episode, 'loss:',
-                  sum(losses[-500:]) / len(losses[-500:]))
-        learner.update(loss)
-        optimizer.update()
+        obj = learner.get_objective(loss)
+        if not isinstance(obj, float):
+            # PPO steps the optimizer itself and returns a float
+            obj.backward()
+            optimizer.step()
+        if episode % 20 == 0:
+            print('episode: ', episode, 'loss:', np.mean(losses[-100:]))
 
 
 def test():
@@ -59,34 +59,15 @@ def test():
     print('Proximal Policy Optimization')
     print('')
     args = parse_arguments()
+    util.reseed(90210)
     if args.task == 'mountaincar':
         print('Mountain Car')
-        ex = MountainCar()
-        run_ppo(
-            ex,
-            lambda dy_model:
-            TransitionBOW(
-                          [MountainCarFeatures()],
-                          [AttendAt(lambda _: 0, 'mountain_car')],
-                          ex.n_actions),
-            MountainCarLoss(),
-            args.eps,
-            args.learner,
-        )
+        run_ppo(lambda: MountainCar(T=200), MountainCarFeatures(), MountainCarLoss(),
+                args.eps, args.learner, args.episodes)
     elif args.task == 'cartpole':
         print('Cart Pole')
-        ex = CartPoleEnv()
-        run_ppo(
-            ex,
-            lambda dy_model:
-            TransitionBOW(
-                          [CartPoleFeatures()],
-                          [AttendAt(lambda _: 0, 'cartpole')],
-                          ex.n_actions),
-            CartPoleLoss(),
-            args.eps,
-            args.learner,
-        )
+        run_ppo(CartPoleEnv, CartPoleFeatures(), CartPoleLoss(),
+                args.eps, args.learner, args.episodes)
     else:
         print('Unsupported Task!')
         exit(-1)
@@ -0,0 +1,48 @@
+from __future__ import division, generators, print_function
+import numpy as np
+import torch
+
+import macarico.util as util
+from macarico.lts.reinforce import Reinforce, LinearValueFn, A2C
+from macarico.policies.linear import SoftmaxPolicy
+
+import macarico.tasks.cartpole as cartpole
+import macarico.tasks.mountain_car as car
+import macarico.tasks.pendulum as pendulum
+
+TASKS = {
+    'cartpole': (cartpole.VecCartPoleEnv, cartpole.VecCartPoleFeatures),
+    'car':      (car.VecMountainCar, car.VecMountainCarFeatures),
+    'pendulum': (pendulum.VecPendulum, pendulum.VecPendulumFeatures),
+}
+
+def test_vector(task, learner_name, n_envs=16, n_steps=20, n_updates=50):
+    print('vector', task, learner_name)
+    mk_venv, mk_features = TASKS[task]
+    venv = mk_venv(n_envs)
+    features = mk_features()
+    policy = SoftmaxPolicy(features, venv.n_actions)
+    parameters = list(policy.parameters())
+    if learner_name == 'reinforce':
+        learner = Reinforce(policy)
+    else:
+        value_fn = LinearValueFn(features)
+        learner = A2C(policy, value_fn)
+        parameters += list(value_fn.parameters())
+    optimizer = torch.optim.Adam(parameters, lr=0.01)
+    losses = []
+    for update in range(1, 1+n_updates):
+        optimizer.zero_grad()
+        obj = venv.run_steps(learner, n_steps)
+        if not isinstance(obj, float):
+            obj.backward()
+            optimizer.step()
+        losses += venv.pop_finished()
+        if update % 10 == 0 and len(losses) > 0:
+            print(update, len(losses), np.mean(losses[-100:]))
+
+if __name__ == '__main__':
+    util.reseed(90210)
+    for task in sorted(TASKS.keys()):
+        for learner_name in ['reinforce', 'a2c']:
+            test_vector(task, learner_name)